@@ -7,6 +7,7 @@ Files:
     config/config.example.toml -- example config file with no keys, included in the git repo for reference
     config/config.toml -- real working instance of the config
     logs/chat.log -- every message sent in the connected Twitch chat
+    logs/archive/ -- indexed archive of every message, the command it was parsed as and what became of it
     logs/system.log -- mirror of the console output handled by the logging package
     executing.txt -- contains info about the currently executing command, for OBS
 """
@@ -18,6 +19,7 @@ Files:
 # PSL Packages;
 import os  # file manager and cmd command handler
 import sys  # for exiting with best practices and getting exception info for log
+import time
 import asyncio
 import random
 import argparse
@@ -26,7 +28,6 @@ import logging as log  # better print()
 from pathlib import Path  # for best practices filepath handling
 
 # PIP Packages;
-import pyautogui  # some mod only commands
 import aiohttp  # api and discord webhooks
 import toml  # configuration
 import twitchio.ext.commands.bot
@@ -41,8 +42,6 @@ __version__ = '3.34.0'
 CONFIG_FOLDER = Path('config/')
 LOGS_FOLDER = Path('logs/')
 
-pyautogui.FAILSAFE = False
-
 BRANCH_NAME, BRANCH_NAME_ASSUMED = cmpc.get_git_repo_info()
 COPYRIGHT_NOTICE = f"""
 ------------------------------------------
@@ -68,7 +67,7 @@ class TwitchPlays(twitchio.ext.commands.bot.Bot):
 
         Args:
             same as cmpc.TwitchConnection.__init__ but without prefix
-        Checks that username and auth are present. Deletes chat log if it exists. Instantiates a command processor
+        Checks that username and auth are present. Starts the chat log writer. Instantiates a command processor
         and permissions handler.
         """
         self.config = config
@@ -90,6 +89,8 @@ class TwitchPlays(twitchio.ext.commands.bot.Bot):
         if not config['twitch']['username'] or not config['twitch']['oauth_token']:
             log.fatal('[TWITCH] No channel or oauth token was provided.')
             cmpc.send_webhook(config['discord']['systemlog'], 'FAILED TO START - No Oauth or username was provided.')
+            # The loop never runs, so deliver it before exiting
+            cmpc.webhook_outbox().flush()
             sys.exit(1)
         if not config['api']['panelapikey']:
             log.warning('[CHATBOT] No panel api key was provided, chatbot command has been disabled.')
@@ -97,16 +98,46 @@ class TwitchPlays(twitchio.ext.commands.bot.Bot):
             log.warning('[LOG] You are enabling debug mode in a production env, '
                         'this will log discord webhook urls to system.log and such. you have been warned.')
 
-        # Remove temp chat log if it exists.
-        if os.path.exists(LOGS_FOLDER/'chat.log'):
-            os.remove(LOGS_FOLDER/'chat.log')
+        self.chat_log = None
+        if config['options']['LOG_PPR']:
+            chat_log_config = config.get('chat_log', {})
+            rotate_mb = chat_log_config.get('rotate_mb', 10)
+            self.chat_log = cmpc.ChatLogWriter(
+                LOGS_FOLDER/'chat.log', flush_interval=chat_log_config.get('flush_interval'),
+                rotate_bytes=int(rotate_mb * 1024 * 1024) if rotate_mb else None,
+                rotate_hourly=chat_log_config.get('rotate_hourly', True),
+            )
+            asyncio.ensure_future(self.chat_log.run())
+
+        self.archive = None
+        archive_config = config.get('archive', {})
+        if archive_config.get('enabled', False):
+            segment_mb = archive_config.get('segment_mb', 64)
+            self.archive = cmpc.ChatArchive(
+                LOGS_FOLDER/'archive', segment_bytes=int(segment_mb * 1024 * 1024),
+                flush_interval=archive_config.get('flush_interval'),
+            )
+            asyncio.ensure_future(self.archive.run())
 
+        cmpc.webhook_dispatcher().user_agent = config['api']['useragent']
         self.api_requests = cmpc.CmpcApi(config)
         self.user_permissions_handler = self.permissions_handler_from_api()
 
-        self.processor = cmpc.CommandProcessor(self, 'executing.txt')
+        metrics_config = config.get('metrics', {})
+        self.metrics = cmpc.PipelineMetrics(
+            enabled=metrics_config.get('enabled', False),
+            metrics_file=LOGS_FOLDER/metrics_config.get('file', 'metrics.prom'),
+            flush_interval=metrics_config.get('flush_interval'),
+        )
+
+        self.processor = cmpc.CommandProcessor(self, 'executing.txt', metrics=self.metrics)
+        self.metrics.add_gauges(self.processor.input_executor.stats, 'input_queue')
+        self.metrics.add_gauges(cmpc.webhook_dispatcher().stats, 'discord_webhooks')
+        self.metrics.add_gauges(cmpc.webhook_outbox().stats, 'webhook_outbox')
 
         if offline_mode:
+            # No connection to twitch means no twitch api for mod tools
+            self.modtools_on = False
             self.script_tester = cmpc.ScriptTester(TwitchPlays.event_message, self)
         else:
             super().__init__(
@@ -117,9 +148,14 @@ class TwitchPlays(twitchio.ext.commands.bot.Bot):
             )
             if modtools_on:
                 self.modtools = cmpc.ModTools(self)
+                self.metrics.add_gauges(self.modtools.user_cache.stats, 'user_cache')
+                self.metrics.add_gauges(self.modtools.user_lookup.stats, 'user_lookup')
+                self.metrics.add_gauges(self.modtools.twitch_api_breaker.stats, 'twitch_api')
+                self.metrics.add_gauges(self.modtools.ban_sync.stats, 'ban_sync')
             if self.mod_rota_on:
                 self.loop.create_task(self.mod_rota.run())
                 self.loop.create_task(self.mod_rota.run_mod_presence_checks())
+            self.loop.create_task(self.metrics.run_flush())
         log.debug('Finished intialising TwitchPlays object.')
 
     # TwitchPlays methods - TwitchConnection overrides below
@@ -184,9 +220,11 @@ class TwitchPlays(twitchio.ext.commands.bot.Bot):
                     log_message = '[Suspend script for 1 second]'
                 else:
                     log_message = f'[Suspend script for {int(duration)} seconds]'
-                self.processor.log_to_obs(None, none_log_msg=f'{log_message} ({twitch_message.username})')
+                await self.processor.log_to_obs(None, none_log_msg=f'{log_message} ({twitch_message.username})')
 
                 self.allow_commands_from_users = False
+                # Also cancels chat commands queued before the suspend, so they don't run during it
+                self.processor.release_holds()
                 await asyncio.sleep(duration)
                 # todo: handle a situation when the script is unsuspended and resuspended in this time
                 self.allow_commands_from_users = True
@@ -196,13 +234,57 @@ class TwitchPlays(twitchio.ext.commands.bot.Bot):
                 log.error(f'Could not suspend for duration: {twitch_message.content}, '
                           'due to too large arg')
 
+    def archive_message(
+            self, message: twitchio.Message, received_at: float, message_start: int,
+            outcome: str = 'chat', parsed_command: cmpc.ParsedCommand = None
+    ):
+        """Add a message to the chat archive if it's on, commands once they've been executed or dropped."""
+        if self.archive is None:
+            return
+        handle_seconds = (time.perf_counter_ns() - message_start) / 1e9
+        if parsed_command is not None:
+            self.archive.add_command(
+                received_at, message.author.id, message.author.name, message.content, parsed_command, handle_seconds
+            )
+        else:
+            self.archive.add(
+                received_at, message.author.id, message.author.name, message.content, outcome=outcome,
+                latency={'handle': round(handle_seconds * 1000, 3)},
+            )
+
+    def archive_vote_winner(self, parsed_command: cmpc.ParsedCommand):
+        """Add the winner of a democracy vote to the chat archive if it's on, once it's been executed or dropped."""
+        if self.archive is None:
+            return
+        message = parsed_command.message
+        self.archive.add_command(time.time(), 0, message.username, message.content, parsed_command, 0.0)
+
+    async def report_error(self, error: Exception, twitch_message: cmpc.TwitchMessage):
+        """Log an unexpected exception and send info about it to the systemlog webhook."""
+        log.error(f'{error}', exc_info=error)
+        await cmpc.send_error(
+            self.config['discord']['systemlog'], error,
+            twitch_message, self.config['twitch']['channel_to_join'],
+            self.config['options']['DEPLOY'], BRANCH_NAME, BRANCH_NAME_ASSUMED
+        )
+
     # TwitchConnection overrides
     async def event_ready(self):
         """Override TwitchConnection.event_ready - log and send discord webhook for startup message if applicable.
 
-        Also start the mod rota running on the bot's asyncio loop.
+        Also start the mod rota running on the bot's asyncio loop, warming the mod tools user cache, and syncing bans.
         """
         log.info("[TWITCH] Auth accepted and we are connected to twitch")
+        if self.modtools_on:
+            # Users cached before account creation times were stored
+            self.loop.create_task(self.modtools.backfill_account_created())
+            mod_tools_config = self.config.get('mod_tools', {})
+            if mod_tools_config.get('warm_up', True):
+                self.modtools.start_cache_warm_up(self.config['twitch']['channel_to_join'])
+            if mod_tools_config.get('ban_sync', False):
+                self.modtools.start_ban_sync(
+                    self.config['twitch']['channel_to_join'], interval=mod_tools_config.get('ban_sync_interval', 300)
+                )
         await self.processor.log_to_obs(None)
         # Send starting up message with webhook if in CONFIG.
         if self.config['options']['START_MSG']:
@@ -225,6 +307,8 @@ class TwitchPlays(twitchio.ext.commands.bot.Bot):
         Additionally looks for and executes some permission based commands, this might be refactored in the future.
         Also responsible for logging to obs, log files and discord webhooks if applicable.
         """
+        message_start = time.perf_counter_ns()
+        received_at = time.time()
         twitch_message = cmpc.TwitchMessage(message.content, message.author.name)
 
         # Command processing is very scary business - let's wrap the whole thing in a try/catch
@@ -233,9 +317,11 @@ class TwitchPlays(twitchio.ext.commands.bot.Bot):
             # Log the chat if that's something we want to do
             if self.config['options']['LOG_ALL']:
                 log.info(f'CHAT LOG: {twitch_message.get_log_string()}')
-            if self.config['options']['LOG_PPR']:
-                with open(LOGS_FOLDER/'chat.log', 'a', encoding='utf-8') as f:
-                    f.write(f'{twitch_message.get_log_string()}\n')
+            if self.chat_log is not None:
+                chat_log_start = time.perf_counter_ns()
+                # The timestamp lets --replay play the log back at its original timing
+                self.chat_log.write(f'{received_at:.3f}\t{twitch_message.get_log_string()}\n')
+                self.metrics.record('chat_log', chat_log_start)
 
             # Ignore bot messages
             if twitch_message.username in ['twitchcontrolsmypc', 'fucku', 'streamelements']:
@@ -245,26 +331,36 @@ class TwitchPlays(twitchio.ext.commands.bot.Bot):
             if not message.author.id:
                 return
 
+            permissions_start = time.perf_counter_ns()
             user_permissions = self.user_permissions_handler.get(twitch_message.username, cmpc.Permissions())
+            self.metrics.record('permissions', permissions_start)
 
             if not self.allow_commands_from_users and not (user_permissions.moderator or user_permissions.developer):
+                self.archive_message(message, received_at, message_start, outcome='ignored')
                 return
 
             if self.modtools_on:
                 # Check if the user is allowed to run commands
                 # Don't bother checking for moderators or developers
                 if not (user_permissions.moderator or user_permissions.developer):
-                    if not await self.modtools.check_user_allowed(message.author.id):
+                    check_start = time.perf_counter_ns()
+                    user_allowed = await self.modtools.check_user_allowed(message.author.id)
+                    self.metrics.record('check_user_allowed', check_start)
+                    if not user_allowed:
                         await self.modtools.notify_ignored_user(message)
                         log.info(f'Ignored message from {twitch_message.username} due to account age or deny list.')
+                        self.archive_message(message, received_at, message_start, outcome='ignored')
                         return
                     log.debug(f'User {message.author.name} {message.author.id} was allowed')
 
             # Process this beef
-            command_has_run = await self.processor.process_commands(twitch_message)
-            if command_has_run:
-                await self.processor.log_to_obs(None)
+            # The command is only queued here, the input executor resets obs once it's done executing
+            parsed_command = await self.processor.process_commands(twitch_message)
+            if parsed_command is not None:
+                self.metrics.record('event_message', message_start)
+                self.archive_message(message, received_at, message_start, parsed_command=parsed_command)
                 return
+            self.archive_message(message, received_at, message_start)
 
             # Commands for authorised developers in dev list only.
             if user_permissions.script or user_permissions.developer:
@@ -363,20 +459,14 @@ class TwitchPlays(twitchio.ext.commands.bot.Bot):
                                 twitch_message.original_content, command_invoc, case_sensitive=False
                             ).lstrip(),
                         }
-                        try:
-                            async with aiohttp.ClientSession() as session:
-                                await session.post(self.config['discord']['modtalk'],
-                                                   json=data, headers={'User-Agent': self.config['api']['useragent']})
-                        except aiohttp.ClientError:
-                            log.error(f"Could not modsay this moderator's message: {twitch_message.original_content}",
-                                      sys.exc_info())
+                        await cmpc.webhook_dispatcher().send(self.config['discord']['modtalk'], data)
 
                         break
 
                 if twitch_message.content in ['hideall']:
-                    pyautogui.hotkey('win', 'm')
+                    self.processor.priority_input('hotkey', 'win', 'm')
                 if twitch_message.content in ['mute']:
-                    pyautogui.press('volumemute')
+                    self.processor.priority_input('press', 'volumemute')
 
                 if twitch_message.content in ['shutdownabort']:
                     os.system('shutdown -a')
@@ -387,6 +477,7 @@ class TwitchPlays(twitchio.ext.commands.bot.Bot):
                         None, none_log_msg=f'Version {__version__} ({twitch_message.username})',
                         sleep_duration=3.0, none_sleep=True
                     )
+                    await self.processor.log_to_obs(None)
                     log.info(f'Version {__version__} ({twitch_message.username})')
 
                 command_invocs = ('script- suspend', '../script suspend')
@@ -401,15 +492,44 @@ class TwitchPlays(twitchio.ext.commands.bot.Bot):
                 if twitch_message.content in ['../script unsuspend']:
                     self.allow_commands_from_users = True
 
+                command_invocs = ('script- democracy', '../script democracy')
+                if twitch_message.content.startswith(command_invocs):
+                    for command_invoc in command_invocs:
+                        if twitch_message.content.startswith(command_invoc):
+                            window = cmpc.removeprefix(twitch_message.content, command_invoc).strip()
+                            break
+
+                    try:
+                        window_seconds = float(window) if window else None
+                    except ValueError:
+                        log.error(f'Could not start democracy mode: {twitch_message.content}, due to non-numeric arg')
+                    else:
+                        if window_seconds is not None and not 0.0 < window_seconds <= 60.0:
+                            log.error(f'Could not start democracy mode: {twitch_message.content}, '
+                                      'window must be between 0 and 60 seconds')
+                        else:
+                            self.processor.start_democracy(window_seconds, on_winner=self.archive_vote_winner)
+
+                if twitch_message.content in ['script- anarchy', '../script anarchy']:
+                    self.processor.stop_democracy()
+
+                if twitch_message.content in ['script- queue', '../script queue']:
+                    queue_stats = ', '.join(
+                        f'{key}: {value}' for key, value in self.processor.input_executor.stats().items()
+                    )
+                    log.info(f'[QUEUE] {queue_stats}')
+                    cmpc.send_webhook(self.config['discord']['systemlog'], f'Command queue - {queue_stats}')
+
                 # todo: divide these commands into blocks by how they start e.g. script- etc, also refactor I.E. #58
-                await self.modtools.process_commands(twitch_message)
+                if self.modtools_on:
+                    await self.modtools.process_commands(twitch_message)
 
                 if twitch_message.content.startswith('!defcon '):
                     severity = cmpc.removeprefix(twitch_message.content, '!defcon ')
 
                     if severity == '1':
-                        pyautogui.hotkey('win', 'm')
-                        pyautogui.press('volumemute')
+                        self.processor.priority_input('hotkey', 'win', 'm')
+                        self.processor.priority_input('press', 'volumemute')
                         os.system('shutdown -s -t 0 -c "!defcon 1 -- emergency shutdown" -f -d u:5:19')
 
                         await self.suspend(999999, twitch_message)
@@ -417,8 +537,8 @@ class TwitchPlays(twitchio.ext.commands.bot.Bot):
 
                     # todo: Add !defcon 2 -- close all running programs
                     elif severity == '3':
-                        pyautogui.hotkey('win', 'm')
-                        pyautogui.press('volumemute')
+                        self.processor.priority_input('hotkey', 'win', 'm')
+                        self.processor.priority_input('press', 'volumemute')
 
                         await self.suspend(600, twitch_message)
                         await self.processor.log_to_obs(
@@ -430,16 +550,9 @@ class TwitchPlays(twitchio.ext.commands.bot.Bot):
                 if hash(twitch_message.original_content) == -111040882105999023:
                     sys.exit(2)
 
-            await self.processor.log_to_obs(None)
-
         except Exception as error:
             # Send error data to systemlog.
-            log.error(f'{error}', sys.exc_info())
-            await cmpc.send_error(
-                self.config['discord']['systemlog'], error,
-                twitch_message, self.config['twitch']['channel_to_join'],
-                self.config['options']['DEPLOY'], BRANCH_NAME, BRANCH_NAME_ASSUMED
-            )
+            await self.report_error(error, twitch_message)
 
     # I don't know why this method is classed as necessary to implement but here it is.
     async def event_pubsub(self, data):
@@ -447,6 +560,37 @@ class TwitchPlays(twitchio.ext.commands.bot.Bot):
         pass
 
 
+def replay(
+        config: dict, chat_log_path: Path, speed: float, obs_hold: float, start: float = None, end: float = None
+):
+    """Replay a chat log through TwitchPlays.event_message offline, then log the throughput and latency report.
+
+    chat_log_path can also be a chat archive folder, e.g. logs/archive, to replay the messages from start to end.
+    Nothing is sent to discord, inputs go to a recording backend, obs text is only kept in memory, and the replayed
+    chat isn't logged again.
+    Pipeline stage metrics are always recorded, and written to the metrics file at the end.
+    """
+    if chat_log_path.is_dir():
+        messages = cmpc.ChatArchive(chat_log_path).replay_messages(start, end)
+    else:
+        messages = cmpc.read_chat_log(chat_log_path)
+    log.info(f'[Replay] Read {len(messages)} messages from {chat_log_path}')
+
+    config['options'].update(LOG_ALL=False, LOG_PPR=False, START_MSG=False, INPUT_BACKEND='recording')
+    config.setdefault('archive', {})['enabled'] = False
+    # No obs websocket connecting in the background, and executing.txt isn't written, so neither skews the latencies
+    config.setdefault('obs', {})['output'] = 'memory'
+    config['discord'] = {key: '' for key in config['discord']}
+    config.setdefault('metrics', {})['enabled'] = True
+    twitch_client = TwitchPlays(config=config, offline_mode=True, modtools_on=False, mod_rota_on=False)
+    twitch_client.processor.command_logging.obs_log_sleep_duration = obs_hold
+
+    chat_replay = cmpc.ChatReplay(TwitchPlays.event_message, twitch_client, messages, speed=speed)
+    report = asyncio.get_event_loop().run_until_complete(chat_replay.run())
+    log.info(chat_replay.format_report(report))
+    twitch_client.metrics.write()
+
+
 def main():
     """Run the program.
 
@@ -479,8 +623,26 @@ def main():
     parser.add_argument('--version', action='version', version=__version__)
     parser.add_argument('--offline-mode', action='store_true')
     parser.add_argument('--gen-key', action='store_true')
+    parser.add_argument('--replay', type=Path, metavar='CHAT_LOG',
+                        help='replay a chat log, or the chat archive folder, through the script with a recording '
+                             'input backend, then report throughput and latency')
+    parser.add_argument('--replay-start', type=float, default=None, metavar='UNIX_TIME',
+                        help='when replaying the chat archive, only replay messages from this time')
+    parser.add_argument('--replay-end', type=float, default=None, metavar='UNIX_TIME',
+                        help='when replaying the chat archive, only replay messages up to this time')
+    parser.add_argument('--replay-speed', type=float, default=0.0, metavar='SPEED',
+                        help='1 replays at the original timing, 10 ten times faster, 0 (default) as fast as possible')
+    parser.add_argument('--replay-obs-hold', type=float, default=0.5, metavar='SECONDS',
+                        help='how long each command is held on obs during a replay, default 0.5')
     cliargs = parser.parse_args()
 
+    if cliargs.replay:
+        replay(
+            config, cliargs.replay, cliargs.replay_speed, cliargs.replay_obs_hold,
+            start=cliargs.replay_start, end=cliargs.replay_end,
+        )
+        return
+
     if cliargs.gen_key:
         new_oauth_key = keygen.get_oauth_key()
         print(f'[Keygen] Your new oauth key is {new_oauth_key}')
@@ -497,16 +659,28 @@ def main():
     if not cmpc.running_as_admin():
         log.warning('Script is not running as admin.')
 
+    # Webhook messages that couldn't be sent before the last exit
+    cmpc.webhook_outbox().replay_spool()
     twitch_client = TwitchPlays(config=config, offline_mode=cliargs.offline_mode)
 
-    if cliargs.offline_mode:
-        log.info("[Script] Starting script in offline only mode. Cya later internet.")
-        twitch_client.script_tester.run()
-    else:
-        try:
-            twitch_client.run()
-        except KeyError:
-            log.error('Error connecting, please retry.')
+    try:
+        if cliargs.offline_mode:
+            log.info("[Script] Starting script in offline only mode. Cya later internet.")
+            twitch_client.script_tester.run()
+        else:
+            try:
+                twitch_client.run()
+            except KeyError:
+                log.error('Error connecting, please retry.')
+    finally:
+        # Don't leave keys held down, or chat unlogged or unarchived, when the script exits, however it exits
+        twitch_client.processor.input_executor.stop(timeout=5.0)
+        if twitch_client.chat_log is not None:
+            twitch_client.chat_log.close()
+        if twitch_client.archive is not None:
+            twitch_client.archive.close()
+        if twitch_client.modtools_on:
+            twitch_client.modtools.close()
 
 
 if __name__ == '__main__':
@@ -12,11 +12,31 @@ Modules:
     api_requests -- handles requests and caching for the cmpc api
     command_logging -- handles logging commands to obs, discord, and the local log
     mod_tools - module for checking user account age, and blocking users
+    input_executor -- runs input commands in order on a dedicated thread
+    democracy -- counts votes for commands in democracy mode
+    command_coalescing -- merges adjacent queued commands into one action
+    load_shedding -- bounds the command queue, adapting to measured latency
+    input_backends -- pyautogui, pydirectinput and recording backends for sending input
+    replay -- replays a chat log through the script for benchmarking
+    hold_scheduler -- holds keys and mouse buttons without blocking, so holds overlap into chords
+    typing_engine -- types text for type, gtype and ptype by batching key events, game input, or pasting in chunks
+    obs_display -- shows the latest text on obs at a capped rate, without blocking
+    obs_client -- asyncio obs websocket client which reconnects on its own
+    webhook_dispatcher -- sends discord webhooks from one session, batching embeds within rate limits
+    outbox -- spools webhook messages to disk and delivers them with retries, even after a restart
+    chat_log -- buffered chat log writer which rotates and compresses the log
+    chat_archive -- indexed archive of every chat message, the command it was parsed as and what became of it
+    user_cache -- least recently used cache of the user records mod tools checks for every message
+    user_db -- runs sqlite on its own thread, committing writes in batches
+    user_lookup -- batches twitch user lookups, looking up each user only once at a time
+    circuit_breaker -- stops calling an api that keeps failing, and tries it again every so often
+    ban_sync -- copies the channel's bans and timeouts from the twitch api into the user info cache
+    metrics -- latency histograms for each stage of the message pipeline, exported for prometheus
 """
 
 from .utils import *
 from .keyboard_keycodes import KeyboardKeycodes
-from .command_processor import CommandProcessor
+from .command_processor import CommandProcessor, ParsedCommand
 from .twitch_message import TwitchMessage
 from .permission_handler import Permissions
 from .script_tester import ScriptTester
@@ -24,3 +44,24 @@ from .mod_rota import ModRota
 from .api_requests import CmpcApi
 from .command_logging import CommandLogging
 from .mod_tools import ModTools
+from .user_cache import UserCache, UserRecord
+from .user_db import UserDatabase
+from .user_lookup import UserLookup
+from .circuit_breaker import CircuitBreaker, CircuitOpenError
+from .ban_sync import BanListSync, BanSyncError
+from .input_executor import InputExecutor
+from .democracy import VoteCollector
+from .load_shedding import AdmissionController, CommandDroppedError
+from .replay import ChatReplay, read_chat_log
+from .hold_scheduler import HoldScheduler
+from .typing_engine import TypingEngine
+from .obs_display import ObsDisplay
+from .obs_client import ObsWebsocketClient, ObsWebsocketError
+from .webhook_dispatcher import WebhookDispatcher
+from .outbox import WebhookOutbox
+from .chat_log import ChatLogWriter
+from .chat_archive import ChatArchive
+from .metrics import LatencyHistogram, PipelineMetrics
+from .input_backends import (
+    InputBackend, InputBackendError, PyAutoGUIBackend, PyDirectInputBackend, RecordingBackend, get_input_backend
+)
@@ -40,6 +40,7 @@ class CmpcApi:
         """
         # Attempt get dev and mod lists from API.
         log.info(f'[API] Requesting data! ({url})')
+        api_response = None
         try:
             if force_static:
                 log.warning('Forcing getting from static backup instead of api.')
@@ -82,7 +83,8 @@ class CmpcApi:
                              f"Retrieved: {retrieved_time}\n\n"
                              f"[***Stream Link***](<https://twitch.tv/{self.config['twitch']['username']}>)\n"
                              "**Environment -** {config['options']['DEPLOY']}\n"
-                             f"**Response Status Code- ** {api_response.status_code}"
+                             f"**Response Status Code- ** "
+                             f"{'no response' if api_response is None else api_response.status_code}"
                              )
             except TypeError:
                 log.warning('Your apiconfig backup is out of date and missing some fields. Trying to run anyway.')
@@ -0,0 +1,234 @@
+"""Copies the channel's bans and timeouts from the twitch api into the user info cache.
+
+Classes:
+    BanSyncError -- the banned users endpoint couldn't be read
+    BanListSync -- pages through the banned users endpoint, picking up where the last sync stopped
+"""
+
+import time
+import asyncio
+import collections
+import typing
+import logging as log
+
+import aiohttp
+
+from cmpc.utils import parse_twitch_time
+from cmpc.user_db import UserDatabase
+
+
+class BanSyncError(Exception):
+    """The banned users endpoint returned an error, or couldn't be reached."""
+
+    def __init__(self, message: str, status: int = None):
+        super().__init__(message)
+        # The http status twitch returned, if it returned one
+        self.status = status
+
+
+class BanListSync:
+    """Sync the channel's banned and timed out users into the users table, so they're ignored like script bans.
+
+    Bans are read 100 at a time from helix moderation/banned, following its pagination cursor. Each page is written
+    with one statement per kind of ban, which the database commits together: bans set allow to False, timeouts set
+    allow_after to when they end (and clear allow, as the timeout command does). Whether users have been told
+    they're ignored is left alone, so they aren't told again.
+    Syncs are incremental. Twitch lists the newest bans first, so a sync stops at the first ban no newer than the
+    newest one the last sync saw. The cursor is saved after every page, so a sync that's stopped part way through
+    (twitch failing, or the script exiting) carries on from there. Both are kept in the sync_state table.
+    Unbans aren't synced, since they'd undo bans made with the script.
+    Needs a token with the moderation:read scope, from the broadcaster or a moderator of the channel.
+    Public methods:
+        sync
+        run
+        stats
+    Instance variables:
+        user_db -- cmpc.UserDatabase with the users and sync_state tables
+        client_id -- twitch api client id
+        token -- twitch api token, without the oauth: prefix
+        base_url -- helix url, e.g. to use a local stand-in while testing
+        on_users_changed -- called with the ids of users whose rows were changed, so they can be uncached
+        max_retries -- times a page is retried after a server or connection error
+    """
+
+    STATE_CURSOR = 'banned_cursor'
+    STATE_NEWEST = 'banned_newest'
+    STATE_PENDING_NEWEST = 'banned_pending_newest'
+
+    def __init__(
+            self, user_db: UserDatabase, client_id: str, token: str, base_url: str = None,
+            on_users_changed: typing.Callable[[typing.List[int]], None] = None, max_retries: int = None
+    ):
+        """Initialise the class attributes."""
+        self.user_db = user_db
+        self.client_id = client_id
+        self.token = token
+        if base_url is None:
+            base_url = 'https://api.twitch.tv/helix'
+        self.base_url = base_url.rstrip('/')
+        self.on_users_changed = on_users_changed
+        if max_retries is None:
+            max_retries = 3
+        self.max_retries = max_retries
+
+        self.keep_running = False
+        # Monotonic time the rate limit resets, if it's been used up
+        self._rate_limit_reset_at = 0.0
+        self._counts = collections.Counter()
+
+    async def sync(self, broadcaster_id: str) -> int:
+        """Sync bans newer than the last sync saw, returning how many users were updated.
+
+        Raises BanSyncError if twitch can't be read, the next sync carries on from the last page written.
+        """
+        cursor = await self._get_state(self.STATE_CURSOR)
+        newest = float(await self._get_state(self.STATE_NEWEST) or 0.0)
+        # Bans newer than newest that were seen by a sync which didn't finish
+        pending_newest = max(newest, float(await self._get_state(self.STATE_PENDING_NEWEST) or 0.0))
+        if cursor:
+            log.info('[BAN SYNC] Carrying on from where the last ban sync stopped.')
+
+        synced = 0
+        headers = {'Client-Id': self.client_id, 'Authorization': f'Bearer {self.token}'}
+        async with aiohttp.ClientSession(headers=headers) as session:
+            while True:
+                params = {'broadcaster_id': broadcaster_id, 'first': '100'}
+                if cursor:
+                    params['after'] = cursor
+                try:
+                    page = await self._get_page(session, params)
+                except BanSyncError as error:
+                    if not cursor or error.status != 400:
+                        raise
+                    # Cursors don't last forever, so start again from the newest bans
+                    log.warning('[BAN SYNC] Saved cursor was refused, syncing from the newest ban.')
+                    cursor = None
+                    continue
+
+                bans = page.get('data') or []
+                reached_last_sync = False
+                ban_rows = []
+                timeout_rows = []
+                for ban in bans:
+                    banned_at = parse_twitch_time(ban['created_at']) if ban.get('created_at') else None
+                    if banned_at is not None and newest and banned_at <= newest:
+                        reached_last_sync = True
+                        continue
+                    if banned_at is not None:
+                        pending_newest = max(pending_newest, banned_at)
+                    if ban.get('expires_at'):
+                        timeout_rows.append((int(ban['user_id']), parse_twitch_time(ban['expires_at'])))
+                    else:
+                        ban_rows.append((int(ban['user_id']),))
+
+                self._write_page(ban_rows, timeout_rows)
+                synced += len(ban_rows) + len(timeout_rows)
+
+                cursor = (page.get('pagination') or {}).get('cursor')
+                if reached_last_sync or not cursor or not bans:
+                    break
+                # Queued after the page's rows, so it's only committed with them
+                self._set_state(self.STATE_CURSOR, cursor)
+                self._set_state(self.STATE_PENDING_NEWEST, pending_newest)
+
+        self._set_state(self.STATE_CURSOR, None)
+        self._set_state(self.STATE_PENDING_NEWEST, None)
+        # Committed after everything queued before it
+        await self._set_state(self.STATE_NEWEST, pending_newest)
+        self._counts['syncs'] += 1
+        self._counts['users'] += synced
+        log.info(f'[BAN SYNC] Synced {synced} banned or timed out users.')
+        return synced
+
+    async def run(self, broadcaster_id: str, interval: float):
+        """Sync every interval seconds until keep_running is set to False."""
+        self.keep_running = True
+        while self.keep_running:
+            try:
+                await self.sync(broadcaster_id)
+            except BanSyncError as error:
+                self._counts['errors'] += 1
+                log.error(f'[BAN SYNC] {error}')
+            await asyncio.sleep(interval)
+
+    def stats(self) -> typing.Dict[str, int]:
+        """Return how many syncs have been done, users synced, and syncs that failed."""
+        return {key: self._counts[key] for key in ('syncs', 'users', 'errors', 'pages')}
+
+    def _write_page(self, ban_rows: typing.List[tuple], timeout_rows: typing.List[tuple]):
+        writes = []
+        if ban_rows:
+            writes.append(self.user_db.executemany(
+                'INSERT INTO users (id, allow, allow_after, notified_ignored) VALUES (?, 0, NULL, 0) '
+                'ON CONFLICT(id) DO UPDATE SET allow=0',
+                ban_rows
+            ))
+        if timeout_rows:
+            writes.append(self.user_db.executemany(
+                'INSERT INTO users (id, allow, allow_after, notified_ignored) VALUES (?, NULL, ?, 0) '
+                'ON CONFLICT(id) DO UPDATE SET allow=NULL, allow_after=excluded.allow_after',
+                timeout_rows
+            ))
+        for write in writes:
+            # Errors are logged by the database thread
+            write.add_done_callback(lambda done: done.cancelled() or done.exception())
+        changed_user_ids = [row[0] for row in ban_rows + timeout_rows]
+        if changed_user_ids and self.on_users_changed is not None:
+            self.on_users_changed(changed_user_ids)
+
+    async def _get_state(self, name: str) -> typing.Optional[str]:
+        row = await self.user_db.fetchone('SELECT value FROM sync_state WHERE name=?', (name,))
+        return None if row is None else row[0]
+
+    def _set_state(self, name: str, value) -> asyncio.Future:
+        if value is None:
+            future = self.user_db.execute('DELETE FROM sync_state WHERE name=?', (name,))
+        else:
+            future = self.user_db.execute('INSERT OR REPLACE INTO sync_state VALUES (?, ?)', (name, str(value)))
+        # Errors are logged by the database thread
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        return future
+
+    async def _get_page(self, session: aiohttp.ClientSession, params: typing.Dict[str, str]) -> dict:
+        failures = 0
+        while True:
+            wait = self._rate_limit_reset_at - time.monotonic()
+            if wait > 0:
+                log.info(f'[BAN SYNC] Waiting {wait:.1f}s for the twitch api rate limit.')
+                await asyncio.sleep(wait)
+
+            try:
+                async with session.get(f'{self.base_url}/moderation/banned', params=params) as response:
+                    self._update_rate_limit(response.headers)
+                    if response.status == 429:
+                        # _update_rate_limit has set when to try again
+                        if self._rate_limit_reset_at <= time.monotonic():
+                            self._rate_limit_reset_at = time.monotonic() + 1.0
+                        continue
+                    if response.status < 400:
+                        self._counts['pages'] += 1
+                        return await response.json()
+                    if response.status < 500:
+                        raise BanSyncError(
+                            f'Could not get banned users, {response.status}: {await response.text()}',
+                            status=response.status
+                        )
+                    error = f'status {response.status}'
+            except (aiohttp.ClientError, asyncio.TimeoutError) as client_error:
+                error = repr(client_error)
+
+            failures += 1
+            if failures > self.max_retries:
+                raise BanSyncError(f'Could not get banned users after {failures} tries: {error}')
+            await asyncio.sleep(2 ** failures)
+
+    def _update_rate_limit(self, headers: typing.Mapping[str, str]):
+        """Wait for the rate limit to reset before the next request, if it's been used up."""
+        try:
+            remaining = int(headers.get('Ratelimit-Remaining', 1))
+            reset_at = float(headers.get('Ratelimit-Reset', 0))
+        except ValueError:
+            return
+        if remaining <= 0:
+            # Ratelimit-Reset is a unix time
+            self._rate_limit_reset_at = time.monotonic() + max(0.0, reset_at - time.time())
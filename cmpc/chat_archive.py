@@ -0,0 +1,329 @@
+"""Append only archive of every chat message and what became of it, indexed by time and by user.
+
+Classes:
+    ChatArchive -- writes records to segment files with a sidecar index, and looks them up with mmap
+"""
+
+import json
+import mmap
+import time
+import struct
+import asyncio
+import typing
+import logging as log
+from pathlib import Path
+
+from cmpc.load_shedding import CommandDroppedError
+
+
+# key, timestamp, user id, offset of the record in the segment, length of the record
+INDEX_ENTRY = struct.Struct('<ddqQI')
+KEY = struct.Struct('<d')
+
+
+class _ArchiveSegment:
+    """One segment of the archive: a file of json records, one per line, and its index file.
+
+    Index entries are fixed size and appended in key order, so they can be binary searched by key. Keys are the
+    time each record was written, never going backwards, and never earlier than the record's own timestamp.
+    """
+
+    def __init__(self, data_path: Path):
+        self.data_path = data_path
+        self.index_path = data_path.with_suffix('.idx')
+        self.first_key = int(data_path.stem.split('-', 1)[1]) / 1000
+        # The most a record's key is after its timestamp, so time ranges know how far past their end to look
+        self.max_delay = 0.0
+        self.last_key = self.first_key
+        self._data_file = None
+        self._index_file = None
+        self._data_size = 0
+        self._entry_count = 0
+        # user id -> list of index entry numbers, built the first time a user is looked up
+        self._user_entries = None
+
+        if self.index_path.exists():
+            for key, timestamp, user_id, offset, length in self._iter_index():
+                self.max_delay = max(self.max_delay, key - timestamp)
+                self.last_key = key
+                self._entry_count += 1
+
+    def open_for_append(self):
+        self._data_file = open(self.data_path, 'ab')
+        self._index_file = open(self.index_path, 'ab')
+        self._data_size = self._data_file.tell()
+
+    def append(self, key: float, timestamp: float, user_id: int, data: bytes) -> int:
+        """Append an encoded record, returning the size of the segment after it."""
+        self._data_file.write(data)
+        self._index_file.write(INDEX_ENTRY.pack(key, timestamp, user_id, self._data_size, len(data)))
+        if self._user_entries is not None:
+            self._user_entries.setdefault(user_id, []).append(self._entry_count)
+        self._entry_count += 1
+        self._data_size += len(data)
+        self.max_delay = max(self.max_delay, key - timestamp)
+        self.last_key = key
+        return self._data_size
+
+    def flush(self):
+        if self._data_file is not None:
+            self._data_file.flush()
+            self._index_file.flush()
+
+    def close(self):
+        if self._data_file is not None:
+            self._data_file.close()
+            self._index_file.close()
+            self._data_file = None
+            self._index_file = None
+
+    def find(self, start: float, end: float, user_id: int = None) -> typing.Iterator[dict]:
+        """Yield the records with a timestamp from start to end, in the order they were written."""
+        self.flush()
+        try:
+            index_map = self._map(self.index_path)
+        except ValueError:
+            # Nothing's been written to it yet
+            return
+        with index_map, self._map(self.data_path) as data_map:
+            entry_count = len(index_map) // INDEX_ENTRY.size
+            end_key = end + self.max_delay
+
+            if user_id is None:
+                entry_numbers = range(self._first_entry_from(index_map, 0, entry_count, start), entry_count)
+            else:
+                user_entries = self._get_user_entries(index_map, entry_count).get(user_id, [])
+                entry_numbers = user_entries[self._first_user_entry_from(index_map, user_entries, start):]
+
+            for entry_number in entry_numbers:
+                key, timestamp, entry_user_id, offset, length = INDEX_ENTRY.unpack_from(
+                    index_map, entry_number * INDEX_ENTRY.size
+                )
+                if key > end_key:
+                    break
+                if start <= timestamp <= end:
+                    yield json.loads(data_map[offset:offset + length])
+
+    @staticmethod
+    def _map(path: Path) -> mmap.mmap:
+        with open(path, 'rb') as file:
+            return mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def _iter_index(self) -> typing.Iterator[tuple]:
+        try:
+            index_map = self._map(self.index_path)
+        except ValueError:
+            return
+        with index_map:
+            yield from INDEX_ENTRY.iter_unpack(index_map[:len(index_map) - len(index_map) % INDEX_ENTRY.size])
+
+    @staticmethod
+    def _first_entry_from(index_map: mmap.mmap, low: int, high: int, key: float) -> int:
+        """Binary search for the first entry with a key of at least key."""
+        while low < high:
+            middle = (low + high) // 2
+            if KEY.unpack_from(index_map, middle * INDEX_ENTRY.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    @staticmethod
+    def _first_user_entry_from(index_map: mmap.mmap, user_entries: typing.List[int], key: float) -> int:
+        """Binary search a user's entry numbers for the first one with a key of at least key."""
+        low, high = 0, len(user_entries)
+        while low < high:
+            middle = (low + high) // 2
+            if KEY.unpack_from(index_map, user_entries[middle] * INDEX_ENTRY.size)[0] < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def _get_user_entries(self, index_map: mmap.mmap, entry_count: int) -> typing.Dict[int, typing.List[int]]:
+        if self._user_entries is None:
+            user_entries = {}
+            for entry_number in range(entry_count):
+                user_id = INDEX_ENTRY.unpack_from(index_map, entry_number * INDEX_ENTRY.size)[2]
+                user_entries.setdefault(user_id, []).append(entry_number)
+            self._user_entries = user_entries
+        return self._user_entries
+
+
+class ChatArchive:
+    """Archive every chat message with its user, the command it was parsed as, what happened to it and how long it took.
+
+    Records are json, one per line, in segment files named after the time they were started. Each segment has an
+    index file of fixed size entries (key, timestamp, user id, offset, length), so a time range is found with a
+    binary search, and a user's records with a user -> entries map built from the index, then read straight from
+    the segment, both with mmap. Records are written once their outcome is known, which can be after later
+    messages, so the index is keyed by write time and each segment remembers how far that can lag behind.
+    Writes are buffered, and flushed every flush_interval seconds by run, and before every lookup.
+    Public methods:
+        add
+        add_command
+        run
+        flush
+        close
+        find
+        replay_messages
+    Instance variables:
+        directory -- folder the segment files are kept in
+        segment_bytes -- size a segment grows to before a new one is started
+        flush_interval -- the most seconds a record is buffered for
+    """
+
+    def __init__(self, directory: typing.Union[str, Path], segment_bytes: int = None, flush_interval: float = None):
+        """Initialise the class attributes, loading the indexes of the existing segments."""
+        self.directory = Path(directory)
+        if segment_bytes is None:
+            segment_bytes = 64 * 1024 * 1024
+        self.segment_bytes = segment_bytes
+        if flush_interval is None:
+            flush_interval = 1.0
+        self.flush_interval = flush_interval
+
+        self.keep_running = False
+        self._last_key = 0.0
+        self._segments = []
+        if self.directory.exists():
+            self._segments = [
+                _ArchiveSegment(data_path)
+                for data_path in sorted(self.directory.glob('segment-*.jsonl'), key=lambda path: int(path.stem[8:]))
+            ]
+        if self._segments:
+            self._last_key = self._segments[-1].last_key
+        # A new segment is started for every run, the first time something is added
+        self._active_segment = None
+
+    def add(
+            self, timestamp: float, user_id: typing.Union[int, str], username: str, text: str,
+            command: dict = None, outcome: str = 'chat', latency: typing.Dict[str, float] = None
+    ):
+        """Append a record to the archive.
+
+        Args:
+            timestamp -- unix time the message was received
+            user_id -- the twitch user id, or 0 if it isn't known
+            command -- {'name': ..., 'args': [...]} if the message was parsed as a command
+            outcome -- e.g. 'chat', 'ignored', 'executed', 'dropped', 'error', 'voted'
+            latency -- milliseconds spent in each stage, e.g. {'handle': 0.02, 'execute': 30.5}
+        """
+        try:
+            user_id = int(user_id or 0)
+        except ValueError:
+            user_id = 0
+        record = {
+            'timestamp': timestamp, 'user_id': user_id, 'username': username, 'text': text,
+            'command': command, 'outcome': outcome, 'latency': latency or {},
+        }
+        data = (json.dumps(record, separators=(',', ':'), default=str) + '\n').encode('utf-8')
+
+        key = max(time.time(), timestamp, self._last_key)
+        self._last_key = key
+        if self._active_segment is None:
+            self._start_segment(key)
+        try:
+            segment_size = self._active_segment.append(key, timestamp, user_id, data)
+        except OSError:
+            log.exception('[ARCHIVE] Could not write to the chat archive')
+            return
+        if segment_size >= self.segment_bytes:
+            self._active_segment.close()
+            self._active_segment = None
+
+    def add_command(
+            self, timestamp: float, user_id: typing.Union[int, str], username: str, text: str,
+            parsed_command, handle_seconds: float
+    ):
+        """Archive a message that was parsed as a command, once its future says what became of it.
+
+        parsed_command is the cmpc.ParsedCommand returned by CommandProcessor.process_commands.
+        """
+        command = {'name': parsed_command.name, 'args': list(parsed_command.args)}
+        latency = {'handle': round(handle_seconds * 1000, 3)}
+        future = parsed_command.future
+        if future is None:
+            self.add(timestamp, user_id, username, text, command=command, outcome='voted', latency=latency)
+            return
+
+        queued_at = time.monotonic()
+
+        def command_done(done: asyncio.Future):
+            if done.cancelled():
+                outcome = 'cancelled'
+            elif isinstance(done.exception(), CommandDroppedError):
+                outcome = 'dropped'
+            elif done.exception() is not None:
+                outcome = 'error'
+            else:
+                outcome = 'executed'
+            latency['execute'] = round((time.monotonic() - queued_at) * 1000, 3)
+            self.add(timestamp, user_id, username, text, command=command, outcome=outcome, latency=latency)
+
+        future.add_done_callback(command_done)
+
+    async def run(self):
+        """Flush buffered records every flush_interval seconds until close is called."""
+        self.keep_running = True
+        while self.keep_running:
+            await asyncio.sleep(self.flush_interval)
+            self.flush()
+
+    def flush(self):
+        """Write buffered records to disk."""
+        if self._active_segment is not None:
+            try:
+                self._active_segment.flush()
+            except OSError:
+                log.exception('[ARCHIVE] Could not flush the chat archive')
+
+    def close(self):
+        """Flush and close the current segment."""
+        self.keep_running = False
+        if self._active_segment is not None:
+            self._active_segment.close()
+            self._active_segment = None
+
+    def find(self, start: float = None, end: float = None, user_id: typing.Union[int, str] = None
+             ) -> typing.Iterator[dict]:
+        """Yield every record with a timestamp from start to end (unix times), optionally only from one user.
+
+        e.g. everything a user sent in the last hour: archive.find(start=time.time() - 3600, user_id=user_id)
+        """
+        if start is None:
+            start = 0.0
+        if end is None:
+            end = float('inf')
+        if user_id is not None:
+            user_id = int(user_id)
+
+        for segment_number, segment in enumerate(self._segments):
+            # Skip segments that are over before the range starts, or that start after it's over
+            next_first_key = None
+            if segment_number + 1 < len(self._segments):
+                next_first_key = self._segments[segment_number + 1].first_key
+            if next_first_key is not None and next_first_key < start:
+                continue
+            if segment.first_key > end + segment.max_delay:
+                break
+            yield from segment.find(start, end, user_id)
+
+    def replay_messages(self, start: float = None, end: float = None
+                        ) -> typing.List[typing.Tuple[typing.Optional[float], str, str]]:
+        """Return the messages from start to end as (timestamp, content, username), sorted, for cmpc.ChatReplay."""
+        return sorted(
+            (record['timestamp'], record['text'], record['username']) for record in self.find(start, end)
+        )
+
+    def _start_segment(self, key: float):
+        self.directory.mkdir(parents=True, exist_ok=True)
+        data_path = self.directory / f'segment-{int(key * 1000)}.jsonl'
+        while data_path.exists():
+            # Started in the same millisecond as the last one
+            key += 0.001
+            data_path = self.directory / f'segment-{int(key * 1000)}.jsonl'
+        self._active_segment = _ArchiveSegment(data_path)
+        self._active_segment.open_for_append()
+        self._segments.append(self._active_segment)
+        log.debug(f'[ARCHIVE] Started archive segment {data_path}')
@@ -0,0 +1,163 @@
+"""Buffered chat log writer, which rotates the log by size and hour and compresses old segments.
+
+Classes:
+    ChatLogWriter -- buffers chat log lines in memory and writes them from a task on the asyncio loop
+"""
+
+import os
+import time
+import gzip
+import shutil
+import asyncio
+import concurrent.futures
+import typing
+import logging as log
+from pathlib import Path
+
+
+class ChatLogWriter:
+    """Buffer chat log lines and write them in batches to a file that's kept open.
+
+    Lines are written every flush_interval seconds, or as soon as max_buffer_bytes are waiting. Before a write, the
+    log is rotated if it would go over rotate_bytes, or if rotate_hourly and the hour has changed since it was
+    started. Rotated segments are renamed with the time they were started, e.g. chat.20201225-130000.log, then
+    gzipped on a background thread. A log left over from the last run is appended to, or rotated if it's old.
+    Public methods:
+        write
+        run
+        flush
+        close
+    Instance variables:
+        path -- the current segment of the chat log
+        flush_interval -- the most seconds a line waits in memory
+        max_buffer_bytes -- lines are written as soon as this many are waiting
+        rotate_bytes -- the largest a segment gets before it's rotated, or None to not rotate by size
+        rotate_hourly -- if True a new segment is started every hour
+    """
+
+    def __init__(
+            self, path: typing.Union[str, Path], flush_interval: float = None, max_buffer_bytes: int = None,
+            rotate_bytes: typing.Optional[int] = 10 * 1024 * 1024, rotate_hourly: bool = True
+    ):
+        """Initialise the class attributes. The file isn't opened until the first write."""
+        self.path = Path(path)
+        if flush_interval is None:
+            flush_interval = 1.0
+        self.flush_interval = flush_interval
+        if max_buffer_bytes is None:
+            max_buffer_bytes = 64 * 1024
+        self.max_buffer_bytes = max_buffer_bytes
+        self.rotate_bytes = rotate_bytes
+        self.rotate_hourly = rotate_hourly
+
+        self.keep_running = False
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._file = None
+        self._file_bytes = 0
+        self._segment_hour = None
+        self._flush_now = asyncio.Event()
+        self._compressor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='ChatLogCompress')
+
+    def write(self, line: str):
+        """Add a line to the buffer, it's written within flush_interval seconds. Include the newline."""
+        self._buffer.append(line)
+        self._buffer_bytes += len(line)
+        if self._buffer_bytes >= self.max_buffer_bytes:
+            self._flush_now.set()
+
+    async def run(self):
+        """Write the buffer every flush_interval seconds, or once it's full, until close is called."""
+        self.keep_running = True
+        while self.keep_running:
+            try:
+                await asyncio.wait_for(self._flush_now.wait(), self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._flush_now.clear()
+            self.flush()
+
+    def flush(self):
+        """Write every buffered line to the log now, rotating it first if it's due."""
+        if not self._buffer:
+            return
+        data = ''.join(self._buffer).encode('utf-8')
+        self._buffer.clear()
+        self._buffer_bytes = 0
+
+        try:
+            self._rotate_if_due(len(data))
+            if self._file is None:
+                self._open()
+            self._file.write(data)
+            self._file.flush()
+            self._file_bytes += len(data)
+        except OSError:
+            log.exception(f'[CHAT LOG] Could not write {len(data)} bytes to {self.path}')
+
+    def close(self):
+        """Write the buffer and close the log, then wait for any segments still being compressed."""
+        self.keep_running = False
+        self._flush_now.set()
+        self.flush()
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        self._compressor.shutdown(wait=True)
+
+    def _open(self):
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        if self.path.exists():
+            # Left over from the last run, only carry on with it if it's still the same hour
+            if self.rotate_hourly and self._hour_of(self.path.stat().st_mtime) != self._hour_of(time.time()):
+                self._rotate()
+        self._file = open(self.path, 'ab')
+        self._file_bytes = self._file.tell()
+        self._segment_hour = self._hour_of(time.time())
+
+    def _rotate_if_due(self, incoming_bytes: int):
+        if self._file is None:
+            return
+        if self.rotate_bytes is not None and self._file_bytes and \
+                self._file_bytes + incoming_bytes > self.rotate_bytes:
+            self._rotate()
+        elif self.rotate_hourly and self._hour_of(time.time()) != self._segment_hour:
+            self._rotate()
+
+    def _rotate(self):
+        """Rename the current segment after the time it was started, and queue it to be compressed."""
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+        started = time.strftime('%Y%m%d-%H%M%S', time.localtime(self._segment_start_time()))
+        segment_path = self.path.with_name(f'{self.path.stem}.{started}{self.path.suffix}')
+        count = 1
+        while segment_path.exists() or segment_path.with_name(segment_path.name + '.gz').exists():
+            segment_path = self.path.with_name(f'{self.path.stem}.{started}-{count}{self.path.suffix}')
+            count += 1
+        os.replace(self.path, segment_path)
+        log.info(f'[CHAT LOG] Rotated chat log to {segment_path}')
+        self._compressor.submit(self._compress, segment_path)
+
+    def _segment_start_time(self) -> float:
+        """Guess when the current segment was started from its first line's timestamp, or its creation time."""
+        try:
+            with open(self.path, encoding='utf-8') as log_file:
+                return float(log_file.readline().split('\t', 1)[0])
+        except (OSError, ValueError):
+            return os.path.getctime(self.path)
+
+    @staticmethod
+    def _compress(segment_path: Path):
+        try:
+            with open(segment_path, 'rb') as segment_file, \
+                    gzip.open(segment_path.with_name(segment_path.name + '.gz'), 'wb') as compressed_file:
+                shutil.copyfileobj(segment_file, compressed_file)
+            os.remove(segment_path)
+        except OSError:
+            log.exception(f'[CHAT LOG] Could not compress {segment_path}')
+
+    @staticmethod
+    def _hour_of(timestamp: float) -> str:
+        return time.strftime('%Y%m%d%H', time.localtime(timestamp))
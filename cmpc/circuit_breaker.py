@@ -0,0 +1,139 @@
+"""Circuit breaker for calls to an api that can go down, so an outage fails fast instead of being retried forever.
+
+Classes:
+    CircuitOpenError -- raised instead of calling the api while the circuit is open
+    CircuitBreaker -- counts consecutive failures, opening after too many, and probing until the api is back
+"""
+
+import time
+import typing
+import logging as log
+
+
+class CircuitOpenError(Exception):
+    """The api has been failing, so it wasn't called."""
+
+
+class CircuitBreaker:
+    """Stop calling an api after failure_threshold failures in a row, and try it again every reset_timeout seconds.
+
+    While closed every call is allowed. Once open, calls are refused (check raises CircuitOpenError) until
+    reset_timeout has passed, then one probe call is allowed (half open). If it succeeds the circuit closes again,
+    if it fails the circuit opens for another reset_timeout. If it ends without either being recorded, e.g. it was
+    cancelled, record_abandoned lets the next call probe instead, and a probe that's gone reset_timeout without
+    anything being recorded is given up on, so the circuit can't be stuck open.
+    on_open is called once when an outage starts, and on_close with how long it lasted and how many calls were
+    refused once it's over, so an outage is alerted once instead of once per call.
+    Public methods:
+        check
+        record_success
+        record_failure
+        record_abandoned
+        stats
+    Instance variables:
+        name -- what's being called, for the log
+        failure_threshold -- failures in a row which open the circuit
+        reset_timeout -- seconds the circuit stays open before a probe is allowed
+        state -- CLOSED, OPEN or HALF_OPEN
+    """
+
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(
+            self, name: str, failure_threshold: int = None, reset_timeout: float = None,
+            on_open: typing.Callable[[], None] = None,
+            on_close: typing.Callable[[float, int], None] = None,
+            clock: typing.Callable[[], float] = None
+    ):
+        """Initialise the class attributes."""
+        self.name = name
+        if failure_threshold is None:
+            failure_threshold = 5
+        self.failure_threshold = failure_threshold
+        if reset_timeout is None:
+            reset_timeout = 30.0
+        self.reset_timeout = reset_timeout
+        self.on_open = on_open
+        self.on_close = on_close
+        if clock is None:
+            clock = time.monotonic
+        self.clock = clock
+
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._outage_started_at = 0.0
+        self._probing = False
+        self._probe_started_at = 0.0
+        self._refused = 0
+        self._opens = 0
+
+    def check(self):
+        """Raise CircuitOpenError if the api shouldn't be called now, otherwise return so it can be called."""
+        if self.state == self.CLOSED:
+            return
+        if self.state == self.OPEN and self.clock() - self._opened_at >= self.reset_timeout:
+            self.state = self.HALF_OPEN
+            self._probing = False
+        probe_age = self.clock() - self._probe_started_at
+        if self.state == self.HALF_OPEN and self._probing and probe_age >= self.reset_timeout:
+            log.warning(f'[CIRCUIT] Gave up waiting for the last call to {self.name} to finish.')
+            self._probing = False
+        if self.state == self.HALF_OPEN and not self._probing:
+            # This call is the probe, everything else waits for what happens to it
+            self._probing = True
+            self._probe_started_at = self.clock()
+            log.info(f'[CIRCUIT] Trying {self.name} again.')
+            return
+        self._refused += 1
+        raise CircuitOpenError(f'{self.name} is failing, not calling it for now')
+
+    def record_success(self):
+        """Record that a call worked, closing the circuit if it was open."""
+        self._failures = 0
+        if self.state == self.CLOSED:
+            return
+        outage_seconds = self.clock() - self._outage_started_at
+        refused = self._refused
+        self.state = self.CLOSED
+        self._probing = False
+        self._refused = 0
+        log.info(f'[CIRCUIT] {self.name} is working again after {outage_seconds:.0f}s, {refused} calls were refused.')
+        if self.on_close is not None:
+            self.on_close(outage_seconds, refused)
+
+    def record_failure(self):
+        """Record that a call failed, opening the circuit after failure_threshold in a row, or a failed probe."""
+        self._failures += 1
+        if self.state == self.HALF_OPEN:
+            self.state = self.OPEN
+            self._opened_at = self.clock()
+            self._probing = False
+            return
+        if self.state == self.CLOSED and self._failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self._opened_at = self._outage_started_at = self.clock()
+            self._opens += 1
+            log.error(f'[CIRCUIT] {self.name} failed {self._failures} times in a row, '
+                      f'not calling it for {self.reset_timeout:.0f}s.')
+            if self.on_open is not None:
+                self.on_open()
+
+    def record_abandoned(self):
+        """Record that a call ended without showing whether the api works, e.g. it was cancelled.
+
+        It doesn't count as a success or a failure, but if it was the probe, the next call is allowed to probe.
+        """
+        if self.state == self.HALF_OPEN:
+            self._probing = False
+
+    def stats(self) -> typing.Dict[str, int]:
+        """Return whether the circuit is open, the failures in a row, how many outages there have been, and refusals."""
+        return {
+            'open': int(self.state != self.CLOSED),
+            'failures': self._failures,
+            'outages': self._opens,
+            'refused': self._refused,
+        }
@@ -0,0 +1,81 @@
+"""Merges adjacent queued commands that can be executed as one combined action.
+
+Under load the queue fills up with runs like 'left', 'left', 'light left' or 'backspace', 'backspace', and every one of
+them pays the full pyautogui pause and obs display time. Merging them keeps the queue short, but each merge is bounded
+so the combined action still looks like what chat asked for.
+
+Functions:
+    coalesce_commands -- return the merge of two parsed commands, or None if they can't be merged
+"""
+
+import typing
+
+
+# Bounds on a single merged action
+MAX_COALESCED_COMMANDS = 10
+MAX_MOUSE_MOVE = 400  # px on each axis
+MAX_SCROLL = 300  # per scroll, the scroll commands scroll five times
+MAX_BACKSPACES = 99  # the same as the backspace {n} command
+
+
+def _backspace_count(parsed_command) -> typing.Optional[int]:
+    """Return how many times a command presses backspace, or None if it isn't a backspace command."""
+    if parsed_command.name == 'multi_backspace':
+        return parsed_command.args[0]
+    if parsed_command.name == 'key_press' and parsed_command.args == ('backspace',):
+        return 1
+    return None
+
+
+def _merge_mouse_moves(pending, new) -> typing.Optional[tuple]:
+    xval = pending.args[0] + new.args[0]
+    yval = pending.args[1] + new.args[1]
+    if abs(xval) > MAX_MOUSE_MOVE or abs(yval) > MAX_MOUSE_MOVE:
+        return None
+    return xval, yval
+
+
+def _merge_scrolls(pending, new) -> typing.Optional[tuple]:
+    # Only merge scrolls in the same direction, scrolling up then down shouldn't turn into no scroll at all
+    if (pending.args[0] > 0) != (new.args[0] > 0):
+        return None
+    amount = pending.args[0] + new.args[0]
+    if abs(amount) > MAX_SCROLL:
+        return None
+    return (amount,)
+
+
+_MERGERS = {
+    'mouse_move': _merge_mouse_moves,
+    'mouse_scroll': _merge_scrolls,
+    'mouse_horizontal_scroll': _merge_scrolls,
+}
+
+
+def coalesce_commands(pending, new):
+    """Merge two adjacent parsed commands into one combined action, if they're compatible.
+
+    Args:
+        pending -- the cmpc.ParsedCommand waiting at the back of the queue
+        new -- the cmpc.ParsedCommand about to be queued after it
+    Returns:
+        a new cmpc.ParsedCommand which does both, or None if they can't be merged
+    Relative mouse moves merge into one vector, scrolls in the same direction merge into one amount, and backspaces
+    merge into one backspace {n}.
+    """
+    if pending.raw_count + new.raw_count > MAX_COALESCED_COMMANDS:
+        return None
+
+    if pending.name == new.name and pending.name in _MERGERS:
+        merged_args = _MERGERS[pending.name](pending, new)
+        if merged_args is None:
+            return None
+        return pending.merged_with(new, pending.name, merged_args)
+
+    pending_backspaces = _backspace_count(pending)
+    if pending_backspaces is not None:
+        new_backspaces = _backspace_count(new)
+        if new_backspaces is not None and pending_backspaces + new_backspaces <= MAX_BACKSPACES:
+            return pending.merged_with(new, 'multi_backspace', (pending_backspaces + new_backspaces,))
+
+    return None
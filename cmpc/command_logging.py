@@ -1,27 +1,29 @@
-import time
+import asyncio
 import typing
 import logging as log
 from pathlib import Path
 
-import aiohttp
-# https://obsproject.com/forum/resources/obs-websocket-remote-control-obs-studio-from-websockets.466/
-import obswebsocket
-import obswebsocket.exceptions
-import obswebsocket.requests
-
 from cmpc.twitch_message import TwitchMessage
+from cmpc.utils import webhook_dispatcher
+from cmpc.obs_display import ObsDisplay
+from cmpc.obs_client import ObsWebsocketClient, ObsWebsocketError
+from cmpc.metrics import PipelineMetrics
+
+# Where obs text goes: the websocket with executing.txt as a fallback, only executing.txt, or nowhere (for replays)
+OBS_OUTPUTS = ('websocket', 'file', 'memory')
 
 
 class CommandLogging:
     def __init__(
             self, bot, obs_file_name: typing.Union[str, Path],
             obs_source_name: str = None, obs_log_sleep_duration: float = None, obs_none_log_msg: str = None,
-            use_websockets: bool = True
+            output: str = None, metrics: PipelineMetrics = None
     ):
         self.bot = bot
         self.obs_file_name = obs_file_name
+        obs_config = self.bot.config.get('obs', {})
         if obs_source_name is None:
-            obs_source_name = 'executing'
+            obs_source_name = obs_config.get('source_name', 'executing')
         self.obs_source_name = obs_source_name
 
         if obs_log_sleep_duration is None:
@@ -31,63 +33,109 @@ class CommandLogging:
             obs_none_log_msg = 'nothing'
         self.obs_none_log_msg = obs_none_log_msg
 
-        self._socket = obswebsocket.obsws('localhost', 4444)
-        if use_websockets:
+        if output is None:
+            output = obs_config.get('output', 'websocket')
+        if output not in OBS_OUTPUTS:
+            raise ValueError(f'Unknown obs output {output}, expected one of {OBS_OUTPUTS}')
+        self.output = output
+
+        # Only the display writes to obs, everything else just tells it what to show
+        # With the memory output nothing is written, what would be on obs is only kept in obs_display.written_text
+        self.obs_display = ObsDisplay(self._obs_log_nowhere if output == 'memory' else self._obs_log)
+        asyncio.ensure_future(self.obs_display.run(), loop=self.obs_display.loop)
+
+        # executing.txt is used whenever the websocket isn't connected, or the text source can't be set with it
+        self.obs_client = None
+        self._websocket_source_ok = False
+        self._using_websocket = False
+        if output == 'websocket':
+            self.obs_client = ObsWebsocketClient(
+                host=obs_config.get('websocket_host'), port=obs_config.get('websocket_port'),
+                password=obs_config.get('websocket_password'), on_connect=self._check_obs_text_source,
+                metrics=metrics,
+            )
+            asyncio.ensure_future(self.obs_client.run(), loop=self.obs_display.loop)
+
+    async def log_to_discord(self, message: TwitchMessage):
+        """Queue a command to be sent to the chat relay webhook, batched with any others waiting to be sent."""
+        await webhook_dispatcher().send(
+            self.bot.config['discord']['chatrelay'], message.get_log_webhook_payload(), batch=True
+        )
+
+    async def _check_obs_text_source(self):
+        """Check the text source can be set with the websocket, every time it connects."""
+        self._websocket_source_ok = False
+        try:
+            text_source = await self.obs_client.call('GetTextGDIPlusProperties', source=self.obs_source_name)
+        except ObsWebsocketError:
+            log.error(f"Couldn't get obs text source: {self.obs_source_name}. Defaulting to executing.txt")
+            return
+        if text_source.get('read_from_file'):
+            log.error(f'Text source: {self.obs_source_name} is set to read from file. Defaulting to executing.txt')
+            return
+        self._websocket_source_ok = True
+        # Whatever was written to executing.txt while disconnected
+        self.obs_display.refresh()
+
+    async def _obs_log(self, obs_log_text: str):
+        """Show text with the websocket if it's connected, otherwise in executing.txt."""
+        if self._websocket_source_ok and self.obs_client.connected:
             try:
-                self._socket.connect()
-                text_source = self._socket.call(obswebsocket.requests.GetTextGDIPlusProperties(self.obs_source_name))
-                if not text_source.status:
-                    log.error(f"Couldn't get obs text source: {self.obs_source_name}. Defaulting to executing.txt")
-                    raise obswebsocket.exceptions.ConnectionFailure
-                if text_source.datain['read_from_file']:
-                    log.error(f'Text source: {self.obs_source_name} is set to read from file. '
-                              'Defaulting to executing.txt')
-                    raise obswebsocket.exceptions.ConnectionFailure
-            except obswebsocket.exceptions.ConnectionFailure:
-                log.error('Could not connect to obs websocket, defaulting to executing.txt')
-                self.obs_log_handler = self._obs_log_executing_txt
+                await self.obs_client.call(
+                    'SetTextGDIPlusProperties', source=self.obs_source_name, text=obs_log_text
+                )
+            except ObsWebsocketError as error:
+                log.debug(f'[OBS] {error}')
             else:
-                self.obs_log_handler = self._obs_log_ws
-        else:
-            self.obs_log_handler = self._obs_log_executing_txt
+                if not self._using_websocket:
+                    log.info('[OBS] Showing commands with the obs websocket.')
+                    self._using_websocket = True
+                return
 
-    async def log_to_discord(self, message: TwitchMessage):
-        """Send a command to the discord webhook."""
-        async with aiohttp.ClientSession() as session:
-            await session.post(self.bot.config['discord']['chatrelay'],
-                               json=message.get_log_webhook_payload(),
-                               headers={'User-Agent': self.bot.config['api']['useragent']})
+        if self._using_websocket:
+            log.error('Could not show on obs with the websocket, using executing.txt until it reconnects.')
+            self._using_websocket = False
+        await asyncio.get_event_loop().run_in_executor(None, self._obs_log_executing_txt, obs_log_text)
+
+    async def _obs_log_nowhere(self, obs_log_text: str):
+        pass
 
     def _obs_log_executing_txt(self, obs_log_text: str):
-        with open(self.obs_file_name, 'w', encoding='utf-8') as obs_file_handle:
-            obs_file_handle.write(obs_log_text)
+        ObsDisplay.write_file_atomic(self.obs_file_name, obs_log_text)
 
-    def _obs_log_ws(self, obs_log_text: str):
-        try:
-            self._socket.call(obswebsocket.requests.SetTextGDIPlusProperties({self.obs_source_name}, text=obs_log_text))
-        except obswebsocket.exceptions.ConnectionFailure:
-            log.error('Could not connect to obs websocket, defaulting to executing.txt')
-            self._socket.disconnect()
-            self._obs_log_executing_txt(obs_log_text)
-            self.obs_log_handler = self._obs_log_executing_txt
+    def log_executing(self, message: TwitchMessage):
+        """Show a command on obs as it's executed, holding it there for the sleep duration so it's readable.
+
+        Doesn't block, later commands are shown once the hold is over, or skipped if there's a newer one by then.
+        """
+        self.obs_display.show(message.get_log_string(), hold=self.obs_log_sleep_duration)
+        log.info(message.get_log_string())
+
+    def log_nothing_executing(self):
+        """Show the none log message on obs, for when no commands are executing."""
+        self.obs_display.show(self.obs_none_log_msg)
+
+    def log_tally(self, tally_string: str):
+        """Show the live vote tally on obs, for democracy mode."""
+        self.obs_display.show(tally_string)
 
     async def log_to_obs(
             self, message: TwitchMessage, none_log_msg: str = None,
             sleep_duration: float = None, none_sleep: bool = False
     ):
-        """Log a message to the file shown on-screen for the stream."""
+        """Log a message to the file shown on-screen for the stream.
+
+        The message is held on obs for sleep_duration (only if none_sleep for the none log message), but this
+        doesn't wait for it, anything logged next is shown once the hold is over.
+        """
         if none_log_msg is None:
             none_log_msg = self.obs_none_log_msg
         if sleep_duration is None:
             sleep_duration = self.obs_log_sleep_duration
 
         if message is None:
-            self.obs_log_handler(none_log_msg)
-            if none_sleep:
-                time.sleep(sleep_duration)
+            self.obs_display.show(none_log_msg, hold=sleep_duration if none_sleep else 0.0)
         else:
-            self.obs_log_handler(message.get_log_string())
-
-            time.sleep(sleep_duration)
+            self.obs_display.show(message.get_log_string(), hold=sleep_duration)
             log.info(message.get_log_string())
             await self.log_to_discord(message)
@@ -6,26 +6,145 @@ Classes:
 
 # PSL Packages
 import sys
+import asyncio
 import re
 import time
+import functools
 import logging as log
 import typing
 from pathlib import Path
 
-# PIP Packages;
-import aiohttp  # !modalert and chatrelay
-import pyautogui
-import pyperclip  # for ptype command
-
 # Local Packages
 import cmpc.command_logging
+import cmpc.input_executor
+import cmpc.load_shedding
+import cmpc.democracy
+import cmpc.metrics
+import cmpc.hold_scheduler
+import cmpc.typing_engine
+from cmpc.command_coalescing import coalesce_commands
 from cmpc.twitch_message import TwitchMessage
-from cmpc.utils import removeprefix, move_mouse, hold_mouse, press_key, hold_key, parse_goto_args
+from cmpc.utils import parse_goto_args, webhook_dispatcher
+from cmpc.input_backends import InputBackend, InputBackendError, get_input_backend
+
+
+# These only match the part of the message after the command prefix, the prefix itself is matched by the trie
+MULTI_ALT_TAB_ARGS_REGEX = re.compile('([0-9]{1,2})x? tab')
+MULTI_BACKSPACE_ARGS_REGEX = re.compile('(?:x | | x)([0-9]{1,2})')
+# Compound programs e.g. 'left x3, click' or 'z; z; arrow down for 0.5'
+PROGRAM_HINT_REGEX = re.compile('[,;]| ?x[0-9]{1,2}$')
+PROGRAM_SEPARATOR_REGEX = re.compile('[,;]')
+PROGRAM_STEP_REPEAT_REGEX = re.compile('(.+?) ?x([0-9]{1,2})')
+MAX_PROGRAM_STEPS = 10
+MAX_PROGRAM_DURATION = 10.0
+PROGRAM_CACHE_SIZE = 1024
+# Command name -> index of the arg that's how long the command lasts, for MAX_PROGRAM_DURATION
+PROGRAM_STEP_DURATION_ARGS = {'hold_key': 1, 'mouse_hold': 0, 'mouse_drag': 2}
+CONFIG_FOLDER = Path('config/')
 
 
-MULTI_ALT_TAB_REGEX = re.compile('alt ([0-9]{1,2})x? tab')
-MULTI_BACKSPACE_REGEX = re.compile('back ?space(?:x | | x)([0-9]{1,2})')
-CONFIG_FOLDER = Path('config/')
+class CommandParseError(ValueError):
+    """Raised when a message starts with a command prefix but its arguments can't be used."""
+
+
+class ParsedCommand:
+    """A chat message that has been matched to a command, with its arguments already converted.
+
+    Public methods:
+        merged_with
+        get_log_message
+    Instance variables:
+        name -- the name of the command, a key of CommandProcessor.actions e.g. 'mouse_move'
+        args -- tuple of the converted arguments to pass to the command's action
+        message -- the cmpc.TwitchMessage the command was parsed from, or the first one if it's been coalesced
+        raw_count -- how many chat commands this command represents, more than 1 if it's been coalesced
+        usernames -- tuple of the users who sent those commands
+        future -- future for the command being executed, once it's been queued by process_commands
+    """
+
+    __slots__ = ('name', 'args', 'message', 'raw_count', '_usernames', 'future',)
+
+    def __init__(self, name: str, args: tuple, message: TwitchMessage, raw_count: int = 1,
+                 usernames: typing.Tuple[str, ...] = None):
+        """Initialise the class attributes."""
+        self.name = name
+        self.args = args
+        self.message = message
+        self.raw_count = raw_count
+        # Only worked out if the command gets coalesced, to keep the common case cheap
+        self._usernames = usernames
+        self.future = None
+
+    @property
+    def usernames(self) -> typing.Tuple[str, ...]:
+        if self._usernames is None:
+            return (self.message.username,)
+        return self._usernames
+
+    def merged_with(self, other: 'ParsedCommand', name: str, args: tuple) -> 'ParsedCommand':
+        """Return a command with the given name and args, which represents this command followed by other."""
+        usernames = self.usernames + tuple(user for user in other.usernames if user not in self.usernames)
+        return ParsedCommand(name, args, self.message, self.raw_count + other.raw_count, usernames)
+
+    def get_log_message(self) -> TwitchMessage:
+        """Return the message to show on obs and relay to discord.
+
+        For coalesced commands this says how many commands were merged and who sent them.
+        """
+        if self.raw_count == 1:
+            return self.message
+
+        usernames = ', '.join(self.usernames[:3])
+        if len(self.usernames) > 3:
+            usernames += f' +{len(self.usernames) - 3}'
+        return TwitchMessage(f'{self.message.original_content} (+{self.raw_count - 1} merged)', usernames)
+
+    def __repr__(self) -> str:
+        return f'ParsedCommand({self.name!r}, {self.args!r})'
+
+
+class CommandTrie:
+    """Prefix trie for the commands that take arguments.
+
+    Lets a message be matched against every command prefix by walking it once, instead of calling startswith for
+    every prefix in turn.
+    Public methods:
+        insert
+        longest_prefix
+    """
+
+    __slots__ = ('_root',)
+
+    # Key used to store a prefix's value in its node, can't clash with the single character keys
+    _VALUE = None
+
+    def __init__(self):
+        """Initialise the class attributes."""
+        self._root = {}
+
+    def insert(self, prefix: str, value: typing.Any):
+        """Add a prefix to the trie, replacing the value of that prefix if it's already there."""
+        node = self._root
+        for char in prefix:
+            node = node.setdefault(char, {})
+        node[self._VALUE] = value
+
+    def longest_prefix(self, text: str) -> typing.Tuple[typing.Any, int]:
+        """Return the value of the longest prefix of text in the trie, and the length of that prefix.
+
+        Returns (None, 0) if no prefix in the trie matches.
+        """
+        node = self._root
+        value = None
+        prefix_length = 0
+        for index, char in enumerate(text):
+            node = node.get(char)
+            if node is None:
+                break
+            if self._VALUE in node:
+                value = node[self._VALUE]
+                prefix_length = index + 1
+        return value, prefix_length
 
 
 class CommandProcessor:
@@ -33,15 +152,31 @@ class CommandProcessor:
 
     Does not handle permissions, all commands are unrestricted.
     Public methods:
+        parse_command
+        submit_command
         process_commands
+        start_democracy
+        stop_democracy
+        priority_input
+        release_holds
     Instance variables:
         config -- a dict of config values
+        input_backend -- cmpc.InputBackend that sends the keyboard and mouse input, only used on the input executor
+        input_executor -- cmpc.InputExecutor which runs every input command in order, off the asyncio loop
+        hold_scheduler -- cmpc.HoldScheduler which holds keys and the mouse for hold commands, without blocking
+        typing_engine -- cmpc.TypingEngine which types the text of type, ptype and gtype commands
+        metrics -- cmpc.PipelineMetrics the parse, dispatch and execution stages are recorded in
+        vote_collector -- cmpc.VoteCollector while in democracy mode, None while in anarchy mode
+        actions -- dict of command name to the function that runs it on the input executor thread
+        loop_actions -- dict of command name to the coroutine function that runs it on the asyncio loop
+        command_table -- dict of every exact match command alias to its command name and arguments
+        argument_trie -- CommandTrie of every argument taking command prefix to its name and argument parser
         obs_file_name -- path to the file containing the currently executing command
         obs_log_sleep_duration -- how long to leave executing.txt to make it readable on obs on stream
     """
 
     KEY_PRESS_COMMANDS = {
-        ('enter', 'z'): 'enter',e
+        ('enter', 'z'): 'enter',
         ('backspace', 'back space', 'delete',): 'backspace',
         ('space', 'spacebar', 'space bar'): 'space',
         ('page up', 'pageup',): 'pageup',
@@ -56,7 +191,7 @@ class CommandProcessor:
         ('control t', 'ctrl t', 'new tab',): ('ctrl', 't',),
         ('control s', 'ctrl s', 'save',): ('ctrl', 's',),
         ('control z', 'ctrl z', 'undo',): ('ctrl', 'z',),
-        ('control c', 'ctrl s', 'copy',): ('ctrl', 'c',),
+        ('control c', 'ctrl c', 'copy',): ('ctrl', 'c',),
         ('control v', 'ctrl v', 'paste',): ('ctrl', 'v',),
         ('control w', 'ctrl w', 'close tab', 'close the tab',): ('ctrl', 'w',),
         ('control a', 'ctrl a', 'select all',): ('ctrl', 'a',),
@@ -67,7 +202,7 @@ class CommandProcessor:
         ('screenshot', 'screen shot',): ('win', 'prtsc',),
     }
 
-    # note that here doubleclick is not actually a valid pyautogui input, but it gets fixed in the actual def later on
+    # note that here doubleclick is not actually a valid mouse button, but it gets fixed in the actual def later on
     CLICK_COMMANDS = {
         ('click', 'leftclick', 'left click',): 'left',
         ('doubleclick', 'double click',): 'doubleclick',
@@ -129,358 +264,521 @@ class CommandProcessor:
     }  # note trailing space - this is to process args better
 
     def __init__(self, bot, obs_file_name: typing.Union[str, Path],
-                 obs_log_sleep_duration: float = None):
-        """Initialise the class attributes."""
+                 obs_log_sleep_duration: float = None, input_backend: InputBackend = None,
+                 metrics: cmpc.metrics.PipelineMetrics = None):
+        """Initialise the class attributes.
+
+        If input_backend isn't given, it's picked by the INPUT_BACKEND option, or by platform if that's not set.
+        If metrics isn't given, stage latencies aren't recorded.
+        """
         self.bot = bot
 
-        self.command_logging = cmpc.command_logging.CommandLogging(self.bot, obs_file_name, obs_log_sleep_duration)
+        if metrics is None:
+            metrics = cmpc.metrics.PipelineMetrics(enabled=False)
+        self.metrics = metrics
+
+        if input_backend is None:
+            input_backend = get_input_backend(self.bot.config['options'].get('INPUT_BACKEND'))
+        self.input_backend = input_backend
+        log.info(f'Using input backend: {self.input_backend.name}')
+
+        self.command_logging = cmpc.command_logging.CommandLogging(
+            self.bot, obs_file_name, obs_log_sleep_duration=obs_log_sleep_duration, metrics=self.metrics
+        )
+        if self.command_logging.obs_client is not None:
+            self.metrics.add_gauges(self.command_logging.obs_client.stats, 'obs_websocket')
         self.log_to_obs = self.command_logging.log_to_obs
 
+        self.hold_scheduler = cmpc.hold_scheduler.HoldScheduler(self.input_backend)
+        self.typing_engine = cmpc.typing_engine.TypingEngine(self.input_backend, metrics=self.metrics)
+        self.metrics.add_gauges(self.typing_engine.stats, 'typing')
+
+        queue_config = self.bot.config.get('queue', {})
+        self.input_executor = cmpc.input_executor.InputExecutor(
+            on_idle=self.command_logging.log_nothing_executing,
+            admission_controller=cmpc.load_shedding.AdmissionController(
+                policy=queue_config.get('policy'), target_latency=queue_config.get('target_latency'),
+                max_queue_limit=queue_config.get('max_depth'), sample_n=queue_config.get('sample_n'),
+            ),
+            metrics=self.metrics,
+            hold_scheduler=self.hold_scheduler,
+        )
+        self.input_executor.start()
+
         self.cooldowns = {
             '!modalert': {'required': 30.0, 'last_called': 0.0},
         }
 
-    async def process_commands(self, message: TwitchMessage) -> bool:
-        """Check a Twitch message for command invocations and run any applicable command.
+        self.actions = {
+            'key_press': self._run_key_press_command,
+            'hotkey': self._run_hotkey_command,
+            'click': self._run_click_command,
+            'mouse_hold': self._run_mouse_hold_command,
+            'mouse_scroll': self._run_mouse_scroll_command,
+            'mouse_horizontal_scroll': self._run_mouse_horizontal_scroll_command,
+            'mouse_move': self._run_mouse_move_command,
+            'mouse_drag': self._run_mouse_drag_command,
+            'type': self._run_type_command,
+            'hold_key': self._run_hold_key_command,
+            'go_to': self._run_go_to_command,
+            'drag_to': self._run_drag_to_command,
+            'gtype': self._run_gtype_command,
+            'ptype': self._run_ptype_command,
+            'multi_alt_tab': self._run_multi_alt_tab_command,
+            'multi_backspace': self._run_multi_backspace_command,
+            'program': self._run_program_command,
+        }
+        # These don't touch the input device, so they don't wait their turn on the input executor
+        self.loop_actions = {
+            'modalert': self._run_modalert_command,
+        }
 
-        Will run the first applicable command before returning.
-        Args:
-            message -- a cmpc.TwitchMessage object
-        Returns:
-            command_has_run
-        """
-        commands = [
-            self._process_key_press_commands,
-            self._process_click_commands,
-            self._process_mouse_move_commands,
-            self._process_hotkey_commands,
-            self._process_mouse_hold_commands,
-            self._process_mouse_scroll_commands,
-            self._process_mouse_horizontal_scroll_commands,
-            self._process_mouse_drag_commands,
-            self._process_misc_commands,
-            self._process_type_commands,
-            self._process_hold_key_commands,
-        ]
+        # None means anarchy mode, where every command is executed
+        self.vote_collector = None
 
-        command_has_run = False
-        for comm in commands:
-            # noinspection PyArgumentList
-            if await comm(message):
-                command_has_run = True
-                break
-        return command_has_run
+        # alias -> (name, args), so exact match commands only cost one dict lookup per message
+        self.command_table = self._compile_command_table()
+        # prefix -> (name, argument parser), so the rest only cost one walk over the message
+        self.argument_trie = self._compile_argument_trie()
+        # original message content -> program steps, chat repeats the same messages a lot
+        self._parse_program = functools.lru_cache(maxsize=PROGRAM_CACHE_SIZE)(self._compile_program)
 
-    async def _process_key_press_commands(self, message: TwitchMessage) -> bool:
-        """Check message for key press commands and run any applicable command.
+    def _compile_command_table(self) -> typing.Dict[str, typing.Tuple[str, tuple]]:
+        """Compile the alias tuples of the exact match command dicts into one alias lookup table.
 
-        Presses the button and also calls log_to_obs.
-        Takes a cmpc.TwitchMessage instance.
-        Returns True if a command has been run and False otherwise.
+        Returns a dict of alias -> (command name, args), where the name is a key of self.actions.
+        Dicts earlier in the list win when an alias is in more than one of them. This is the same priority
+        process_commands used when it checked every dict in turn. Collisions are logged with the winning dict, and
+        aliases that are in one dict more than once are logged too, since the later ones can never be used.
         """
-        for valid_inputs, output in self.KEY_PRESS_COMMANDS.items():
-            if message.content in valid_inputs:
-                if sys.platform == 'darwin':
-                    output.replace('ctrl', 'command')
-                await self.log_to_obs(message)
-                if 'enter' in valid_inputs:
-                    press_key(output)
-                else:
-                    pyautogui.press(output)
-
-                return True
-        return False
-
-    async def _process_hotkey_commands(self, message: TwitchMessage) -> bool:
-        """Check message for hotkey commands and run any applicable command.
+        exact_command_dicts = [
+            ('KEY_PRESS_COMMANDS', self.KEY_PRESS_COMMANDS, 'key_press'),
+            ('CLICK_COMMANDS', self.CLICK_COMMANDS, 'click'),
+            ('MOUSE_MOVE_COMMANDS', self.MOUSE_MOVE_COMMANDS, 'mouse_move'),
+            ('HOTKEY_COMMANDS', self.HOTKEY_COMMANDS, 'hotkey'),
+            ('MOUSE_HOLD_COMMANDS', self.MOUSE_HOLD_COMMANDS, 'mouse_hold'),
+            ('MOUSE_SCROLL_COMMANDS', self.MOUSE_SCROLL_COMMANDS, 'mouse_scroll'),
+            ('MOUSE_HORIZONTAL_SCROLL_COMMANDS', self.MOUSE_HORIZONTAL_SCROLL_COMMANDS, 'mouse_horizontal_scroll'),
+            ('MOUSE_DRAG_COMMANDS', self.MOUSE_DRAG_COMMANDS, 'mouse_drag'),
+        ]
 
-        Presses the two keys together and also calls log_to_obs.
-        Takes a cmpc.TwitchMessage instance.
-        Returns True if a command has been run and False otherwise.
-        """
-        for valid_inputs, output in self.HOTKEY_COMMANDS.items():
-            if message.content in valid_inputs:
-                if sys.platform == 'darwin':
-                    output.replace('ctrl', 'command')
-                await self.log_to_obs(message)
-                pyautogui.hotkey(*output)
-                return True
-        return False
-
-    async def _process_click_commands(self, message: TwitchMessage) -> bool:
-        """Check message for mouse click press commands and run any applicable command.
-
-        Clicks the mouse button once, or twice if the command is named doubleclick.
-        Also calls log_to_obs.
-        Takes a cmpc.TwitchMessage instance.
-        Returns True if a command has been run and False otherwise.
+        command_table = {}
+        alias_sources = {}
+        for dict_name, command_dict, command_name in exact_command_dicts:
+            dict_aliases = set()
+            for valid_inputs, output in command_dict.items():
+                if isinstance(output, tuple):
+                    args = output
+                    if sys.platform == 'darwin':
+                        args = tuple('command' if key == 'ctrl' else key for key in args)
+                else:
+                    args = (output,)
+
+                for alias in valid_inputs:
+                    if alias in dict_aliases:
+                        log.warning(f"Command alias '{alias}' is in {dict_name} more than once, using the first one.")
+                        continue
+                    dict_aliases.add(alias)
+                    if alias in command_table:
+                        log.warning(f"Command alias '{alias}' is in both {alias_sources[alias]} and {dict_name}, "
+                                    f'using the one from {alias_sources[alias]}.')
+                        continue
+                    command_table[alias] = (command_name, args)
+                    alias_sources[alias] = dict_name
+
+        log.debug(f'Compiled command table with {len(command_table)} aliases.')
+        return command_table
+
+    def _compile_argument_trie(self) -> CommandTrie:
+        """Compile the prefixes of every command that takes arguments into one CommandTrie.
+
+        Each prefix maps to (command name, argument parser). The parser takes the rest of the message after the
+        prefix, in lowercase and in its original case, and returns the converted args tuple for the command's action.
+        Parsers raise ValueError (or CommandParseError) if the arguments can't be used.
         """
-        for valid_inputs, output in self.CLICK_COMMANDS.items():
-            if message.content in valid_inputs:
-                await self.log_to_obs(message)
-                click_count = 1
-                if output == 'doubleclick':
-                    click_count = 2
-                    output = 'left'
-                pyautogui.click(button=output, clicks=click_count)
-                return True
-        return False
-
-    async def _process_mouse_hold_commands(self, message: TwitchMessage) -> bool:
-        """Check message for mouse hold commands and run any applicable command.
-
-        Presses the left mouse button for the duration of time associated with the command.
-        Also calls log_to_obs.
-        Takes a cmpc.TwitchMessage instance.
-        Returns True if a command has been run and False otherwise.
+        argument_trie = CommandTrie()
+        for prefix in self.TYPE_COMMANDS:
+            argument_trie.insert(prefix, ('type', self._parse_original_text_args))
+        for prefix, key in self.HOLD_KEY_COMMANDS.items():
+            argument_trie.insert(prefix, ('hold_key', functools.partial(self._parse_hold_key_args, key)))
+
+        argument_trie.insert('!modalert', ('modalert', self._parse_modalert_args))
+        argument_trie.insert('go to ', ('go_to', self._parse_coordinate_args))
+        argument_trie.insert('drag to ', ('drag_to', self._parse_coordinate_args))
+        argument_trie.insert('gtype ', ('gtype', self._parse_text_args))
+        argument_trie.insert('ptype ', ('ptype', self._parse_text_args))
+        argument_trie.insert('alt ', ('multi_alt_tab', self._parse_multi_alt_tab_args))
+        for prefix in ('backspace', 'back space',):
+            argument_trie.insert(prefix, ('multi_backspace', self._parse_multi_backspace_args))
+
+        return argument_trie
+
+    @staticmethod
+    def _parse_text_args(args: str, original_args: str) -> typing.Tuple[str]:
+        return (args,)
+
+    @staticmethod
+    def _parse_original_text_args(args: str, original_args: str) -> typing.Tuple[str]:
+        return (original_args,)
+
+    @staticmethod
+    def _parse_modalert_args(args: str, original_args: str) -> typing.Tuple[str]:
+        return (args.strip(),)
+
+    @staticmethod
+    def _parse_hold_key_args(key: str, args: str, original_args: str) -> typing.Tuple[str, float]:
+        time_value = float(args)
+        if not 0.0 < time_value <= 10.0:
+            raise CommandParseError(f'hold duration must be between 0 and 10 seconds, not {time_value}')
+        return key, time_value
+
+    def _parse_coordinate_args(self, args: str, original_args: str) -> typing.Tuple[int, int]:
+        return parse_goto_args(args, screen_size=self.input_backend.size())
+
+    @staticmethod
+    def _parse_multi_alt_tab_args(args: str, original_args: str) -> typing.Tuple[int]:
+        multi_alt_tab_match = MULTI_ALT_TAB_ARGS_REGEX.fullmatch(args)
+        if not multi_alt_tab_match:
+            raise CommandParseError('expected alt {n} tab')
+        return (int(multi_alt_tab_match.group(1)),)
+
+    @staticmethod
+    def _parse_multi_backspace_args(args: str, original_args: str) -> typing.Tuple[int]:
+        multi_backspace_match = MULTI_BACKSPACE_ARGS_REGEX.fullmatch(args)
+        if not multi_backspace_match:
+            raise CommandParseError('expected backspace {n}')
+        return (int(multi_backspace_match.group(1)),)
+
+    def parse_command(self, message: TwitchMessage) -> typing.Optional[ParsedCommand]:
+        """Match a Twitch message to a command and convert its arguments.
+
+        Exact match commands are resolved with a single lookup in the command table. Otherwise the message is walked
+        once through the argument trie, and the longest matching prefix's parser converts the rest of the message.
+        If that doesn't give a command, the message is tried as a program of commands, see _compile_program.
+        Args:
+            message -- a cmpc.TwitchMessage object
+        Returns:
+            a ParsedCommand, or None if the message isn't a command or its arguments couldn't be parsed
         """
-        for valid_inputs, output in self.MOUSE_HOLD_COMMANDS.items():
-            if message.content in valid_inputs:
-                await self.log_to_obs(message)
-                hold_mouse(time_value=output, button='left')
-                return True
-        return False
-
-    async def _process_mouse_scroll_commands(self, message: TwitchMessage) -> bool:
-        """Check message for mouse scroll commands and run any applicable command.
-
-        Scrolls the mouse wheel five times by the amount associated with the command.
-        Also calls log_to_obs.
-        Takes a cmpc.TwitchMessage instance.
-        Returns True if a command has been run and False otherwise.
+        parse_error = None
+        try:
+            parsed_command = self._parse_single_command(message)
+        except CommandParseError as error:
+            parsed_command = None
+            parse_error = error
+        if parsed_command is not None:
+            return parsed_command
+
+        if PROGRAM_HINT_REGEX.search(message.content):
+            steps = self._parse_program(message.original_content)
+            if steps is not None:
+                return ParsedCommand('program', (steps,), message)
+
+        if parse_error is not None:
+            # Plenty of regular chat starts like a command, so this isn't an error
+            log.info(str(parse_error))
+        return None
+
+    def _parse_single_command(self, message: TwitchMessage) -> typing.Optional[ParsedCommand]:
+        """Match a Twitch message to one command, returning None if it isn't one.
+
+        Raises CommandParseError if the message starts with a command prefix but its arguments can't be used.
         """
-        for valid_inputs, output in self.MOUSE_SCROLL_COMMANDS.items():
-            if message.content in valid_inputs:
-                await self.log_to_obs(message)
-                for i in range(5):
-                    pyautogui.scroll(output)
-                return True
-        return False
-
-    async def _process_mouse_horizontal_scroll_commands(self, message: TwitchMessage) -> bool:
-        """Check message for horizontal mouse scroll commands and run any applicable command.
-
-        Scrolls the mouse wheel five times by the amount associated with the command.
-        Uses pyautogui.hscroll on compatible platforms. On windows it holds shift then vscrolls.
-        Also calls log_to_obs.
-        Takes a cmpc.TwitchMessage instance.
-        Returns True if a command has been run and False otherwise.
+        exact_command = self.command_table.get(message.content)
+        if exact_command is not None:
+            command_name, args = exact_command
+            return ParsedCommand(command_name, args, message)
+
+        argument_command, prefix_length = self.argument_trie.longest_prefix(message.content)
+        if argument_command is None:
+            return None
+
+        command_name, parse_args = argument_command
+        try:
+            args = parse_args(message.content[prefix_length:], message.original_content[prefix_length:])
+        except (ValueError, OverflowError) as error:
+            raise CommandParseError(f'Could not parse {command_name} command: {message.content} ({error})') from error
+        return ParsedCommand(command_name, args, message)
+
+    def _compile_program(self, content: str) -> typing.Optional[typing.Tuple[typing.Tuple[str, tuple], ...]]:
+        """Compile a message of commands separated by , or ; into a tuple of (command name, args) steps.
+
+        A step can be repeated up to 99 times with x{n}, e.g. 'left x3, click'. Only input commands can be steps.
+        Programs are capped at MAX_PROGRAM_STEPS steps after repeats, and MAX_PROGRAM_DURATION seconds of holds and
+        drags. Returns None if any step isn't a command, or the program is over a cap.
+        Called through self._parse_program, which caches the result for each message.
         """
-        for valid_inputs, output in self.MOUSE_HORIZONTAL_SCROLL_COMMANDS.items():
-            if message.content in valid_inputs:
-                await self.log_to_obs(message)
-                if sys.platform in ['darwin', 'linux']:
-                    for i in range(5):
-                        pyautogui.hscroll(output)
-                else:
-                    pyautogui.keyDown('shift')
-                    for i in range(5):
-                        pyautogui.scroll(output)
-                    pyautogui.keyUp('shift')
-                return True
-        return False
-
-    async def _process_mouse_move_commands(self, message: TwitchMessage) -> bool:
-        """Check message for mouse move commands and run any applicable command.
-
-        Moves the mouse by the command's co-ords and also calls log_to_obs.
-        Takes a cmpc.TwitchMessage instance.
-        Returns True if a command has been run and False otherwise.
+        steps = []
+        duration = 0.0
+        for step_content in PROGRAM_SEPARATOR_REGEX.split(content):
+            step_content = step_content.strip()
+            if not step_content:
+                continue
+
+            repeat = 1
+            try:
+                step = self._parse_single_command(TwitchMessage(step_content, ''))
+                if step is None:
+                    repeat_match = PROGRAM_STEP_REPEAT_REGEX.fullmatch(step_content)
+                    if repeat_match:
+                        repeat = int(repeat_match.group(2))
+                        step = self._parse_single_command(TwitchMessage(repeat_match.group(1), ''))
+            except CommandParseError:
+                return None
+            if step is None or step.name not in self.actions:
+                return None
+
+            steps.extend([(step.name, step.args)] * repeat)
+            duration_arg = PROGRAM_STEP_DURATION_ARGS.get(step.name)
+            if duration_arg is not None:
+                duration += step.args[duration_arg] * repeat
+            if len(steps) > MAX_PROGRAM_STEPS or duration > MAX_PROGRAM_DURATION:
+                log.info(f'Program is over {MAX_PROGRAM_STEPS} steps or {MAX_PROGRAM_DURATION} seconds: {content}')
+                return None
+
+        if not steps:
+            return None
+        return tuple(steps)
+
+    def submit_command(self, parsed_command: ParsedCommand) -> asyncio.Future:
+        """Queue a parsed command to be executed, after every command submitted before it.
+
+        Input commands run on the input executor thread, the rest are scheduled on the asyncio loop.
+        If the command at the back of the input queue hasn't started yet and can be merged with this one, they are
+        coalesced into one action, and the future of the queued one is returned.
+        Returns a future which completes once the command has been executed, awaiting it is optional.
         """
-        for valid_inputs, output in self.MOUSE_MOVE_COMMANDS.items():
-            if message.content in valid_inputs:
-                await self.log_to_obs(message)
-                move_mouse(*output)
-                return True
-        return False
-
-    async def _process_mouse_drag_commands(self, message: TwitchMessage) -> bool:
-        """Check message for mouse drag commands and run any applicable command.
-
-        Moves the mouse by the commands co-ords while holding the left mouse button.
-        Also calls log_to_obs.
-        Takes a cmpc.TwitchMessage instance.
-        Returns True if a command has been run and False otherwise.
+        loop_action = self.loop_actions.get(parsed_command.name)
+        if loop_action is not None:
+            return asyncio.ensure_future(loop_action(parsed_command.message, *parsed_command.args))
+        return self.input_executor.submit(self._execute_command, parsed_command, merge=self._coalesce_queued)
+
+    @staticmethod
+    def _coalesce_queued(pending_args: tuple, new_args: tuple) -> typing.Optional[tuple]:
+        """Merge function for InputExecutor.submit, coalescing the parsed commands in two _execute_command jobs."""
+        merged_command = coalesce_commands(pending_args[0], new_args[0])
+        if merged_command is None:
+            return None
+        return (merged_command,)
+
+    async def process_commands(self, message: TwitchMessage) -> typing.Optional[ParsedCommand]:
+        """Check a Twitch message for command invocations and queue any applicable command.
+
+        Doesn't wait for the command to be executed, use parse_command and submit_command for that.
+        In democracy mode, input commands are counted as a vote instead of being queued.
+        Args:
+            message -- a cmpc.TwitchMessage object
+        Returns:
+            parsed_command -- the command if one was found and queued or voted for, with the future for it being
+                executed if it was queued, otherwise None
         """
-        for valid_inputs, output in self.MOUSE_DRAG_COMMANDS.items():
-            if message.content in valid_inputs:
-                await self.log_to_obs(message)
-                pyautogui.drag(*output, button='left')
-                return True
-        return False
-
-    async def _process_type_commands(self, message: TwitchMessage) -> bool:
-        """Check message for typing commands and run any applicable command.
-
-        Types the message and also calls log_to_obs.
-        Takes a cmpc.TwitchMessage instance.
-        Returns True if a command has been run and False otherwise.
-        This only handles regular typing, not ptype or gtype.
+        parse_start = time.perf_counter_ns()
+        parsed_command = self.parse_command(message)
+        dispatch_start = time.perf_counter_ns()
+        self.metrics.record('parse', parse_start, dispatch_start)
+        if parsed_command is None:
+            return None
+
+        if self.vote_collector is not None and parsed_command.name in self.actions:
+            self.vote_collector.vote(parsed_command, message.username)
+        else:
+            parsed_command.future = self.submit_command(parsed_command)
+        self.metrics.record('dispatch', dispatch_start)
+        return parsed_command
+
+    def start_democracy(self, window_seconds: float = None, on_winner: typing.Callable[..., typing.Any] = None):
+        """Switch to democracy mode, where only the most voted command in each window is executed.
+
+        If already in democracy mode, the new window length is used from the next window.
+        on_winner is called with each winning cmpc.ParsedCommand once it's been queued, e.g. to archive it.
         """
-        for valid_input in self.TYPE_COMMANDS:
-            if message.content.startswith(valid_input):
-                await self.log_to_obs(message)
-                message_to_type = removeprefix(message.original_content, valid_input, case_sensitive=False)
-                pyautogui.typewrite(message_to_type)
-
-                return True
-        return False
-
-    async def _process_hold_key_commands(self, message: TwitchMessage) -> bool:
-        """Check message for key press commands and run any applicable command.
-
-        Holds the key for the duration specified in the message.
-        Duration must be between 0 and 10 seconds or the keypress will not execute.
-        Also calls log_to_obs.
-        Takes a cmpc.TwitchMessage instance.
-        Returns True if a command has been run and False otherwise.
+        if self.vote_collector is not None:
+            if window_seconds is not None:
+                self.vote_collector.window_seconds = window_seconds
+            return
+
+        self.vote_collector = cmpc.democracy.VoteCollector(
+            self.submit_command, show_tally=self.command_logging.log_tally, window_seconds=window_seconds,
+            on_winner=on_winner
+        )
+        asyncio.ensure_future(self.vote_collector.run())
+
+    def stop_democracy(self):
+        """Switch back to anarchy mode, throwing away the votes in the current window."""
+        if self.vote_collector is None:
+            return
+
+        self.vote_collector.stop()
+        self.vote_collector = None
+        self.command_logging.log_nothing_executing()
+
+    def priority_input(self, method_name: str, *args) -> asyncio.Future:
+        """Run an input backend method ahead of every queued chat command, for mod only and !defcon inputs."""
+        return self.input_executor.submit(getattr(self.input_backend, method_name), *args, priority=True)
+
+    def release_holds(self):
+        """Release every held key and mouse button now, and make sure no queued command holds them down again.
+
+        Queued chat commands are cancelled first, since a hold still in the queue would press its key again after
+        the release. Everything is released again once the running job has finished, in case it was a hold.
         """
-        for valid_input, output in self.HOLD_KEY_COMMANDS.items():
-            if message.content.startswith(valid_input):
-                time_value = float(removeprefix(message.content, valid_input))
-                log.debug(f"time_value: {time_value}")
-                log.debug(f"key_to_press: {output}")
-
-                # This command is a lil more complex bc we need to work out what key they actually want to press,
-                # but still nothing impossible
-                log.debug('i am the boss, and i give all the orders')
-                if output is None:
-                    log.debug('no key to press, im having sad cat hours ngl...')
-                    return False
-
-                log.debug('And when we split, we split my way.')
-                if 0.0 < time_value <= 10.0:
-                    log.debug('time was a success')
-                    await self.log_to_obs(message)
-                    hold_key(key=output, time_value=time_value)
-
-                return True
-        return False
-
-    async def _process_misc_commands(self, message: TwitchMessage) -> bool:
-        """Process commands that are either too complicated to dict, or just one-off irregulars.
-
-        Runs the first applicable command and returns.
-        Takes a cmpc.TwitchMessage instance.
-        Returns True if a command has been run and False otherwise.
+        self.input_executor.cancel_pending()
+        self.hold_scheduler.release_all()
+        self.input_executor.submit(self.hold_scheduler.release_all, priority=True)
+
+    def _execute_command(self, parsed_command: ParsedCommand):
+        """Show the command on obs and relay it to discord, then run it. Called on the input executor thread."""
+        message = parsed_command.get_log_message()
+        obs_start = time.perf_counter_ns()
+        self.command_logging.log_executing(message)
+        input_start = time.perf_counter_ns()
+        self.metrics.record('obs_display', obs_start, input_start)
+        asyncio.run_coroutine_threadsafe(self._relay_to_discord(message), self.input_executor.loop)
+
+        try:
+            self.actions[parsed_command.name](parsed_command.message, *parsed_command.args)
+        except Exception as error:
+            asyncio.run_coroutine_threadsafe(self.bot.report_error(error, message), self.input_executor.loop)
+            raise
+        finally:
+            self.metrics.record('input', input_start)
+
+    async def _relay_to_discord(self, message: TwitchMessage):
+        """Send an executed command to the chat relay webhook, recording how long it took."""
+        relay_start = time.perf_counter_ns()
+        await self.command_logging.log_to_discord(message)
+        self.metrics.record('discord_relay', relay_start)
+
+    def _run_key_press_command(self, message: TwitchMessage, key: str):
+        """Press the key for a KEY_PRESS_COMMANDS alias."""
+        self.input_backend.press(key)
+
+    def _run_hotkey_command(self, message: TwitchMessage, *keys: str):
+        """Press the keys for a HOTKEY_COMMANDS alias together."""
+        self.input_backend.hotkey(*keys)
+
+    def _run_click_command(self, message: TwitchMessage, button: str):
+        """Click the mouse button once, or twice if the command is named doubleclick."""
+        click_count = 1
+        if button == 'doubleclick':
+            click_count = 2
+            button = 'left'
+        self.input_backend.click(button=button, clicks=click_count)
+
+    def _run_mouse_hold_command(self, message: TwitchMessage, time_value: float):
+        """Hold the left mouse button for the duration of time associated with the command, without waiting."""
+        self.hold_scheduler.hold_mouse('left', time_value)
+
+    def _run_mouse_scroll_command(self, message: TwitchMessage, amount: int):
+        """Scroll the mouse wheel five times by the amount associated with the command."""
+        for i in range(5):
+            self.input_backend.scroll(amount)
+
+    def _run_mouse_horizontal_scroll_command(self, message: TwitchMessage, amount: int):
+        """Scroll the mouse wheel horizontally five times by the amount associated with the command."""
+        for i in range(5):
+            self.input_backend.hscroll(amount)
+
+    def _run_mouse_move_command(self, message: TwitchMessage, xval: int, yval: int):
+        """Move the mouse by the command's co-ords."""
+        self.input_backend.move(xval, yval)
+
+    def _run_mouse_drag_command(self, message: TwitchMessage, xval: int, yval: int, duration: float):
+        """Move the mouse by the command's co-ords while holding the left mouse button."""
+        self.input_backend.drag(xval, yval, duration, button='left')
+
+    def _run_type_command(self, message: TwitchMessage, message_to_type: str):
+        """Type the message in its original case.
+
+        This only handles regular typing, not ptype or gtype. Characters that don't have a key are skipped.
         """
-        # !modalert command
-        if message.content.startswith('!modalert'):
-            log.info('[MODALERT] called.')
-            # Check cooldown
-            time_since_last_called = time.time() - self.cooldowns['!modalert']['last_called']
-            cooldown_ok = (time_since_last_called > self.cooldowns['!modalert']['required'])
-
-            if cooldown_ok:
-                self.cooldowns['!modalert']['last_called'] = time.time()
-
-                data = {
-                    'embeds': [
-                        {
-                            'title': ':rotating_light: '
-                                     '**The user above needs a moderator on the stream.** '
-                                     ':rotating_light:',
-                            'description': f'Extra info: *{message.content[10:] or "none given"}*'
-                        }
-                    ],
-                    'username': message.username,
-                    'content': f"{self.bot.config['discord']['modalertping']} "
-                               f"https://twitch.tv/{self.bot.config['twitch']['channel_to_join']}",
-                }
-                log.info('[MODALERT] Sending request...')
-                # todo: Move this requests over to cmpc package, so that way we can check if there is even a webhook
-                #  set if not, then log what should have been sent to console.
-                async with aiohttp.ClientSession() as session:
-                    await session.post(self.bot.config['discord']['chatalerts'],
-                                       json=data,
-                                       headers={'User-Agent': self.bot.config['api']['useragent']})
-                log.info('[MODALERT] Request sent')
-                return True
-            else:
-                log.info('[MODALERT] still on cooldown.')
-
-        # 'go to' command
-        if message.content.startswith('go to '):
-            try:
-                xval, yval = parse_goto_args(message, 'go to ')
-            except ValueError:
-                log.error(f'Could not move mouse to location: {message.content} due to non-numeric or not enough args')
-            except OverflowError:
-                log.error(f'Could not move mouse to location: {message.content} due to too large args')
-            else:
-                await self.log_to_obs(message)
-                try:
-                    pyautogui.moveTo(xval, yval, duration=0.11)
-                except pyautogui.PyAutoGUIException:
-                    log.error(f'Could not move mouse to location: {message.content} due to pyautogui issue')
-                else:
-                    return True
+        self.typing_engine.type_text(message_to_type)
 
-        # 'drag to' command
-        if message.content.startswith('drag to '):
-            try:
-                xval, yval = parse_goto_args(message, 'drag to ')
-            except ValueError:
-                log.error(f'Could not drag mouse to location: {message.content} due to non-numeric or not enough args')
-            except OverflowError:
-                log.error(f'Could not move mouse to location: {message.content} due to too large args')
-            else:
-                await self.log_to_obs(message)
-                try:
-                    pyautogui.dragTo(xval, yval, duration=0.11)
-                except pyautogui.PyAutoGUIException:
-                    log.error(f'Could not drag mouse to location: {message.content} due to pyautogui issue')
-                else:
-                    return True
+    def _run_hold_key_command(self, message: TwitchMessage, key: str, time_value: float):
+        """Hold the key for the duration specified in the message, without waiting.
 
-        # gtype command
-        # you don't say?
-        if message.content.startswith('gtype '):
-            if sys.platform == 'darwin':
-                log.error(f'COULD NOT GTYPE: {message.content} '
-                          'DUE TO PLATFORM: darwin')
-                return True
-
-            await self.log_to_obs(message)
-            import pydirectinput
-            message_to_type = removeprefix(message.content, 'gtype ')
-            pydirectinput.typewrite(message_to_type)
-
-            return True
-
-        # uses copy-paste instead of typing emulation
-        if message.content.startswith('ptype '):
-            await self.log_to_obs(message)
-            message_to_type = removeprefix(message.content, 'ptype ')
-
-            try:
-                pyperclip.copy(message_to_type)
-            except pyperclip.PyperclipException:
-                log.error(f'Could not ptype: {message.content}', sys.exc_info())
-            else:
-                pyautogui.hotkey('ctrl', 'v')
-
-            return True
-
-        # multi alt tab for easier app switching
-        multi_alt_tab_match = re.fullmatch(MULTI_ALT_TAB_REGEX, message.content)
-        if multi_alt_tab_match:
-            await self.log_to_obs(message)
-
-            alt_tabs = int(multi_alt_tab_match.group(1))
-            pyautogui.keyDown('altleft')
-            for i in range(alt_tabs):
-                pyautogui.press('tab')
-            pyautogui.keyUp('altleft')
-
-        # multi backspace command
-        multi_backspace_match = re.fullmatch(MULTI_BACKSPACE_REGEX, message.content)
-        if multi_backspace_match:
-            await self.log_to_obs(message)
-
-            backspaces = int(multi_backspace_match.group(1))
-            for i in range(backspaces):
-                pyautogui.press('backspace')
-
-        # No commands run, sad cat hours
-        return False
+        The duration has already been checked to be between 0 and 10 seconds by the parser. The key is held along
+        with anything else that's held, and holding a key that's already held extends the hold.
+        """
+        log.debug(f'time_value: {time_value}')
+        log.debug(f'key_to_press: {key}')
+        self.hold_scheduler.hold_key(key, time_value)
+
+    def _run_program_command(self, message: TwitchMessage, steps: typing.Tuple[typing.Tuple[str, tuple], ...]):
+        """Run each step of a compound program in order, as one command."""
+        for command_name, args in steps:
+            self.actions[command_name](message, *args)
+
+    async def _run_modalert_command(self, message: TwitchMessage, extra_info: str):
+        """Ping the moderators in discord, if the command isn't on cooldown."""
+        log.info('[MODALERT] called.')
+        # Check cooldown
+        time_since_last_called = time.time() - self.cooldowns['!modalert']['last_called']
+        cooldown_ok = (time_since_last_called > self.cooldowns['!modalert']['required'])
+
+        if not cooldown_ok:
+            log.info('[MODALERT] still on cooldown.')
+            return
+
+        self.cooldowns['!modalert']['last_called'] = time.time()
+
+        data = {
+            'embeds': [
+                {
+                    'title': ':rotating_light: '
+                             '**The user above needs a moderator on the stream.** '
+                             ':rotating_light:',
+                    'description': f'Extra info: *{extra_info or "none given"}*'
+                }
+            ],
+            'username': message.username,
+            'content': f"{self.bot.config['discord']['modalertping']} "
+                       f"https://twitch.tv/{self.bot.config['twitch']['channel_to_join']}",
+        }
+        if not self.bot.config['discord']['chatalerts']:
+            log.warning(f'[MODALERT] No chatalerts webhook set, would have sent: {data}')
+            return
+
+        await webhook_dispatcher().send(self.bot.config['discord']['chatalerts'], data)
+        log.info('[MODALERT] Request queued')
+
+    def _run_go_to_command(self, message: TwitchMessage, xval: int, yval: int):
+        """Move the mouse to the co-ords."""
+        try:
+            self.input_backend.move_to(xval, yval, duration=0.11)
+        except InputBackendError:
+            log.error(f'Could not move mouse to location: {message.content} due to input backend issue')
+
+    def _run_drag_to_command(self, message: TwitchMessage, xval: int, yval: int):
+        """Drag the mouse to the co-ords."""
+        try:
+            self.input_backend.drag_to(xval, yval, duration=0.11)
+        except InputBackendError:
+            log.error(f'Could not drag mouse to location: {message.content} due to input backend issue')
+
+    # you don't say?
+    def _run_gtype_command(self, message: TwitchMessage, message_to_type: str):
+        """Type the message in a way that works in games, if the input backend supports it."""
+        if not self.input_backend.game_input:
+            log.error(f'COULD NOT GTYPE: {message.content} '
+                      f'DUE TO INPUT BACKEND: {self.input_backend.name}')
+            return
+
+        self.typing_engine.type_text(message_to_type, game=True)
+
+    def _run_ptype_command(self, message: TwitchMessage, message_to_type: str):
+        """Paste the message using the clipboard instead of typing emulation."""
+        try:
+            self.typing_engine.paste_text(message_to_type)
+        except InputBackendError:
+            log.error(f'Could not ptype: {message.content}', sys.exc_info())
+
+    def _run_multi_alt_tab_command(self, message: TwitchMessage, alt_tabs: int):
+        """Hold alt and press tab alt_tabs times for easier app switching."""
+        self.input_backend.key_down('altleft')
+        self.input_backend.press('tab', presses=alt_tabs)
+        self.input_backend.key_up('altleft')
+
+    def _run_multi_backspace_command(self, message: TwitchMessage, backspaces: int):
+        """Press backspace backspaces times."""
+        self.input_backend.press('backspace', presses=backspaces)
@@ -0,0 +1,154 @@
+"""Democracy mode, where chat votes on commands and only the most popular one is executed.
+
+Classes:
+    VoteCollector -- counts votes for parsed commands over a time window and submits the winner
+"""
+
+import heapq
+import asyncio
+import typing
+import logging as log
+
+from cmpc.twitch_message import TwitchMessage
+from cmpc.load_shedding import CommandDroppedError
+
+
+class VoteCollector:
+    """Collect votes for parsed commands over a time window, then submit the plurality winner.
+
+    Every vote is O(1): the counts are a dict keyed by command name and args, and the leader is updated as votes
+    come in rather than searched for at the end of the window. Each user gets one vote per window.
+    Ties go to the command that reached the winning count first, so the result doesn't depend on dict ordering.
+    The winner's future is kept on it, so a dropped or failed winner is logged rather than lost.
+    Public methods:
+        vote
+        tally_string
+        run
+        stop
+    Instance variables:
+        submit_command -- called with the winning cmpc.ParsedCommand at the end of each window
+        show_tally -- called with the tally string a few times per window, if given
+        on_winner -- called with each winning cmpc.ParsedCommand once its future is set, if given
+        window_seconds -- how long each vote lasts
+        keep_running -- set to False to stop after the current window, use stop to stop straight away
+    """
+
+    def __init__(
+            self, submit_command: typing.Callable, show_tally: typing.Callable[[str], typing.Any] = None,
+            window_seconds: float = None, tally_updates_per_window: int = 4,
+            on_winner: typing.Callable[..., typing.Any] = None
+    ):
+        """Initialise the class attributes."""
+        self.submit_command = submit_command
+        self.show_tally = show_tally
+        self.on_winner = on_winner
+        if window_seconds is None:
+            window_seconds = 2.0
+        self.window_seconds = window_seconds
+        self.tally_updates_per_window = tally_updates_per_window
+        self.keep_running = False
+
+        self._counts = {}
+        self._first_commands = {}
+        self._voters = set()
+        self._leader_key = None
+        self._leader_count = 0
+        self._window_end = 0.0
+        self._stopped = asyncio.Event()
+
+    def vote(self, parsed_command, voter: str) -> bool:
+        """Count a vote for a parsed command. Returns False if the voter has already voted this window."""
+        if voter in self._voters:
+            return False
+        self._voters.add(voter)
+
+        key = (parsed_command.name, parsed_command.args)
+        count = self._counts.get(key, 0) + 1
+        self._counts[key] = count
+        if count == 1:
+            self._first_commands[key] = parsed_command
+        # Strictly greater, so in a tie the command that got there first stays in the lead
+        if count > self._leader_count:
+            self._leader_key = key
+            self._leader_count = count
+        return True
+
+    def tally_string(self, top: int = 3) -> str:
+        """Return a short string of the leading commands and their votes, for showing on obs."""
+        remaining = max(0.0, self._window_end - asyncio.get_event_loop().time())
+        if not self._counts:
+            return f'[Vote {remaining:.1f}s] no votes yet'
+
+        leaders = heapq.nlargest(top, self._counts.items(), key=lambda item: item[1])
+        leaders_string = ' | '.join(
+            f'{self._first_commands[key].message.content} {count}' for key, count in leaders
+        )
+        return f'[Vote {remaining:.1f}s] {leaders_string}'
+
+    def _close_window(self):
+        """Submit the winner of the window that just ended, then reset the counts for the next one."""
+        if self._leader_key is not None:
+            winner = self._first_commands[self._leader_key]
+            votes = self._leader_count
+            log.info(f'[DEMOCRACY] {winner.message.content} won with {votes} of {len(self._voters)} votes.')
+
+            # Attribute it to the vote rather than whoever happened to send it first
+            winner.message = TwitchMessage(winner.message.original_content, f'{votes} votes')
+            winner.future = self.submit_command(winner)
+            winner.future.add_done_callback(self._winner_done)
+            if self.on_winner is not None:
+                self.on_winner(winner)
+
+        self._counts = {}
+        self._first_commands = {}
+        self._voters = set()
+        self._leader_key = None
+        self._leader_count = 0
+
+    @staticmethod
+    def _winner_done(future: asyncio.Future):
+        """Log a winning command that was dropped or failed, nothing else is waiting on its future."""
+        if future.cancelled():
+            log.info('[DEMOCRACY] Winning command was cancelled.')
+        elif isinstance(future.exception(), CommandDroppedError):
+            log.warning(f'[DEMOCRACY] Winning command was dropped: {future.exception()}')
+        elif future.exception() is not None:
+            log.error('[DEMOCRACY] Winning command failed', exc_info=future.exception())
+
+    async def run(self):
+        """Close a window every window_seconds until stopped, showing the tally in between."""
+        loop = asyncio.get_event_loop()
+        self.keep_running = True
+        log.info(f'[DEMOCRACY] Started, voting every {self.window_seconds} seconds.')
+
+        while self.keep_running:
+            self._window_end = loop.time() + self.window_seconds
+            tally_interval = self.window_seconds / self.tally_updates_per_window
+            while True:
+                remaining = self._window_end - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(self._stopped.wait(), min(tally_interval, remaining))
+                except asyncio.TimeoutError:
+                    pass
+                if self._stopped.is_set():
+                    # Return without another tally, it would overwrite whatever stop_democracy showed
+                    log.info('[DEMOCRACY] Stopped.')
+                    return
+                if self.show_tally is not None:
+                    self.show_tally(self.tally_string())
+
+            self._close_window()
+
+        log.info('[DEMOCRACY] Stopped.')
+
+    def stop(self):
+        """Stop straight away, throwing away any votes so far."""
+        self.keep_running = False
+        self._stopped.set()
+        self._counts = {}
+        self._first_commands = {}
+        self._voters = set()
+        self._leader_key = None
+        self._leader_count = 0
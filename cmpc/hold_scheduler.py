@@ -0,0 +1,155 @@
+"""Holds keys and mouse buttons down for a duration without blocking, so holds can overlap into chords.
+
+Classes:
+    HoldScheduler -- presses keys and buttons straight away, and releases them on their deadlines from its own thread
+"""
+
+import time
+import heapq
+import threading
+import typing
+import logging as log
+
+from cmpc.input_backends import InputBackend
+
+
+class HoldScheduler:
+    """Press keys and mouse buttons now, and release them once their deadline has passed.
+
+    Holds that overlap are all down at the same time, e.g. 'w for 2' then 'd for 2' holds both as a chord. Holding
+    something that's already held moves its deadline later if the new hold ends later, instead of stacking.
+    Holds are released by a release thread, started by the first hold, which sleeps until the next deadline. So a
+    release is never held up by a long job running on the cmpc.InputExecutor thread, like typing a long message
+    or a slow drag. Releases are sent while that job is still sending its own input, which the backends' libraries
+    allow, since each input is sent to the system on its own.
+    Every method is thread safe, so release_all can be called straight from the asyncio loop in an emergency.
+    Public methods:
+        hold_key
+        hold_mouse
+        release_due
+        release_all
+        stop
+    Instance variables:
+        input_backend -- the cmpc.InputBackend keys and buttons are pressed and released with
+        held -- list of what's currently held, e.g. ['key w', 'mouse left']
+    """
+
+    KEY = 'key'
+    MOUSE = 'mouse'
+
+    def __init__(self, input_backend: InputBackend, clock: typing.Callable[[], float] = None):
+        """Initialise the class attributes."""
+        self.input_backend = input_backend
+        if clock is None:
+            clock = time.monotonic
+        self._clock = clock
+
+        # (device, button) -> deadline, the source of truth for what's held
+        self._deadlines = {}
+        # (deadline, device, button), entries with a deadline that's since been extended are skipped when popped
+        self._heap = []
+        # Notified when a hold is added, so the release thread can wake up sooner
+        self._condition = threading.Condition(threading.RLock())
+        self._running = False
+        self._thread = None
+
+    @property
+    def held(self) -> typing.List[str]:
+        with self._condition:
+            return [f'{device} {button}' for device, button in self._deadlines]
+
+    def hold_key(self, key: str, seconds: float):
+        """Press the key now if it isn't already held, and release it seconds from now at the earliest."""
+        self._hold(self.KEY, key, seconds)
+
+    def hold_mouse(self, button: str, seconds: float):
+        """Press the mouse button now if it isn't already held, and release it seconds from now at the earliest."""
+        self._hold(self.MOUSE, button, seconds)
+
+    def _hold(self, device: str, button: str, seconds: float):
+        with self._condition:
+            deadline = self._clock() + seconds
+            current_deadline = self._deadlines.get((device, button))
+            if current_deadline is None:
+                self._press(device, button)
+            elif deadline <= current_deadline:
+                return
+            else:
+                log.debug(f'[HOLD] Extended {device} {button} hold by {deadline - current_deadline:.2f}s')
+            self._deadlines[(device, button)] = deadline
+            heapq.heappush(self._heap, (deadline, device, button))
+            self._start()
+            self._condition.notify()
+
+    def release_due(self) -> typing.Optional[float]:
+        """Release everything whose deadline has passed.
+
+        Returns the seconds until the next deadline, or None if nothing is held. Called by the release thread, it
+        only needs calling directly to release holds on time without it, e.g. with a fake clock.
+        """
+        with self._condition:
+            now = self._clock()
+            while self._heap and self._heap[0][0] <= now:
+                deadline, device, button = heapq.heappop(self._heap)
+                if self._deadlines.get((device, button)) == deadline:
+                    del self._deadlines[(device, button)]
+                    self._release(device, button)
+            if not self._heap:
+                return None
+            return max(self._heap[0][0] - now, 0.0)
+
+    def release_all(self):
+        """Release everything that's held straight away, e.g. on suspend, !defcon or shutdown.
+
+        Holds made afterwards still press their key, so cancel queued hold commands first, as
+        cmpc.CommandProcessor.release_holds does.
+        """
+        with self._condition:
+            held = list(self._deadlines)
+            self._deadlines.clear()
+            self._heap.clear()
+            for device, button in held:
+                self._release(device, button)
+        if held:
+            log.info(f'[HOLD] Released {len(held)} held keys and buttons.')
+
+    def stop(self):
+        """Release everything that's held, and stop the release thread until the next hold."""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+            thread = self._thread
+            self._thread = None
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.release_all()
+
+    def _start(self):
+        # Called with the condition held
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(target=self._run, name='HoldScheduler', daemon=True)
+        self._thread.start()
+
+    def _run(self):
+        with self._condition:
+            while self._running:
+                # Wakes up for the next deadline, or when a hold is added, which may end sooner
+                self._condition.wait(self.release_due())
+
+    def _press(self, device: str, button: str):
+        if device == self.KEY:
+            self.input_backend.key_down(button)
+        else:
+            self.input_backend.mouse_down(button=button)
+
+    def _release(self, device: str, button: str):
+        # One failed release mustn't leave everything else held down
+        try:
+            if device == self.KEY:
+                self.input_backend.key_up(button)
+            else:
+                self.input_backend.mouse_up(button=button)
+        except Exception:
+            log.exception(f'[HOLD] Could not release {device} {button}')
@@ -0,0 +1,341 @@
+"""Input backends, so the rest of the script doesn't need to know which library presses the keys.
+
+The backend is resolved once at startup, instead of every input helper checking the platform on every call.
+Classes:
+    InputBackendError -- raised by backends when an input can't be performed
+    InputBackend -- the interface every backend implements
+    PyAutoGUIBackend -- uses pyautogui, the default outside of windows
+    PyDirectInputBackend -- uses pydirectinput where it can, which works in games, the default on windows
+    RecordingBackend -- records every input with a monotonic timestamp without touching a display
+Functions:
+    get_input_backend -- return a backend by name, or the default backend for the platform
+"""
+
+import abc
+import sys
+import time
+import typing
+
+from cmpc.utils import direct_or_auto
+
+
+class InputBackendError(Exception):
+    """Raised by input backends when an input can't be performed, e.g. moving the mouse off the screen."""
+
+
+class InputBackend(abc.ABC):
+    """Interface for sending keyboard and mouse input.
+
+    Key and button names are the ones pyautogui uses. Every method may block until the input is finished, so only
+    call them from the input executor thread. A backend that doesn't implement every abstract method can't be made.
+    Instance variables:
+        name -- the name get_input_backend knows the backend by
+        game_input -- True if game_typewrite uses input that games pick up, instead of falling back to typewrite
+    """
+
+    name = ''
+    game_input = False
+
+    @abc.abstractmethod
+    def press(self, key: str, presses: int = 1):
+        """Press and release a key presses times."""
+
+    @abc.abstractmethod
+    def hotkey(self, *keys: str):
+        """Press keys in order, then release them in reverse order."""
+
+    @abc.abstractmethod
+    def key_down(self, key: str):
+        """Press a key without releasing it."""
+
+    @abc.abstractmethod
+    def key_up(self, key: str):
+        """Release a key."""
+
+    @abc.abstractmethod
+    def click(self, button: str = 'left', clicks: int = 1):
+        """Click a mouse button clicks times."""
+
+    @abc.abstractmethod
+    def mouse_down(self, button: str = 'left'):
+        """Press a mouse button without releasing it."""
+
+    @abc.abstractmethod
+    def mouse_up(self, button: str = 'left'):
+        """Release a mouse button."""
+
+    @abc.abstractmethod
+    def move(self, xval: int, yval: int):
+        """Move the mouse relative to where it is."""
+
+    @abc.abstractmethod
+    def move_to(self, xval: int, yval: int, duration: float = 0.0):
+        """Move the mouse to absolute co-ords. Raises InputBackendError if that isn't possible."""
+
+    @abc.abstractmethod
+    def drag(self, xval: int, yval: int, duration: float = 0.0, button: str = 'left'):
+        """Drag the mouse relative to where it is."""
+
+    @abc.abstractmethod
+    def drag_to(self, xval: int, yval: int, duration: float = 0.0, button: str = 'left'):
+        """Drag the mouse to absolute co-ords. Raises InputBackendError if that isn't possible."""
+
+    @abc.abstractmethod
+    def scroll(self, amount: int):
+        """Scroll vertically, positive amounts scroll up."""
+
+    @abc.abstractmethod
+    def hscroll(self, amount: int):
+        """Scroll horizontally, positive amounts scroll right."""
+
+    @abc.abstractmethod
+    def typewrite(self, text: str, interval: float = 0.0):
+        """Type text one key at a time, waiting interval seconds between keys."""
+
+    def game_typewrite(self, text: str, interval: float = 0.0):
+        """Type text in a way that games pick up, if the backend can."""
+        self.typewrite(text, interval=interval)
+
+    @abc.abstractmethod
+    def paste(self, text: str):
+        """Paste text through the clipboard. Raises InputBackendError if the clipboard isn't available."""
+
+    @abc.abstractmethod
+    def size(self) -> typing.Tuple[int, int]:
+        """Return the screen size in pixels."""
+
+    def sleep(self, seconds: float):
+        """Wait between inputs, e.g. while holding a key down."""
+        time.sleep(seconds)
+
+
+class PyAutoGUIBackend(InputBackend):
+    """Input backend using pyautogui."""
+
+    name = 'auto'
+
+    def __init__(self):
+        """Import pyautogui and work out the platform specific bits once."""
+        import pyautogui
+        import pyperclip
+        pyautogui.FAILSAFE = False
+        self._pyautogui = pyautogui
+        self._pyperclip = pyperclip
+        self._native_hscroll = sys.platform in ['darwin', 'linux']
+        self._paste_hotkey = ('command', 'v') if sys.platform == 'darwin' else ('ctrl', 'v')
+
+    def press(self, key: str, presses: int = 1):
+        self._pyautogui.press(key, presses=presses)
+
+    def hotkey(self, *keys: str):
+        self._pyautogui.hotkey(*keys)
+
+    def key_down(self, key: str):
+        self._pyautogui.keyDown(key)
+
+    def key_up(self, key: str):
+        self._pyautogui.keyUp(key)
+
+    def click(self, button: str = 'left', clicks: int = 1):
+        self._pyautogui.click(button=button, clicks=clicks)
+
+    def mouse_down(self, button: str = 'left'):
+        self._pyautogui.mouseDown(button=button)
+
+    def mouse_up(self, button: str = 'left'):
+        self._pyautogui.mouseUp(button=button)
+
+    def move(self, xval: int, yval: int):
+        self._pyautogui.move(xval, yval)
+
+    def move_to(self, xval: int, yval: int, duration: float = 0.0):
+        try:
+            self._pyautogui.moveTo(xval, yval, duration=duration)
+        except (self._pyautogui.PyAutoGUIException, OverflowError) as error:
+            raise InputBackendError(error) from error
+
+    def drag(self, xval: int, yval: int, duration: float = 0.0, button: str = 'left'):
+        self._pyautogui.drag(xval, yval, duration, button=button)
+
+    def drag_to(self, xval: int, yval: int, duration: float = 0.0, button: str = 'left'):
+        try:
+            self._pyautogui.dragTo(xval, yval, duration=duration, button=button)
+        except (self._pyautogui.PyAutoGUIException, OverflowError) as error:
+            raise InputBackendError(error) from error
+
+    def scroll(self, amount: int):
+        self._pyautogui.scroll(amount)
+
+    def hscroll(self, amount: int):
+        """Scroll horizontally, on windows this holds shift then scrolls vertically."""
+        if self._native_hscroll:
+            self._pyautogui.hscroll(amount)
+        else:
+            self.key_down('shift')
+            self._pyautogui.scroll(amount)
+            self.key_up('shift')
+
+    def typewrite(self, text: str, interval: float = 0.0):
+        self._pyautogui.typewrite(text, interval=interval)
+
+    def paste(self, text: str):
+        try:
+            self._pyperclip.copy(text)
+        except self._pyperclip.PyperclipException as error:
+            raise InputBackendError(error) from error
+        self.hotkey(*self._paste_hotkey)
+
+    def size(self) -> typing.Tuple[int, int]:
+        return tuple(self._pyautogui.size())
+
+
+class PyDirectInputBackend(PyAutoGUIBackend):
+    """Input backend using pydirectinput for the keys and mouse inputs it supports, which games pick up.
+
+    Falls back to pyautogui for everything else, like hotkeys, scrolling and keys pydirectinput doesn't know.
+    """
+
+    name = 'direct'
+    game_input = True
+
+    def __init__(self):
+        """Import pydirectinput as well as pyautogui."""
+        super().__init__()
+        import pydirectinput
+        pydirectinput.FAILSAFE = False
+        self._pydirectinput = pydirectinput
+        self._direct_keys = pydirectinput.KEYBOARD_MAPPING
+
+    def press(self, key: str, presses: int = 1):
+        if key in self._direct_keys:
+            self._pydirectinput.press(key, presses=presses)
+        else:
+            super().press(key, presses=presses)
+
+    def key_down(self, key: str):
+        if key in self._direct_keys:
+            self._pydirectinput.keyDown(key)
+        else:
+            super().key_down(key)
+
+    def key_up(self, key: str):
+        if key in self._direct_keys:
+            self._pydirectinput.keyUp(key)
+        else:
+            super().key_up(key)
+
+    def mouse_down(self, button: str = 'left'):
+        self._pydirectinput.mouseDown(button=button)
+
+    def mouse_up(self, button: str = 'left'):
+        self._pydirectinput.mouseUp(button=button)
+
+    def move(self, xval: int, yval: int):
+        self._pydirectinput.move(xval, yval)
+
+    def game_typewrite(self, text: str, interval: float = 0.0):
+        self._pydirectinput.typewrite(text, interval=interval)
+
+
+class RecordingBackend(InputBackend):
+    """Input backend that records every input in memory and never touches a display.
+
+    For benchmarking and testing the whole command path on a headless machine.
+    Public methods:
+        clear
+    Instance variables:
+        events -- list of (monotonic timestamp, method name, args tuple) for every input, in order
+        screen_size -- what size returns
+        real_sleep -- if True, sleep actually waits, otherwise it's only recorded
+    """
+
+    name = 'recording'
+    game_input = True
+
+    def __init__(self, screen_size: typing.Tuple[int, int] = (1920, 1080), real_sleep: bool = False):
+        """Initialise the class attributes."""
+        self.events = []
+        self.screen_size = screen_size
+        self.real_sleep = real_sleep
+
+    def _record(self, action: str, *args):
+        self.events.append((time.monotonic(), action, args))
+
+    def clear(self):
+        """Forget every recorded event."""
+        self.events = []
+
+    def press(self, key: str, presses: int = 1):
+        self._record('press', key, presses)
+
+    def hotkey(self, *keys: str):
+        self._record('hotkey', *keys)
+
+    def key_down(self, key: str):
+        self._record('key_down', key)
+
+    def key_up(self, key: str):
+        self._record('key_up', key)
+
+    def click(self, button: str = 'left', clicks: int = 1):
+        self._record('click', button, clicks)
+
+    def mouse_down(self, button: str = 'left'):
+        self._record('mouse_down', button)
+
+    def mouse_up(self, button: str = 'left'):
+        self._record('mouse_up', button)
+
+    def move(self, xval: int, yval: int):
+        self._record('move', xval, yval)
+
+    def move_to(self, xval: int, yval: int, duration: float = 0.0):
+        self._record('move_to', xval, yval, duration)
+
+    def drag(self, xval: int, yval: int, duration: float = 0.0, button: str = 'left'):
+        self._record('drag', xval, yval, duration, button)
+
+    def drag_to(self, xval: int, yval: int, duration: float = 0.0, button: str = 'left'):
+        self._record('drag_to', xval, yval, duration, button)
+
+    def scroll(self, amount: int):
+        self._record('scroll', amount)
+
+    def hscroll(self, amount: int):
+        self._record('hscroll', amount)
+
+    def typewrite(self, text: str, interval: float = 0.0):
+        self._record('typewrite', text, interval)
+
+    def game_typewrite(self, text: str, interval: float = 0.0):
+        self._record('game_typewrite', text, interval)
+
+    def paste(self, text: str):
+        self._record('paste', text)
+
+    def size(self) -> typing.Tuple[int, int]:
+        return self.screen_size
+
+    def sleep(self, seconds: float):
+        self._record('sleep', seconds)
+        if self.real_sleep:
+            time.sleep(seconds)
+
+
+INPUT_BACKENDS = {
+    backend.name: backend for backend in (PyAutoGUIBackend, PyDirectInputBackend, RecordingBackend)
+}
+
+
+def get_input_backend(name: str = None) -> InputBackend:
+    """Return a new input backend by name, one of INPUT_BACKENDS.
+
+    If name is None or empty, uses pydirectinput on windows and pyautogui everywhere else.
+    """
+    if not name:
+        name = direct_or_auto()
+    try:
+        backend_class = INPUT_BACKENDS[name]
+    except KeyError:
+        raise ValueError(f'Unknown input backend {name}, expected one of {tuple(INPUT_BACKENDS)}') from None
+    return backend_class()
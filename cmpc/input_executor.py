@@ -0,0 +1,211 @@
+"""Runs input commands on a dedicated thread, so holding keys and sleeping don't block the asyncio loop.
+
+Classes:
+    InputExecutor -- owns the input device and runs jobs from an ordered queue, one at a time
+"""
+
+import time
+import asyncio
+import threading
+import collections
+import typing
+import logging as log
+
+from cmpc.load_shedding import AdmissionController, CommandDroppedError
+from cmpc.metrics import PipelineMetrics
+from cmpc.hold_scheduler import HoldScheduler
+
+
+class InputExecutor:
+    """Run input jobs on a dedicated thread, in the order they were submitted.
+
+    The asyncio loop only enqueues jobs and gets back a future, which is resolved on the loop once the job has run.
+    Priority jobs, like the inputs of !defcon and mod only commands, have their own queue which is always run first,
+    so they never wait behind chat commands. cancel_pending cancels every chat command that's waiting.
+    Public methods:
+        start
+        submit
+        cancel_pending
+        stop
+        stats
+    Instance variables:
+        loop -- the asyncio loop the returned futures belong to
+        on_idle -- called on the executor thread when a job finishes and the queue is empty
+        admission_controller -- cmpc.AdmissionController that bounds the chat command queue, or None for no bound
+        metrics -- cmpc.PipelineMetrics the queue_wait and input_job stages are recorded in, or None
+        hold_scheduler -- cmpc.HoldScheduler whose holds are all released on stop, or None
+        queue_depth -- number of chat command jobs waiting to run, not including the running one or priority jobs
+    """
+
+    def __init__(
+            self, loop: asyncio.AbstractEventLoop = None, on_idle: typing.Callable[[], typing.Any] = None,
+            admission_controller: AdmissionController = None, metrics: PipelineMetrics = None,
+            hold_scheduler: HoldScheduler = None
+    ):
+        """Initialise the class attributes. The thread isn't started until start is called."""
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        self.on_idle = on_idle
+        self.admission_controller = admission_controller
+        self.metrics = metrics
+        self.hold_scheduler = hold_scheduler
+
+        self._queue = collections.deque()
+        self._priority_queue = collections.deque()
+        self._condition = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    def start(self):
+        """Start the executor thread, if it isn't running already."""
+        with self._condition:
+            if self._running:
+                return
+            self._running = True
+        self._thread = threading.Thread(target=self._run, name='InputExecutor', daemon=True)
+        self._thread.start()
+        log.debug('Started input executor thread.')
+
+    def submit(
+            self, job: typing.Callable, *args,
+            merge: typing.Callable[[tuple, tuple], typing.Optional[tuple]] = None, priority: bool = False, **kwargs
+    ) -> asyncio.Future:
+        """Queue job(*args, **kwargs) to run after every job submitted before it.
+
+        Must be called from the loop's thread. Returns an asyncio future for the job's return value, awaiting it is
+        optional. Exceptions raised by the job are logged here and set on the future.
+        If merge is given and the job at the back of the queue is the same job and hasn't started yet,
+        merge(queued_args, args) is called. If it returns new args, the queued job runs once with them instead of
+        both jobs running, and the queued job's future is returned.
+        If the admission controller sheds the job, or a queued job to make room for it, CommandDroppedError is set on
+        the future of the job that was dropped.
+        If priority is True the job runs after the running job and any other priority jobs, before every queued chat
+        command. It's never merged, shed or cancelled by cancel_pending, and isn't counted by the admission
+        controller, which only bounds the chat command queue.
+        """
+        future = self.loop.create_future()
+        # Mark the exception as retrieved, it's already been logged, and most callers never await the future
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+
+        if priority:
+            with self._condition:
+                self._priority_queue.append((job, args, kwargs, future, time.monotonic()))
+                self._condition.notify()
+            return future
+
+        with self._condition:
+            if merge is not None and self._queue:
+                queued_job, queued_args, queued_kwargs, queued_future, queued_at = self._queue[-1]
+                if queued_job == job and queued_kwargs == kwargs:
+                    merged_args = merge(queued_args, args)
+                    if merged_args is not None:
+                        self._queue[-1] = (queued_job, merged_args, queued_kwargs, queued_future, queued_at)
+                        return queued_future
+
+            if self.admission_controller is not None:
+                decision = self.admission_controller.admit(len(self._queue))
+                if decision == AdmissionController.DROP_NEW:
+                    future.set_exception(CommandDroppedError('Input queue is full'))
+                    return future
+                if decision == AdmissionController.DROP_OLDEST and self._queue:
+                    oldest_future = self._queue.popleft()[3]
+                    oldest_future.set_exception(CommandDroppedError('Dropped to make room in the input queue'))
+
+            self._queue.append((job, args, kwargs, future, time.monotonic()))
+            self._condition.notify()
+        return future
+
+    def cancel_pending(self) -> int:
+        """Cancel every queued chat command job, returning how many there were. Must be called from the loop's thread.
+
+        The running job and priority jobs aren't affected.
+        """
+        with self._condition:
+            pending = list(self._queue)
+            self._queue.clear()
+        for job, args, kwargs, future, queued_at in pending:
+            future.cancel()
+        if pending:
+            log.info(f'Cancelled {len(pending)} queued input jobs.')
+        return len(pending)
+
+    def stats(self) -> typing.Dict[str, typing.Union[int, float, str]]:
+        """Return the current queue depths, and the admission controller's drop counts if there is one."""
+        stats = {'queue_depth': len(self._queue), 'priority_queue_depth': len(self._priority_queue)}
+        if self.admission_controller is not None:
+            stats.update(self.admission_controller.stats())
+        return stats
+
+    def stop(self, timeout: float = None):
+        """Stop the executor thread once the jobs already in the queue have run, then release every hold."""
+        with self._condition:
+            self._running = False
+            self._condition.notify()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join(timeout)
+        log.debug('Stopped input executor thread.')
+
+    def _resolve(self, future: asyncio.Future, result: typing.Any = None, exception: BaseException = None):
+        """Set the result or exception of a future from the executor thread."""
+        def set_future():
+            if future.done():
+                # Cancelled by whoever submitted it
+                return
+            if exception is not None:
+                future.set_exception(exception)
+            else:
+                future.set_result(result)
+
+        try:
+            self.loop.call_soon_threadsafe(set_future)
+        except RuntimeError:
+            # The loop has been closed, so nobody can be waiting on the future any more
+            pass
+
+    def _run(self):
+        """Take jobs from the queue and run them until stopped."""
+        while True:
+            with self._condition:
+                if self._priority_queue:
+                    job, args, kwargs, future, queued_at = self._priority_queue.popleft()
+                    priority = True
+                elif self._queue:
+                    job, args, kwargs, future, queued_at = self._queue.popleft()
+                    priority = False
+                elif not self._running:
+                    break
+                else:
+                    self._condition.wait()
+                    continue
+
+            started_at = time.monotonic()
+            if self.metrics is not None:
+                self.metrics.record_duration('queue_wait', started_at - queued_at)
+            try:
+                result = job(*args, **kwargs)
+            except Exception as error:
+                log.exception(f'Error in input executor job {job}')
+                self._resolve(future, exception=error)
+            else:
+                self._resolve(future, result=result)
+
+            finished_at = time.monotonic()
+            if self.metrics is not None:
+                self.metrics.record_duration('input_job', finished_at - started_at)
+            # Only chat commands are admitted, so only they tell the controller how long the queue is taking
+            if self.admission_controller is not None and not priority:
+                self.admission_controller.record_latency(finished_at - queued_at)
+
+            if self.on_idle is not None and not self._queue and not self._priority_queue:
+                try:
+                    self.on_idle()
+                except Exception:
+                    log.exception('Error in input executor on_idle callback')
+
+        if self.hold_scheduler is not None:
+            self.hold_scheduler.stop()
@@ -0,0 +1,127 @@
+"""Admission control for the input queue, so commands don't pile up and execute minutes late during a raid.
+
+Classes:
+    CommandDroppedError -- set on the future of a command that was shed instead of executed
+    AdmissionController -- decides whether a new command is queued, adapting the queue limit to measured latency
+"""
+
+import math
+import time
+import threading
+import typing
+import logging as log
+
+
+class CommandDroppedError(Exception):
+    """Set on the future of a queued command that was dropped by load shedding."""
+
+
+class AdmissionController:
+    """Bounded admission in front of the input queue, with an AIMD controlled queue limit.
+
+    Every executed command reports its end to end latency, from being queued to finishing. While the latency is
+    under the target the queue limit grows additively, by about one per queue limit commands. When it goes over,
+    the limit is halved, at most once per target_latency so one slow burst doesn't collapse it to the minimum.
+    Once the queue is at the limit, the policy decides what happens to new commands:
+        drop-oldest -- drop the oldest queued command that hasn't started, and queue the new one
+        drop-newest -- drop the new command
+        sample -- queue one in every sample_n new commands and drop the rest
+    Public methods:
+        admit
+        record_latency
+        stats
+    Instance variables:
+        policy -- one of POLICIES
+        target_latency -- end to end latency to aim for, in seconds
+        queue_limit -- current queue limit, adjusted between min_queue_limit and max_queue_limit
+    """
+
+    POLICIES = ('drop-oldest', 'drop-newest', 'sample',)
+
+    # Decisions returned by admit
+    ADMIT = 'admit'
+    DROP_NEW = 'drop new'
+    DROP_OLDEST = 'drop oldest'
+
+    def __init__(
+            self, policy: str = None, target_latency: float = None,
+            min_queue_limit: int = 1, max_queue_limit: int = None, sample_n: int = None,
+            decrease_factor: float = 0.5
+    ):
+        """Initialise the class attributes."""
+        if policy is None:
+            policy = 'drop-oldest'
+        if policy not in self.POLICIES:
+            raise ValueError(f'Unknown load shedding policy {policy}, expected one of {self.POLICIES}')
+        self.policy = policy
+
+        if target_latency is None:
+            target_latency = 1.5
+        self.target_latency = target_latency
+        if max_queue_limit is None:
+            max_queue_limit = 50
+        self.min_queue_limit = min_queue_limit
+        self.max_queue_limit = max_queue_limit
+        if sample_n is None:
+            sample_n = 4
+        self.sample_n = sample_n
+        self.decrease_factor = decrease_factor
+
+        self.queue_limit = float(max_queue_limit)
+        self._last_decrease = 0.0
+        self._sample_counter = 0
+        # record_latency is called from the input executor thread
+        self._lock = threading.Lock()
+
+        self.admitted = 0
+        self.dropped_oldest = 0
+        self.dropped_newest = 0
+        self.last_latency = 0.0
+
+    def admit(self, queue_depth: int) -> str:
+        """Decide what to do with a new command, given how many commands are queued. Returns one of the decisions."""
+        if queue_depth < int(self.queue_limit):
+            self._sample_counter = 0
+            self.admitted += 1
+            return self.ADMIT
+
+        if self.policy == 'drop-oldest':
+            self.dropped_oldest += 1
+            self.admitted += 1
+            return self.DROP_OLDEST
+
+        if self.policy == 'sample':
+            self._sample_counter += 1
+            if self._sample_counter >= self.sample_n:
+                # Make room for the sampled command, so the queue stays bounded
+                self._sample_counter = 0
+                self.dropped_oldest += 1
+                self.admitted += 1
+                return self.DROP_OLDEST
+
+        self.dropped_newest += 1
+        return self.DROP_NEW
+
+    def record_latency(self, latency: float):
+        """Adjust the queue limit with the end to end latency of a command that has just been executed."""
+        with self._lock:
+            self.last_latency = latency
+            if latency > self.target_latency:
+                now = time.monotonic()
+                if now - self._last_decrease >= self.target_latency:
+                    self._last_decrease = now
+                    self.queue_limit = max(self.min_queue_limit, self.queue_limit * self.decrease_factor)
+                    log.debug(f'[QUEUE] Latency {latency:.2f}s over target, queue limit now {self.queue_limit:.1f}')
+            else:
+                self.queue_limit = min(self.max_queue_limit, self.queue_limit + 1 / self.queue_limit)
+
+    def stats(self) -> typing.Dict[str, typing.Union[int, float, str]]:
+        """Return the drop counts and current state, for monitoring."""
+        return {
+            'policy': self.policy,
+            'queue_limit': math.floor(self.queue_limit),
+            'admitted': self.admitted,
+            'dropped_oldest': self.dropped_oldest,
+            'dropped_newest': self.dropped_newest,
+            'last_latency': round(self.last_latency, 3),
+        }
@@ -0,0 +1,197 @@
+"""Low overhead latency histograms for each stage of the message pipeline, exported in Prometheus text format.
+
+Classes:
+    LatencyHistogram -- HDR style log-linear histogram of nanosecond latencies
+    PipelineMetrics -- a histogram per pipeline stage plus gauges, periodically written to a metrics file
+"""
+
+import os
+import time
+import asyncio
+import typing
+import logging as log
+from pathlib import Path
+
+
+class LatencyHistogram:
+    """HDR style histogram of latencies in nanoseconds, with about 3% relative precision at every magnitude.
+
+    Values are bucketed by their power of two, then linearly into SUB_BUCKET_COUNT sub buckets within it, so
+    recording is a bit_length, a shift and a list increment. Counts may very occasionally be lost if two threads
+    record into the same histogram at the same moment, which is fine for monitoring.
+    Public methods:
+        record
+        percentile
+        reset
+    Instance variables:
+        count -- number of values recorded
+        total -- sum of the values recorded, in nanoseconds
+    """
+
+    SUB_BUCKET_BITS = 5
+    SUB_BUCKET_COUNT = 1 << SUB_BUCKET_BITS
+
+    __slots__ = ('counts', 'count', 'total',)
+
+    def __init__(self):
+        """Initialise the class attributes."""
+        # Enough buckets for any 64 bit value
+        self.counts = [0] * (64 * self.SUB_BUCKET_COUNT)
+        self.count = 0
+        self.total = 0
+
+    def record(self, value: int):
+        """Record a latency in nanoseconds."""
+        if value < 0:
+            value = 0
+        exponent = value.bit_length() - self.SUB_BUCKET_BITS - 1
+        if exponent < 0:
+            exponent = 0
+        self.counts[(exponent << self.SUB_BUCKET_BITS) + (value >> exponent)] += 1
+        self.count += 1
+        self.total += value
+
+    def _bucket_upper_bound(self, index: int) -> int:
+        if index < 2 * self.SUB_BUCKET_COUNT:
+            return index + 1
+        exponent = (index >> self.SUB_BUCKET_BITS) - 1
+        mantissa = index - (exponent << self.SUB_BUCKET_BITS)
+        return (mantissa + 1) << exponent
+
+    def percentile(self, percent: float) -> int:
+        """Return the upper bound of the bucket containing the given percentile, in nanoseconds."""
+        if not self.count:
+            return 0
+        target = max(1, round(percent / 100 * self.count))
+        seen = 0
+        for index, bucket_count in enumerate(self.counts):
+            seen += bucket_count
+            if seen >= target:
+                return self._bucket_upper_bound(index)
+        return self._bucket_upper_bound(len(self.counts) - 1)
+
+    def reset(self):
+        """Forget every recorded value."""
+        self.counts = [0] * (64 * self.SUB_BUCKET_COUNT)
+        self.count = 0
+        self.total = 0
+
+
+class PipelineMetrics:
+    """Latency histograms for the stages of the message pipeline, and gauges, written out in Prometheus format.
+
+    Stages are timed with time.perf_counter_ns, e.g.
+        start = time.perf_counter_ns()
+        ...
+        metrics.record('dispatch', start)
+    When disabled, record returns straight away, so the only cost left is reading the clock.
+    Public methods:
+        record
+        record_duration
+        add_gauges
+        percentiles
+        prometheus_text
+        write
+        run_flush
+    Instance variables:
+        enabled -- if False nothing is recorded
+        metrics_file -- path the Prometheus text is written to
+        flush_interval -- seconds between writes in run_flush
+        histograms -- dict of stage name to LatencyHistogram
+    """
+
+    QUANTILES = (0.5, 0.95, 0.99,)
+
+    def __init__(
+            self, enabled: bool = True, metrics_file: typing.Union[str, Path] = None, flush_interval: float = None
+    ):
+        """Initialise the class attributes."""
+        self.enabled = enabled
+        if metrics_file is None:
+            metrics_file = Path('logs/metrics.prom')
+        self.metrics_file = Path(metrics_file)
+        if flush_interval is None:
+            flush_interval = 15.0
+        self.flush_interval = flush_interval
+
+        self.histograms = {}
+        self._gauge_sources = []
+        self.keep_running = False
+
+    def record(self, stage: str, start_ns: int, end_ns: int = None):
+        """Record the time a stage took, from start_ns until end_ns or now, both from time.perf_counter_ns."""
+        if not self.enabled:
+            return
+        if end_ns is None:
+            end_ns = time.perf_counter_ns()
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram()
+        histogram.record(end_ns - start_ns)
+
+    def record_duration(self, stage: str, seconds: float):
+        """Record the time a stage took in seconds, for durations that weren't measured with perf_counter_ns."""
+        if not self.enabled:
+            return
+        self.record(stage, 0, int(seconds * 1e9))
+
+    def add_gauges(self, source: typing.Callable[[], typing.Dict[str, typing.Any]], prefix: str):
+        """Add a callable returning a dict of values, the numeric ones are written as gauges named prefix_key."""
+        self._gauge_sources.append((source, prefix))
+
+    def percentiles(self) -> typing.Dict[str, typing.Dict[str, float]]:
+        """Return {stage: {'count', 'p50', 'p95', 'p99'}} with the latencies in seconds."""
+        return {
+            stage: {
+                'count': histogram.count,
+                **{f'p{round(quantile * 100)}': histogram.percentile(quantile * 100) / 1e9
+                   for quantile in self.QUANTILES},
+            }
+            for stage, histogram in self.histograms.items()
+        }
+
+    def prometheus_text(self) -> str:
+        """Return every histogram as a Prometheus summary, and every gauge, in the text exposition format."""
+        lines = [
+            '# HELP cmpc_stage_latency_seconds Time spent in each stage of the message pipeline.',
+            '# TYPE cmpc_stage_latency_seconds summary',
+        ]
+        for stage, histogram in sorted(self.histograms.items()):
+            for quantile in self.QUANTILES:
+                value = histogram.percentile(quantile * 100) / 1e9
+                lines.append(f'cmpc_stage_latency_seconds{{stage="{stage}",quantile="{quantile}"}} {value:.9f}')
+            lines.append(f'cmpc_stage_latency_seconds_sum{{stage="{stage}"}} {histogram.total / 1e9:.9f}')
+            lines.append(f'cmpc_stage_latency_seconds_count{{stage="{stage}"}} {histogram.count}')
+
+        for source, prefix in self._gauge_sources:
+            try:
+                values = source()
+            except Exception:
+                log.exception(f'[METRICS] Could not get gauges for {prefix}')
+                continue
+            for key, value in values.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)):
+                    continue
+                lines.append(f'# TYPE cmpc_{prefix}_{key} gauge')
+                lines.append(f'cmpc_{prefix}_{key} {value}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self):
+        """Write the Prometheus text to the metrics file, atomically so a scraper never reads half of it."""
+        temp_file = self.metrics_file.with_name(self.metrics_file.name + '.tmp')
+        temp_file.write_text(self.prometheus_text(), encoding='utf-8')
+        os.replace(temp_file, self.metrics_file)
+
+    async def run_flush(self):
+        """Write the metrics file every flush_interval seconds until keep_running is set to False."""
+        if not self.enabled:
+            return
+        self.keep_running = True
+        log.info(f'[METRICS] Writing metrics to {self.metrics_file} every {self.flush_interval} seconds.')
+        while self.keep_running:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                self.write()
+            except OSError:
+                log.exception(f'[METRICS] Could not write metrics file {self.metrics_file}')
@@ -1,24 +1,33 @@
 import time
-import sqlite3
+import asyncio
 import typing
 import logging as log
 from pathlib import Path
 from typing import Union
-from asyncio import Lock
 
+import aiohttp
 import twitchio
-from cmpc.utils import send_webhook
+from cmpc.utils import send_webhook, parse_twitch_time, removeprefix
 from cmpc.twitch_message import TwitchMessage
+from cmpc.user_cache import UserCache, UserRecord
+from cmpc.user_db import UserDatabase
+from cmpc.user_lookup import UserLookup
+from cmpc.circuit_breaker import CircuitBreaker, CircuitOpenError
+from cmpc.ban_sync import BanListSync
 
 
 CONFIG_FOLDER = Path('config')
-SCHEMA = {
-    'id': 0,
-    'allow': 1,
-    'allow_after': 2,
-    'notified_ignored': 3,
-}
-db_list_type = typing.List[typing.Tuple[sqlite3.Connection, sqlite3.Cursor]]
+# What get_users raises when twitch, or the connection to it, is having problems
+TWITCH_API_ERRORS = (twitchio.HTTPException, aiohttp.ClientError, asyncio.TimeoutError)
+# USER_DB_MIGRATIONS[n] takes the user info cache database from schema version n to n + 1
+USER_DB_MIGRATIONS = (
+    ('''CREATE TABLE IF NOT EXISTS users
+(id INT PRIMARY KEY, allow BOOL, allow_after FLOAT, notified_ignored BOOL)''',),
+    # allow_after is worked out from this when it's read, unless it's been set by a timeout
+    ('ALTER TABLE users ADD COLUMN account_created FLOAT',),
+    # Where cmpc.BanListSync got to
+    ('CREATE TABLE sync_state (name TEXT PRIMARY KEY, value TEXT)',),
+)
 
 
 class ModTools:
@@ -34,108 +43,313 @@ class ModTools:
             req_account_age_days = 7
         self.req_age_days = req_account_age_days
 
-        self.cache_db_paths = [':memory:', CONFIG_FOLDER / 'user_info_cache.db']
-        self.cache_db_pairs = self.init_dbs()
-        self.db_access_lock = Lock()
+        # Users are looked up in the user cache first, the database is only the persistent tier
+        cache_config = self.bot.config.get('mod_tools', {})
+        self.user_cache = UserCache(max_size=cache_config.get('cache_size'), ttl=cache_config.get('cache_ttl'))
+        # Every sqlite call runs on the database's own thread, with writes committed in batches
+        self.user_db = UserDatabase(
+            CONFIG_FOLDER / 'user_info_cache.db', batch_interval=cache_config.get('db_batch_interval')
+        )
+        # Cache misses are looked up on twitch together, and only once however many messages are waiting on them
+        self.user_lookup = UserLookup(self.fetch_user_records, batch_window=cache_config.get('lookup_window'))
+
+        # While twitch is down, users that aren't cached are allowed or denied by this instead of retrying the api
+        # for every message. Users twitch couldn't tell us about are remembered for a short time.
+        self.allow_unknown_users = cache_config.get('unknown_users', 'deny') == 'allow'
+        self.negative_cache = UserCache(ttl=cache_config.get('negative_cache_ttl', 30))
+        self.twitch_api_breaker = CircuitBreaker(
+            'twitch api', failure_threshold=cache_config.get('api_failure_threshold'),
+            reset_timeout=cache_config.get('api_retry_after'),
+            on_open=self._alert_twitch_api_down, on_close=self._alert_twitch_api_recovered,
+        )
+        # Filled with the channel's chatters by start_cache_warm_up
+        self.warm_up_batch_pause = cache_config.get('warm_up_batch_pause', 0.5)
+        self.warm_up_task = None
+
+        # Copies bans and timeouts made on twitch into the database, started by start_ban_sync
+        self.ban_sync = BanListSync(
+            self.user_db, client_id=self.bot.config['twitch']['api_client_id'],
+            token=removeprefix(self.bot.config['twitch']['oauth_token'], 'oauth:'),
+            base_url=cache_config.get('helix_url'), on_users_changed=self._uncache_users,
+        )
+        self.ban_sync_task = None
+
+        # Queued before anything else, so everything after it runs on the up to date schema
+        self.user_db.migrate(USER_DB_MIGRATIONS).add_done_callback(
+            lambda done: done.cancelled() or done.exception()
+        )
         log.debug('Initialised ModTools object.')
 
-    def init_dbs(self) -> db_list_type:
-        """Return a list of (conn, cur) tuples based off self.cache_db_paths."""
-        conn_cur_pairs = []
-        for db_path in self.cache_db_paths:
-            create_table = False
-            if db_path == ':memory:':
-                create_table = True
-            elif not db_path.is_file():
-                create_table = True
-
-            conn = sqlite3.connect(db_path)
-            cur = conn.cursor()
-
-            if create_table:
-                # todo: add account_created column in case we want to change the age requirement without invalidating
-                #       the cache?
-                cur.execute("""CREATE TABLE users
-(id INT PRIMARY KEY, allow BOOL, allow_after FLOAT, notified_ignored BOOL)""")
-                conn.commit()
-                log.info(f'Initialised user info cache {db_path}')
-            else:
-                log.info(f'Connected to user info cache {db_path}')
-
-            conn_cur_pairs.append((conn, cur))
-
-        return conn_cur_pairs
-
-    async def write_to_dbs(self, sql: str, data: typing.Iterable, db_pairs: db_list_type = None, many: bool = False):
-        """Execute some sql on every cache database."""
-        log.debug(f'Writing to some dbs {sql} {data} {db_pairs if db_pairs is None else len(db_pairs)}')
-        if db_pairs is None:
-            db_pairs = self.cache_db_pairs
+    def write_to_dbs(self, sql: str, data: typing.Iterable = (), many: bool = False) -> asyncio.Future:
+        """Queue some sql to be run on the cache database.
 
-        for conn, cur in db_pairs:
-            if many:
-                cur.executemany(sql, data)
-            else:
-                cur.execute(sql, data)
-            async with self.db_access_lock:
-                conn.commit()
-
-    async def read_from_dbs(self, user_id: int, db_pairs=None):
-        """Iterate through the databases for a result.
+        Returns a future which is set once it's been committed, there's no need to wait for it unless something
+        depends on it being on disk, since reads are run after any writes queued before them.
+        """
+        log.debug(f'Writing to the db {sql} {data}')
+        if many:
+            future = self.user_db.executemany(sql, data)
+        else:
+            future = self.user_db.execute(sql, data)
+        # Errors are logged by the database thread, this just stops asyncio complaining they weren't retrieved
+        future.add_done_callback(lambda done: done.cancelled() or done.exception())
+        return future
+
+    async def read_from_dbs(self, user_id: int) -> typing.Optional[tuple]:
+        """Get a user's row from the cache database, or None if they aren't in it."""
+        log.debug(f'Reading from the db {user_id}')
+        return await self.user_db.fetchone(
+            'SELECT id, allow, allow_after, notified_ignored, account_created FROM users WHERE id=?', (user_id,)
+        )
+
+    def close(self):
+        """Stop warming the user cache and syncing bans, commit any writes that are waiting, and close the database."""
+        for task in (self.warm_up_task, self.ban_sync_task):
+            if task is not None:
+                task.cancel()
+        self.user_db.close()
+
+    def start_ban_sync(self, channel: str, interval: float = 300.0):
+        """Start syncing the channel's bans and timeouts every interval seconds, unless it's already running."""
+        if self.ban_sync_task is None or self.ban_sync_task.done():
+            self.ban_sync_task = asyncio.ensure_future(self._run_ban_sync(channel, interval))
+
+    async def _run_ban_sync(self, channel: str, interval: float):
+        try:
+            api_users = await self.get_twitch_users(channel)
+        except TWITCH_API_ERRORS + (CircuitOpenError,) as error:
+            log.error(f'[BAN SYNC] Could not get the id of {channel}, not syncing bans: {error!r}')
+            return
+        if not api_users:
+            log.error(f'[BAN SYNC] Could not find channel {channel}, not syncing bans.')
+            return
+        await self.ban_sync.run(api_users[0].id, interval)
+
+    def _uncache_users(self, user_ids: typing.Iterable[int]):
+        """Forget users whose rows have been changed in the database, so they're read from it again."""
+        for user_id in user_ids:
+            self.user_cache.discard(user_id)
+            self.negative_cache.discard(user_id)
+
+    async def get_user_record(self, user_id: int) -> typing.Optional[UserRecord]:
+        """Get a user's record from the user cache, or from the databases if it isn't cached, then cache it."""
+        user_id = int(user_id)
+        user_record = self.user_cache.get(user_id)
+        if user_record is None:
+            row = await self.read_from_dbs(user_id)
+            if row is None:
+                return None
+            user_record = UserRecord.from_row(row)
+            self.user_cache.put(user_record)
+        return user_record
+
+    async def get_user_info(self, user_id: int) -> typing.Optional[UserRecord]:
+        """Get info on a twitch user from their user id.
 
-        If we get a result, it's then written to every database on which it wasn't found, to speed up getting
-        that result next time.
+        First searches the cache, and if no result is found it gets the account age from the twitch api
+        and creates a new entry in the cache, then returns that. Returns None if twitch couldn't tell us about them,
+        which is remembered for negative_cache_ttl seconds so the api isn't asked again for every message.
         """
-        log.debug(f'Reading from some dbs {user_id} {db_pairs if db_pairs is None else len(db_pairs)}')
-        if db_pairs is None:
-            db_pairs = self.cache_db_pairs
-
-        for index, pair in enumerate(db_pairs):
-            conn, cur = pair
-            cur.execute('SELECT * FROM users WHERE id=?', (user_id,))
-            response = cur.fetchone()
-            if response:
-                log.debug(f'Cache hit from {conn}')
-                await self.write_to_dbs(
-                    'INSERT INTO users VALUES (?,?,?,?)',
-                    response, db_pairs=self.cache_db_pairs[:index]
+        log.debug(f'Getting user info {user_id}')
+        user_id = int(user_id)
+        user_record = await self.get_user_record(user_id)
+        if user_record is not None:
+            return user_record
+        if self.negative_cache.get(user_id) is not None:
+            return None
+
+        try:
+            user_record = await self.user_lookup.get(user_id)
+        except CircuitOpenError:
+            user_record = None
+        except TWITCH_API_ERRORS as error:
+            # Alerted once per outage by the circuit breaker, not for every message
+            log.warning(f'Failed to get info on user {user_id} from twitch api: {error!r}')
+            user_record = None
+        if user_record is None:
+            self.negative_cache.put(UserRecord(user_id))
+        return user_record
+
+    @property
+    def required_age_seconds(self) -> float:
+        return self.req_age_days * 24 * 60 ** 2
+
+    async def backfill_account_created(self, batch_pause: float = 0.1) -> int:
+        """Store when their account was created for every user cached before it was stored, returning how many.
+
+        Twitch is asked about 100 users per request, with batch_pause seconds between requests. Their allow_after
+        was worked out from it when they were cached, so if it's still within a day of that (it's worked out with
+        the required age now, and used to be in local time) it's cleared, and worked out when it's checked instead.
+        Otherwise it was set by a timeout and it's kept. Anyone not done, e.g. if twitch fails, is done next time.
+        """
+        rows = await self.user_db.fetchall('SELECT id, allow_after FROM users WHERE account_created IS NULL')
+        if not rows:
+            return 0
+        log.info(f'Getting account creation times from twitch for {len(rows)} cached users.')
+        start_time = time.monotonic()
+        backfilled = 0
+        for batch_start in range(0, len(rows), 100):
+            old_allow_afters = dict(rows[batch_start:batch_start + 100])
+            try:
+                api_users = await self.get_twitch_users(*old_allow_afters)
+            except TWITCH_API_ERRORS + (CircuitOpenError,) as error:
+                log.warning(f'Stopped getting account creation times, the rest are done next start: {error!r}')
+                break
+
+            updates = []
+            for api_user_info in api_users:
+                user_id = int(api_user_info.id)
+                account_created = parse_twitch_time(api_user_info.created_at)
+                old_allow_after = old_allow_afters.get(user_id)
+                new_allow_after = old_allow_after
+                if old_allow_after is not None and \
+                        abs(old_allow_after - (account_created + self.required_age_seconds)) < 24 * 60 ** 2:
+                    new_allow_after = None
+                updates.append((account_created, old_allow_after, new_allow_after, user_id))
+                # Read again with account_created next time they're checked
+                self.user_cache.discard(user_id)
+            if updates:
+                # allow_after is only changed if it hasn't been changed since it was read, e.g. by a timeout
+                self.write_to_dbs(
+                    'UPDATE users SET account_created=?, allow_after=CASE WHEN allow_after=? THEN ? '
+                    'ELSE allow_after END WHERE id=?',
+                    updates, many=True
                 )
-                return response
+            backfilled += len(updates)
+            await asyncio.sleep(batch_pause)
+
+        log.info(f'Got account creation times for {backfilled} users in {time.monotonic() - start_time:.1f}s.')
+        return backfilled
+
+    async def get_twitch_users(self, *users: Union[str, int]) -> list:
+        """Call get_users through the circuit breaker, raising CircuitOpenError instead while twitch is failing."""
+        self.twitch_api_breaker.check()
+        try:
+            api_users = await self.bot.get_users(*users)
+        except TWITCH_API_ERRORS:
+            self.twitch_api_breaker.record_failure()
+            raise
+        except BaseException:
+            # Cancelled, or failed in a way that says nothing about twitch, so it mustn't hold the probe forever
+            self.twitch_api_breaker.record_abandoned()
+            raise
+        self.twitch_api_breaker.record_success()
+        return api_users
+
+    def _alert_twitch_api_down(self):
+        unknown_users = 'allowed' if self.allow_unknown_users else 'ignored'
+        send_webhook(
+            self.bot.config['discord']['systemlog'],
+            f'Failed to get info on users from twitch api {self.twitch_api_breaker.failure_threshold} times in a row. '
+            f"New users will be {unknown_users} until it's working again."
+        )
+
+    def _alert_twitch_api_recovered(self, outage_seconds: float, refused: int):
+        send_webhook(
+            self.bot.config['discord']['systemlog'],
+            f'Twitch api is working again after {outage_seconds:.0f} seconds, '
+            f'{refused} user lookups were skipped while it was down.'
+        )
+
+    async def fetch_user_records(self, user_ids: typing.List[int]) -> typing.Dict[int, UserRecord]:
+        """Get up to 100 users from the twitch api in one request, and cache them all with one database write.
+
+        Used by self.user_lookup, which collects the ids of cache misses and makes sure each is only fetched once.
+        """
+        records = {}
+        for api_user_info in await self.get_twitch_users(*user_ids):
+            log.debug(f'User ID {api_user_info.id} created at {api_user_info.created_at}')
+            # The time they're allowed after is worked out from this when it's checked
+            user_record = UserRecord(
+                int(api_user_info.id), account_created=parse_twitch_time(api_user_info.created_at)
+            )
+            self.user_cache.put(user_record)
+            records[user_record.id] = user_record
+
+        self._insert_new_users(records.values())
+        return records
+
+    def _insert_new_users(self, user_records: typing.Iterable[UserRecord]):
+        """Write new users to the database in one go."""
+        rows = [user_record.as_row() for user_record in user_records]
+        if rows:
+            # Ignored if they've been added since they were looked up, e.g. by a ban, so that isn't overwritten
+            self.write_to_dbs(
+                'INSERT OR IGNORE INTO users (id, allow, allow_after, notified_ignored, account_created) '
+                'VALUES (?,?,?,?,?)',
+                rows, many=True
+            )
 
-        log.debug('No cache hit')
-        return None
+    def start_cache_warm_up(self, channel: str):
+        """Start warming the user cache with the channel's chatters, unless it's already being warmed."""
+        if self.warm_up_task is None or self.warm_up_task.done():
+            self.warm_up_task = asyncio.ensure_future(self.warm_up_cache(channel))
 
-    async def get_user_info(self, user_id: int):
-        """Get info on a twitch user from their user id.
+    async def warm_up_cache(self, channel: str, batch_pause: float = None) -> int:
+        """Cache everyone in chat, so their first message doesn't wait on the twitch api. Returns how many.
 
-        First searches the cache databases, and if no result is found it gets the account age from the twitch api
-        and creates a new entry in the databases, then returns that.
+        The chatters list only has usernames, so they're looked up on twitch 100 at a time, with batch_pause seconds
+        between requests to leave room in the rate limit for everything else. Users already in the database are
+        cached from there, so their bans and timeouts are kept, and the rest are added to it.
+        Mods, devs and the bot are skipped, since they aren't checked. Can be cancelled with self.warm_up_task.
         """
-        log.debug(f'Getting user info {user_id}')
-        cache_hit = await self.read_from_dbs(user_id)
-        if cache_hit is not None:
-            return cache_hit
-        else:
-            try:
-                twitch_api_response = await self.bot.get_users(user_id)
-                if not twitch_api_response:
-                    raise twitchio.HTTPException
-                api_user_info = twitch_api_response[0]
-                log.debug(f'User ID {user_id} created at {api_user_info.created_at}')
-            except twitchio.HTTPException:
-                # No luck, no allow
-                send_webhook(self.bot.config['discord']['systemlog'],
-                             f"Failed to get info on user from twitch api.")
-                return False
-            else:
-                # Check the status from the response info, and save it to the cache
-                account_created_string = api_user_info.created_at
-                account_created_seconds = time.mktime(time.strptime(account_created_string, '%Y-%m-%dT%H:%M:%S.%fZ'))
-                # allow_after should be the time in seconds since the epoch after which the user is allowed
-                allow_after_time = account_created_seconds + (self.req_age_days * 24 * 60 ** 2)
+        if batch_pause is None:
+            batch_pause = self.warm_up_batch_pause
+        start_time = time.monotonic()
+        try:
+            chatters = await self.bot.get_chatters(channel)
+        except TWITCH_API_ERRORS:
+            log.error('Unable to get chatters list for channel to warm the user cache.')
+            return 0
+
+        usernames = []
+        for username in chatters.all:
+            user_permissions = self.bot.user_permissions_handler.get(username)
+            if username != self.bot.nick and not (
+                    user_permissions is not None and (user_permissions.moderator or user_permissions.developer)
+            ):
+                usernames.append(username)
+
+        warmed = 0
+        try:
+            for batch_start in range(0, len(usernames), 100):
+                try:
+                    api_users = await self.get_twitch_users(*usernames[batch_start:batch_start + 100])
+                except TWITCH_API_ERRORS + (CircuitOpenError,) as error:
+                    log.warning(f'Stopped warming the user cache: {error!r}')
+                    break
+
+                user_ids = [int(api_user_info.id) for api_user_info in api_users]
+                rows = []
+                if user_ids:
+                    rows = await self.user_db.fetchall(
+                        'SELECT id, allow, allow_after, notified_ignored, account_created FROM users '
+                        f"WHERE id IN ({','.join('?' * len(user_ids))})",
+                        user_ids
+                    )
+                for row in rows:
+                    self.user_cache.put(UserRecord.from_row(row))
+                cached_user_ids = {row[0] for row in rows}
+
+                new_user_records = [
+                    UserRecord(
+                        int(api_user_info.id), account_created=parse_twitch_time(api_user_info.created_at)
+                    )
+                    for api_user_info in api_users if int(api_user_info.id) not in cached_user_ids
+                ]
+                for user_record in new_user_records:
+                    self.user_cache.put(user_record)
+                self._insert_new_users(new_user_records)
+
+                warmed += len(api_users)
+                await asyncio.sleep(batch_pause)
+        except asyncio.CancelledError:
+            log.info(f'Stopped warming the user cache after {warmed} users.')
+            raise
 
-                await self.write_to_dbs('INSERT INTO users(id, allow_after) VALUES (?, ?)', (user_id, allow_after_time))
-                return await self.read_from_dbs(user_id)
+        log.info(f'Warmed the user cache with {warmed} of {len(usernames)} chatters '
+                 f'in {time.monotonic() - start_time:.1f}s.')
+        return warmed
 
     async def notify_ignored_user(self, message: twitchio.Message):
         """Check if a user has been notified they're banned, if they haven't then do it.
@@ -145,10 +359,12 @@ class ModTools:
         Args:
             message -- the twitchio message to get the user id from and to reply to if necessary
         """
-        user_id = message.author.id
-        user_info = await self.read_from_dbs(user_id)
-        # user_info [3] = notified_ignored
-        if not user_info[3]:
+        # Straight after check_user_allowed, so this is the record it just got from the cache
+        user_record = await self.get_user_record(message.author.id)
+        if user_record is None:
+            # The twitch api failed, so there's nothing to say they've been notified
+            return
+        if not user_record.notified_ignored:
             ctx = await self.bot.get_context(message)
             # todo: add custom messages depending on why they were ignored
             # and only send the mod webhook if it was because of account age
@@ -164,21 +380,23 @@ class ModTools:
             )
             log.info('Warned mods about ignored user via webhook.')
 
-            await self.write_to_dbs('UPDATE users SET notified_ignored=? WHERE id=?', (True, user_id))
+            user_record.notified_ignored = True
+            self.write_to_dbs('UPDATE users SET notified_ignored=? WHERE id=?', (True, user_record.id))
 
     async def check_user_allowed(self, user_id: int) -> bool:
         """Return True if a user can run commands and False otherwise.
 
         Gets their info, then checks whether they've been manually allowed or denied first.
         If they haven't been manually allowed or denied, checks the time they're allowed.
+        If twitch couldn't tell us about them, the unknown_users policy decides.
         """
-        user_info: Union[bool, tuple] = await self.get_user_info(user_id)
-        if not user_info:
-            return user_info
-        elif user_info[SCHEMA['allow']] is not None:
-            return user_info[SCHEMA['allow']]
+        user_info = await self.get_user_info(user_id)
+        if user_info is None:
+            return self.allow_unknown_users
+        elif user_info.allow is not None:
+            return user_info.allow
         else:
-            return user_info[SCHEMA['allow_after']] < time.time()
+            return user_info.allowed_after(self.required_age_seconds) < time.time()
 
     # todo: return True or False?
     async def process_commands(self, twitch_message: TwitchMessage):
@@ -229,21 +447,22 @@ class ModTools:
                 return
 
             try:
-                twitch_api_response = await self.bot.get_users(user_name)
+                twitch_api_response = await self.get_twitch_users(user_name)
                 if not twitch_api_response:
                     raise twitchio.errors.HTTPException
                 user_id = int(twitch_api_response[0].id)
-            except twitchio.errors.HTTPException:
+            except TWITCH_API_ERRORS + (CircuitOpenError,):
                 log.error(f'Unable to unban/ban user {user_name} - user not found!')
             else:
-                current_user_info = await self.get_user_info(user_id)
-                new_user_info = list(current_user_info)
+                user_record = await self.get_user_info(user_id)
+                if not user_record:
+                    log.error(f'Unable to unban/ban user {user_name} - could not get their info from twitch!')
+                    return
+                # The cached record is updated in place, so the change applies to their next message
                 for key, value in set_states:
-                    new_user_info[SCHEMA[key]] = value
-                new_user_info.append(user_id)
-                new_user_info.pop(0)
+                    setattr(user_record, key, value)
 
                 await self.write_to_dbs(
                     'UPDATE users SET allow=?, allow_after=?, notified_ignored=? WHERE id=?',
-                    new_user_info
+                    (user_record.allow, user_record.allow_after, user_record.notified_ignored, user_record.id)
                 )
@@ -0,0 +1,203 @@
+"""Asyncio client for the obs websocket plugin (protocol 4.x), which reconnects on its own.
+
+Classes:
+    ObsWebsocketError -- raised when a request can't be sent, times out, or obs answers with an error
+    ObsWebsocketClient -- keeps a connection to obs open and sends requests over it
+"""
+
+import time
+import base64
+import random
+import asyncio
+import hashlib
+import itertools
+import typing
+import logging as log
+
+import aiohttp
+
+from cmpc.metrics import PipelineMetrics
+
+
+class ObsWebsocketError(Exception):
+    """Raised when a request to obs can't be sent, times out, or obs answers with an error."""
+
+
+class ObsWebsocketClient:
+    """Keep a websocket connection to obs open, reconnecting with exponential backoff whenever it drops.
+
+    Requests are pipelined: each one is sent straight away with its own message id, and its response is matched
+    back to it by a reader task, so a slow response doesn't hold up other requests.
+    Public methods:
+        run
+        call
+        stop
+        stats
+    Instance variables:
+        url -- the websocket url, e.g. ws://localhost:4444
+        password -- the obs websocket password, or None if it doesn't need one
+        on_connect -- coroutine function awaited every time the client connects, e.g. to check a source exists
+        metrics -- cmpc.PipelineMetrics the obs_websocket_call stage is recorded in
+        connected -- True while connected and authenticated
+        reconnects -- number of times the connection has been made again after dropping
+    """
+
+    def __init__(
+            self, host: str = None, port: int = None, password: str = None,
+            on_connect: typing.Callable[[], typing.Awaitable] = None, metrics: PipelineMetrics = None,
+            min_backoff: float = None, max_backoff: float = None, request_timeout: float = None
+    ):
+        """Initialise the class attributes. Nothing is connected until run is started."""
+        if host is None:
+            host = 'localhost'
+        if port is None:
+            port = 4444
+        self.url = f'ws://{host}:{port}'
+        self.password = password or None
+        self.on_connect = on_connect
+        if metrics is None:
+            metrics = PipelineMetrics(enabled=False)
+        self.metrics = metrics
+        if min_backoff is None:
+            min_backoff = 0.5
+        self.min_backoff = min_backoff
+        if max_backoff is None:
+            max_backoff = 30.0
+        self.max_backoff = max_backoff
+        if request_timeout is None:
+            request_timeout = 2.0
+        self.request_timeout = request_timeout
+
+        self.connected = False
+        self.keep_running = False
+        self.reconnects = 0
+        self._requests = 0
+        self._failed_requests = 0
+        self._last_latency = 0.0
+        self._websocket = None
+        self._message_ids = itertools.count(1)
+        # message id -> future for the response
+        self._pending = {}
+
+    async def run(self):
+        """Connect, and reconnect whenever the connection drops, until stop is called."""
+        self.keep_running = True
+        backoff = self.min_backoff
+        has_connected = False
+        async with aiohttp.ClientSession() as session:
+            while self.keep_running:
+                try:
+                    async with session.ws_connect(self.url, heartbeat=10.0) as websocket:
+                        self._websocket = websocket
+                        reader = asyncio.ensure_future(self._read(websocket))
+                        try:
+                            await self._authenticate()
+                            self.connected = True
+                            if has_connected:
+                                self.reconnects += 1
+                            has_connected = True
+                            backoff = self.min_backoff
+                            log.info(f'[OBS] Connected to obs websocket at {self.url}')
+                            if self.on_connect is not None:
+                                await self.on_connect()
+                            await reader
+                        finally:
+                            reader.cancel()
+                            self._disconnected()
+                    log.warning('[OBS] Lost connection to obs websocket.')
+                except (aiohttp.ClientError, OSError, ObsWebsocketError) as error:
+                    log.debug(f'[OBS] Could not connect to obs websocket at {self.url}: {error!r}')
+
+                if not self.keep_running:
+                    break
+                # Jitter so a restarted obs isn't hit by every retry at the same moment
+                await asyncio.sleep(backoff * random.uniform(0.5, 1.0))
+                backoff = min(backoff * 2, self.max_backoff)
+
+    async def call(self, request_type: str, **fields) -> dict:
+        """Send a request to obs and return its response.
+
+        Raises ObsWebsocketError if not connected, if obs doesn't answer within request_timeout,
+        or if it answers with an error.
+        """
+        if not self.connected:
+            raise ObsWebsocketError('Not connected to obs websocket')
+        return await self._request(request_type, fields)
+
+    def stop(self):
+        """Close the connection and stop reconnecting."""
+        self.keep_running = False
+        if self._websocket is not None:
+            asyncio.ensure_future(self._websocket.close())
+
+    def stats(self) -> typing.Dict[str, typing.Union[int, float]]:
+        """Return whether it's connected, the reconnect and request counts, and the last request's latency."""
+        return {
+            'connected': int(self.connected),
+            'reconnects': self.reconnects,
+            'requests': self._requests,
+            'failed_requests': self._failed_requests,
+            'last_latency': round(self._last_latency, 6),
+        }
+
+    async def _request(self, request_type: str, fields: dict) -> dict:
+        if self._websocket is None:
+            raise ObsWebsocketError('Not connected to obs websocket')
+
+        message_id = str(next(self._message_ids))
+        future = asyncio.get_event_loop().create_future()
+        self._pending[message_id] = future
+        self._requests += 1
+        start = time.perf_counter_ns()
+        try:
+            await self._websocket.send_json({'request-type': request_type, 'message-id': message_id, **fields})
+            response = await asyncio.wait_for(future, self.request_timeout)
+        except (aiohttp.ClientError, ConnectionError, RuntimeError, asyncio.TimeoutError) as error:
+            self._failed_requests += 1
+            raise ObsWebsocketError(f'{request_type} failed: {error!r}') from error
+        except ObsWebsocketError:
+            self._failed_requests += 1
+            raise
+        finally:
+            self._pending.pop(message_id, None)
+
+        end = time.perf_counter_ns()
+        self._last_latency = (end - start) / 1e9
+        self.metrics.record('obs_websocket_call', start, end)
+        if response.get('status') != 'ok':
+            self._failed_requests += 1
+            raise ObsWebsocketError(f"{request_type} failed: {response.get('error', 'unknown error')}")
+        return response
+
+    async def _authenticate(self):
+        auth_info = await self._request('GetAuthRequired', {})
+        if not auth_info.get('authRequired'):
+            return
+        if self.password is None:
+            raise ObsWebsocketError('Obs websocket needs a password, but none was given')
+
+        secret = base64.b64encode(hashlib.sha256((self.password + auth_info['salt']).encode()).digest())
+        auth = base64.b64encode(hashlib.sha256(secret + auth_info['challenge'].encode()).digest()).decode()
+        await self._request('Authenticate', {'auth': auth})
+
+    async def _read(self, websocket: aiohttp.ClientWebSocketResponse):
+        """Match responses to their requests until the connection closes. Events from obs are ignored."""
+        async for websocket_message in websocket:
+            if websocket_message.type != aiohttp.WSMsgType.TEXT:
+                continue
+            try:
+                data = websocket_message.json()
+            except ValueError:
+                log.warning(f'[OBS] Got a message that is not json: {websocket_message.data!r}')
+                continue
+            future = self._pending.get(data.get('message-id'))
+            if future is not None and not future.done():
+                future.set_result(data)
+
+    def _disconnected(self):
+        self.connected = False
+        self._websocket = None
+        for future in self._pending.values():
+            if not future.done():
+                future.set_exception(ObsWebsocketError('Connection to obs websocket closed'))
+        self._pending.clear()
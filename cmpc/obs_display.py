@@ -0,0 +1,134 @@
+"""Shows text on obs without blocking whoever sets it.
+
+Classes:
+    ObsDisplay -- keeps only the latest text, and writes it to obs at a capped rate, holding text so it's readable
+"""
+
+import os
+import asyncio
+import threading
+import typing
+import logging as log
+from pathlib import Path
+
+
+class ObsDisplay:
+    """Write the latest text to obs from a task on the asyncio loop, at most max_flush_rate times a second.
+
+    show can be called from any thread and never blocks. Text that's replaced before it's written is never shown,
+    and text that's the same as what's on obs isn't written again. Text can be held for a while, so later text
+    waits until the held text has been readable for long enough, instead of anyone sleeping.
+    Text shown without a hold, like 'nothing' once the input queue is empty, never replaces held text that hasn't
+    been written yet, it's written after it instead. So every command that's the latest when obs is written shows.
+    If write is a coroutine function it's awaited, otherwise it's blocking, so it's run in the default executor.
+    Public methods:
+        show
+        refresh
+        run
+        stop
+        write_file_atomic
+    Instance variables:
+        write -- function that puts text on obs
+        loop -- the asyncio loop run is scheduled on
+        min_interval -- the least seconds between two writes
+        written_text -- the text that's on obs now, or None if nothing has been written yet
+    """
+
+    def __init__(
+            self, write: typing.Callable[[str], typing.Any], loop: asyncio.AbstractEventLoop = None,
+            max_flush_rate: float = None
+    ):
+        """Initialise the class attributes."""
+        self.write = write
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        if max_flush_rate is None:
+            max_flush_rate = 10.0
+        self.min_interval = 1.0 / max_flush_rate
+
+        self.written_text = None
+        self.keep_running = False
+        # (text, hold) waiting to be written, only the latest is kept
+        self._pending = None
+        # Text without a hold that was shown while held text was pending, written after it
+        self._pending_after = None
+        self._pending_lock = threading.Lock()
+        self._wake = asyncio.Event()
+
+    def show(self, text: str, hold: float = 0.0):
+        """Show text on obs as soon as the rate limit and any held text allow, then keep it there for hold seconds.
+
+        Thread safe, returns straight away.
+        """
+        with self._pending_lock:
+            if not hold and self._pending is not None and self._pending[1]:
+                self._pending_after = text
+            else:
+                self._pending = (text, hold)
+                self._pending_after = None
+        try:
+            self.loop.call_soon_threadsafe(self._wake.set)
+        except RuntimeError:
+            # The loop has been closed, there's nothing left to show anything
+            pass
+
+    def refresh(self):
+        """Write the text that's on obs again, e.g. after obs has reconnected."""
+        if self.written_text is None:
+            return
+        text, self.written_text = self.written_text, None
+        with self._pending_lock:
+            if self._pending is None:
+                self._pending = (text, 0.0)
+        self.loop.call_soon_threadsafe(self._wake.set)
+
+    async def run(self):
+        """Write pending text until stop is called."""
+        self.keep_running = True
+        next_write = 0.0
+        while self.keep_running:
+            await self._wake.wait()
+            self._wake.clear()
+
+            delay = next_write - self.loop.time()
+            if delay > 0:
+                # Anything shown meanwhile replaces the pending text, so only the latest gets written
+                await asyncio.sleep(delay)
+
+            with self._pending_lock:
+                pending, self._pending = self._pending, None
+                if self._pending_after is not None:
+                    self._pending = (self._pending_after, 0.0)
+                    self._pending_after = None
+                    # Written once this text's hold is over
+                    self._wake.set()
+            if pending is None:
+                continue
+            text, hold = pending
+
+            if text != self.written_text:
+                try:
+                    if asyncio.iscoroutinefunction(self.write):
+                        await self.write(text)
+                    else:
+                        await self.loop.run_in_executor(None, self.write, text)
+                except Exception:
+                    log.exception(f'[OBS] Could not show on obs: {text}')
+                else:
+                    self.written_text = text
+            next_write = self.loop.time() + max(self.min_interval, hold)
+
+    def stop(self):
+        """Stop run after its next wake up, without writing anything else."""
+        self.keep_running = False
+        self.loop.call_soon_threadsafe(self._wake.set)
+
+    @staticmethod
+    def write_file_atomic(path: typing.Union[str, Path], text: str):
+        """Replace a file's contents in one go, so obs never reads a half written file."""
+        path = Path(path)
+        temp_path = path.with_name(path.name + '.tmp')
+        with open(temp_path, 'w', encoding='utf-8') as temp_file:
+            temp_file.write(text)
+        os.replace(temp_path, path)
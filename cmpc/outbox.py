@@ -0,0 +1,196 @@
+"""Durable outbox for discord webhook messages, so messages survive failed requests and restarts.
+
+Classes:
+    WebhookOutbox -- spools messages to an append only file, and delivers them in the background with retries
+"""
+
+import os
+import time
+import json
+import uuid
+import asyncio
+import collections
+import concurrent.futures
+import typing
+import logging as log
+from pathlib import Path
+
+from cmpc.webhook_dispatcher import WebhookDispatcher
+
+
+class WebhookOutbox:
+    """Queue webhook messages without waiting, and keep trying to deliver them until discord takes them.
+
+    Every message is appended to the spool file before it's sent, and a done record is appended once discord has
+    taken it (or rejected it, since sending it again won't help). Messages without a done record are sent again by
+    replay_spool on the next start, so messages queued just before a crash or sys.exit still get sent.
+    The spool is emptied whenever everything in it has been delivered, so it only grows while discord is down.
+    Spool writes are made in order on a writer thread, which keeps the file open, so send never waits on the disk.
+    Public methods:
+        send
+        flush
+        replay_spool
+        stats
+    Instance variables:
+        dispatcher -- cmpc.WebhookDispatcher the messages are posted with
+        spool_path -- path of the append only spool file
+        max_attempts -- deliveries tried before a message is left for the next start
+        max_retry_delay -- the longest wait between deliveries, they start at 2 seconds and double
+    """
+
+    def __init__(
+            self, dispatcher: WebhookDispatcher, spool_path: typing.Union[str, Path] = None,
+            max_attempts: int = None, max_retry_delay: float = None
+    ):
+        """Initialise the class attributes."""
+        self.dispatcher = dispatcher
+        if spool_path is None:
+            spool_path = Path('logs/webhook_outbox.jsonl')
+        self.spool_path = Path(spool_path)
+        if max_attempts is None:
+            max_attempts = 10
+        self.max_attempts = max_attempts
+        if max_retry_delay is None:
+            max_retry_delay = 300.0
+        self.max_retry_delay = max_retry_delay
+
+        # ids of messages in the spool that haven't been delivered yet
+        self._undelivered = set()
+        self._counts = collections.Counter()
+        # Only used on the writer thread
+        self._spool_file = None
+        self._writer = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix='WebhookOutbox')
+
+    def send(self, url: str, payload: dict):
+        """Spool a message and queue it to be delivered, without waiting for either."""
+        if not url:
+            return
+        message_id = uuid.uuid4().hex
+        spooled = self._writer.submit(self._append, {'id': message_id, 'url': url, 'payload': payload})
+        self._undelivered.add(message_id)
+        self._counts['queued'] += 1
+        asyncio.ensure_future(self._deliver(message_id, url, payload, spooled))
+
+    def flush(self, timeout: float = 5.0) -> bool:
+        """Deliver everything that's undelivered before returning, for when the loop won't run again, e.g. sys.exit.
+
+        Runs the loop until every message has been delivered or timeout seconds have passed, so it can't be called
+        while the loop is running. Returns True if everything was delivered, what's left is sent on the next start.
+        """
+        loop = asyncio.get_event_loop()
+        if loop.is_running():
+            raise RuntimeError('WebhookOutbox.flush can only be called while the loop is not running')
+
+        deadline = time.monotonic() + timeout
+
+        async def wait_for_deliveries():
+            while self._undelivered and time.monotonic() < deadline:
+                await asyncio.sleep(0.05)
+
+        loop.run_until_complete(wait_for_deliveries())
+        # Let the done records reach the spool
+        self._writer.submit(self._sync_spool).result()
+        return not self._undelivered
+
+    def replay_spool(self):
+        """Queue every message that wasn't delivered before the last exit, and compact the spool down to them.
+
+        Call it once on start, before anything is sent.
+        """
+        try:
+            with open(self.spool_path, encoding='utf-8') as spool_file:
+                lines = spool_file.readlines()
+        except FileNotFoundError:
+            return
+
+        messages = {}
+        for line in lines:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                # Most likely a line cut short by a crash
+                log.warning(f'[OUTBOX] Skipping unreadable spool line: {line!r}')
+                continue
+            if record.get('done'):
+                messages.pop(record['id'], None)
+            else:
+                messages[record['id']] = record
+
+        with open(self.spool_path, 'w', encoding='utf-8') as spool_file:
+            for record in messages.values():
+                spool_file.write(json.dumps(record) + '\n')
+        if not messages:
+            return
+
+        log.info(f'[OUTBOX] Sending {len(messages)} webhook messages left over from the last run.')
+        for message_id, record in messages.items():
+            self._undelivered.add(message_id)
+            self._counts['replayed'] += 1
+            asyncio.ensure_future(self._deliver(message_id, record['url'], record['payload']))
+
+    def stats(self) -> typing.Dict[str, int]:
+        """Return how many messages are undelivered, and how many have been queued, replayed, retried and sent."""
+        stats = {key: self._counts[key] for key in ('queued', 'replayed', 'delivered', 'retries', 'given_up')}
+        stats['undelivered'] = len(self._undelivered)
+        return stats
+
+    async def _deliver(
+            self, message_id: str, url: str, payload: dict, spooled: concurrent.futures.Future = None
+    ):
+        if spooled is not None:
+            # Not sent until it's in the spool, so it can't be sent and then missed by the spool
+            await asyncio.wrap_future(spooled)
+        for attempt in range(1, self.max_attempts + 1):
+            status = await self.dispatcher.send_nowait(url, payload)
+            if status != WebhookDispatcher.FAILED:
+                self._counts['delivered' if status == WebhookDispatcher.SENT else 'given_up'] += 1
+                self._mark_done(message_id)
+                return
+            if attempt < self.max_attempts:
+                self._counts['retries'] += 1
+                await asyncio.sleep(min(2.0 ** attempt, self.max_retry_delay))
+
+        # Left in the spool, so it's tried again on the next start
+        self._counts['given_up'] += 1
+        log.error(f'[OUTBOX] Could not deliver webhook message after {self.max_attempts} tries, '
+                  'it will be sent again on the next start.')
+
+    def _mark_done(self, message_id: str):
+        self._undelivered.discard(message_id)
+        if self._undelivered:
+            self._writer.submit(self._append, {'id': message_id, 'done': True})
+        else:
+            # Nothing's waiting, so there's no need to keep any of the spool
+            self._writer.submit(self._empty_spool)
+
+    def _append(self, record: dict):
+        """Append a record to the spool. Only called on the writer thread."""
+        try:
+            if self._spool_file is None:
+                self.spool_path.parent.mkdir(parents=True, exist_ok=True)
+                self._spool_file = open(self.spool_path, 'a', encoding='utf-8')
+            self._spool_file.write(json.dumps(record) + '\n')
+            self._spool_file.flush()
+        except OSError:
+            # Still deliver it, it just won't survive a restart
+            log.exception(f'[OUTBOX] Could not write to spool file {self.spool_path}')
+
+    def _empty_spool(self):
+        """Truncate the spool. Only called on the writer thread."""
+        try:
+            if self._spool_file is None:
+                open(self.spool_path, 'w').close()
+            else:
+                self._spool_file.seek(0)
+                self._spool_file.truncate()
+        except OSError:
+            log.exception(f'[OUTBOX] Could not empty spool file {self.spool_path}')
+
+    def _sync_spool(self):
+        """Make sure what's been written to the spool is on disk. Only called on the writer thread."""
+        if self._spool_file is None:
+            return
+        try:
+            os.fsync(self._spool_file.fileno())
+        except OSError:
+            log.exception(f'[OUTBOX] Could not sync spool file {self.spool_path}')
@@ -0,0 +1,196 @@
+"""Replays a recorded chat log through the message pipeline, for benchmarking.
+
+Each line of the chat log is either 'content (user)', or '<unix time>\tcontent (user)' which lets it be replayed at its
+original timing. Messages are sent with mocked authors the same way the offline mode script tester does it.
+Classes:
+    ChatReplay -- feeds recorded messages to the message callback and reports throughput and latency
+Functions:
+    read_chat_log -- parse a chat log file into (timestamp, content, username) tuples
+    percentile -- nearest rank percentile of a sorted list
+"""
+
+import time
+import gzip
+import zlib
+import asyncio
+import typing
+import logging as log
+from pathlib import Path
+
+from cmpc.script_tester import MockUser, MockMessage
+from cmpc.load_shedding import CommandDroppedError
+
+
+replay_message_type = typing.Tuple[typing.Optional[float], str, str]
+
+
+def read_chat_log(path: typing.Union[str, Path]) -> typing.List[replay_message_type]:
+    """Parse a chat log file, or a gzipped rotated segment, into a list of (timestamp or None, content, username)."""
+    messages = []
+    open_function = gzip.open if str(path).endswith('.gz') else open
+    with open_function(path, 'rt', encoding='utf-8') as chat_log:
+        for line in chat_log:
+            line = line.rstrip('\n')
+            timestamp = None
+            if '\t' in line:
+                timestamp_string, line = line.split('\t', 1)
+                try:
+                    timestamp = float(timestamp_string)
+                except ValueError:
+                    line = f'{timestamp_string}\t{line}'
+
+            # Twitch usernames can't contain spaces or brackets, so the last ' (' always starts the username
+            content, separator, username = line.rpartition(' (')
+            if not separator or not username.endswith(')'):
+                log.debug(f'[REPLAY] Skipping unparseable chat log line: {line}')
+                continue
+            messages.append((timestamp, content, username[:-1]))
+    return messages
+
+
+def percentile(sorted_values: typing.Sequence[float], percent: float) -> float:
+    """Return the nearest rank percentile of an already sorted sequence, or 0.0 if it's empty."""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, round(percent / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+
+class ChatReplay:
+    """Feed recorded chat messages through the message callback, and measure how the pipeline copes.
+
+    Public methods:
+        run
+        format_report
+    Instance variables:
+        message_callback -- the unbound event_message to send mock messages to, as with cmpc.ScriptTester
+        bot -- the TwitchPlays instance to pass as self to message_callback
+        messages -- list of (timestamp, content, username) tuples, as returned by read_chat_log
+        speed -- 1.0 replays at the original timing, 10.0 ten times faster, 0 as fast as possible
+        default_interval -- seconds between messages at speed 1.0, for lines without a timestamp
+    """
+
+    def __init__(
+            self, message_callback: typing.Callable, bot, messages: typing.List[replay_message_type],
+            speed: float = 0.0, default_interval: float = 0.5
+    ):
+        """Initialise the class attributes."""
+        self.message_callback = message_callback
+        self.bot = bot
+        self.messages = messages
+        self.speed = speed
+        self.default_interval = default_interval
+
+        self._stage_latencies = {}
+        self._command_futures = set()
+        self._submitted_commands = 0
+        self._dropped_commands = 0
+
+    def _record(self, stage: str, seconds: float):
+        self._stage_latencies.setdefault(stage, []).append(seconds)
+
+    def _wrap_submit_command(self):
+        """Wrap the processor's submit_command to time every command from being queued to being executed."""
+        processor = self.bot.processor
+        submit_command = processor.submit_command
+
+        def timed_submit_command(parsed_command):
+            submitted_at = time.perf_counter()
+            future = submit_command(parsed_command)
+            self._submitted_commands += 1
+            if future in self._command_futures:
+                # Coalesced into a command that's already queued and timed
+                return future
+
+            def command_done(done: asyncio.Future):
+                if not done.cancelled() and isinstance(done.exception(), CommandDroppedError):
+                    self._dropped_commands += 1
+                else:
+                    self._record('queued_to_executed', time.perf_counter() - submitted_at)
+
+            future.add_done_callback(command_done)
+            self._command_futures.add(future)
+            return future
+
+        processor.submit_command = timed_submit_command
+        return submit_command
+
+    def _mock_message(self, content: str, username: str) -> MockMessage:
+        # event_message ignores messages from authors without an id, so give everyone a stable non-zero one
+        user_id = zlib.crc32(username.encode('utf-8')) or 1
+        return MockMessage(MockUser(username, user_id), content)
+
+    async def run(self) -> dict:
+        """Replay every message, wait for the queued commands to execute, then return the report dict."""
+        loop = asyncio.get_event_loop()
+        original_submit_command = self._wrap_submit_command()
+        try:
+            first_timestamp = None
+            replay_start = loop.time()
+            wall_start = time.perf_counter()
+
+            for index, (timestamp, content, username) in enumerate(self.messages):
+                if self.speed > 0:
+                    if timestamp is None:
+                        offset = index * self.default_interval
+                    else:
+                        if first_timestamp is None:
+                            first_timestamp = timestamp
+                        offset = timestamp - first_timestamp
+                    delay = replay_start + offset / self.speed - loop.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
+                message = self._mock_message(content, username)
+                handler_start = time.perf_counter()
+                await self.message_callback(self=self.bot, message=message)
+                self._record('event_message', time.perf_counter() - handler_start)
+
+            messages_done = time.perf_counter()
+            await asyncio.gather(*self._command_futures, return_exceptions=True)
+            commands_done = time.perf_counter()
+        finally:
+            self.bot.processor.submit_command = original_submit_command
+
+        stages = {
+            stage: {
+                'count': len(latencies),
+                'p50': percentile(sorted(latencies), 50),
+                'p95': percentile(sorted(latencies), 95),
+                'p99': percentile(sorted(latencies), 99),
+            }
+            for stage, latencies in self._stage_latencies.items()
+        }
+        metrics = getattr(self.bot, 'metrics', None)
+        if metrics is not None and metrics.enabled:
+            # Finer grained stages recorded by the pipeline itself
+            stages.update({f'pipeline {stage}': stats for stage, stats in metrics.percentiles().items()})
+
+        return {
+            'messages': len(self.messages),
+            'commands': self._submitted_commands,
+            'dropped_commands': self._dropped_commands,
+            'message_seconds': messages_done - wall_start,
+            'total_seconds': commands_done - wall_start,
+            'messages_per_second': len(self.messages) / max(messages_done - wall_start, 1e-9),
+            'stages': stages,
+            'queue': self.bot.processor.input_executor.stats(),
+        }
+
+    @staticmethod
+    def format_report(report: dict) -> str:
+        """Format a report dict from run as a table for the console."""
+        lines = [
+            f"[Replay] {report['messages']} messages in {report['message_seconds']:.3f}s "
+            f"({report['messages_per_second']:.1f} messages/s), {report['commands']} commands "
+            f"({report['dropped_commands']} dropped after queueing), "
+            f"all executed after {report['total_seconds']:.3f}s",
+            f"{'stage':<24}{'count':>8}{'p50 ms':>12}{'p95 ms':>12}{'p99 ms':>12}",
+        ]
+        for stage, stats in report['stages'].items():
+            lines.append(
+                f"{stage:<24}{stats['count']:>8}{stats['p50'] * 1000:>12.3f}"
+                f"{stats['p95'] * 1000:>12.3f}{stats['p99'] * 1000:>12.3f}"
+            )
+        lines.append('[Replay] queue: ' + ', '.join(f'{key}: {value}' for key, value in report['queue'].items()))
+        return '\n'.join(lines)
@@ -0,0 +1,110 @@
+"""Types text on an input backend, with the strategy its command asks for, and measures how fast each one goes.
+
+Classes:
+    TypingEngine -- types text as batched key events or game input, and pastes it in chunks
+"""
+
+import time
+import string
+import typing
+import logging as log
+
+from cmpc.input_backends import InputBackend
+from cmpc.metrics import PipelineMetrics
+
+
+TYPEABLE_CHARACTERS = frozenset(string.ascii_letters + string.digits + string.punctuation + ' ')
+
+
+class TypingEngine:
+    """Type text on an input backend, with a fixed strategy for each typing command.
+
+    Strategies:
+        batch -- one typewrite call with all the key events, for type
+        game -- the backend's game_typewrite, for gtype, falling back to batch if the backend has no game input
+        paste -- the clipboard in chunks, only for ptype, since it replaces what the streamer has copied and a lot
+            of games ignore pasting
+    Text over the length cap for its strategy is cut short, so a wall of text can't hold up the input queue.
+    Public methods:
+        type_text
+        paste_text
+        stats
+    Instance variables:
+        input_backend -- the cmpc.InputBackend to type with
+        metrics -- cmpc.PipelineMetrics the time each strategy takes is recorded in
+        max_length -- the most characters typed or pasted from one message
+        max_game_length -- the most characters typed from one message with the game strategy
+        paste_chunk_size -- the most characters pasted at once
+    """
+
+    BATCH = 'batch'
+    PASTE = 'paste'
+    GAME = 'game'
+
+    def __init__(
+            self, input_backend: InputBackend, metrics: PipelineMetrics = None, max_length: int = None,
+            max_game_length: int = None, paste_chunk_size: int = None
+    ):
+        """Initialise the class attributes."""
+        self.input_backend = input_backend
+        if metrics is None:
+            metrics = PipelineMetrics(enabled=False)
+        self.metrics = metrics
+        if max_length is None:
+            max_length = 500
+        self.max_length = max_length
+        if max_game_length is None:
+            max_game_length = 100
+        self.max_game_length = max_game_length
+        if paste_chunk_size is None:
+            paste_chunk_size = 200
+        self.paste_chunk_size = paste_chunk_size
+
+        self._characters = {self.BATCH: 0, self.PASTE: 0, self.GAME: 0}
+        self._seconds = {self.BATCH: 0.0, self.PASTE: 0.0, self.GAME: 0.0}
+        self._truncated = 0
+
+    def type_text(self, text: str, game: bool = False) -> str:
+        """Type text with key presses, returning the name of the strategy used.
+
+        Characters there are no keys for, e.g. emoji, are skipped. If game is True, and the backend has game input,
+        it's typed with game input. Text is never pasted here, that's paste_text.
+        """
+        text = ''.join(character for character in text if character in TYPEABLE_CHARACTERS)
+        if game and self.input_backend.game_input:
+            self._run(self.GAME, text, self.input_backend.game_typewrite)
+            return self.GAME
+        self._run(self.BATCH, text, self.input_backend.typewrite)
+        return self.BATCH
+
+    def paste_text(self, text: str):
+        """Paste text through the clipboard in chunks. Raises cmpc.InputBackendError if it isn't available."""
+        self._run(self.PASTE, text, self._paste_chunks)
+
+    def stats(self) -> typing.Dict[str, typing.Union[int, float]]:
+        """Return the characters typed and the measured characters per second of each strategy."""
+        stats = {'truncated_messages': self._truncated}
+        for strategy, characters in self._characters.items():
+            stats[f'{strategy}_characters'] = characters
+            seconds = self._seconds[strategy]
+            stats[f'{strategy}_characters_per_second'] = round(characters / seconds, 1) if seconds else 0.0
+        return stats
+
+    def _run(self, strategy: str, text: str, type_function: typing.Callable[[str], typing.Any]):
+        """Cap the text's length, type it with type_function, and measure how fast it went."""
+        max_length = self.max_game_length if strategy == self.GAME else self.max_length
+        if len(text) > max_length:
+            log.info(f'[TYPING] Only typing the first {max_length} of {len(text)} characters.')
+            text = text[:max_length]
+            self._truncated += 1
+
+        start = time.perf_counter_ns()
+        type_function(text)
+        end = time.perf_counter_ns()
+        self.metrics.record(f'typing_{strategy}', start, end)
+        self._characters[strategy] += len(text)
+        self._seconds[strategy] += (end - start) / 1e9
+
+    def _paste_chunks(self, text: str):
+        for chunk_start in range(0, len(text), self.paste_chunk_size):
+            self.input_backend.paste(text[chunk_start:chunk_start + self.paste_chunk_size])
@@ -0,0 +1,134 @@
+"""In-process cache of the twitch user records mod tools checks for every message from a regular user.
+
+Classes:
+    UserRecord -- what's known about one twitch user, a row of the user info cache database
+    UserCache -- least recently used cache of user records, which expire after a while
+"""
+
+import time
+import collections
+import typing
+
+
+class UserRecord:
+    """What's known about one twitch user, a row of the users table in the user info cache database.
+
+    Public methods:
+        from_row
+        as_row
+        allowed_after
+    Instance variables:
+        id -- the twitch user id
+        allow -- True or False if they've been manually allowed or denied, otherwise None
+        allow_after -- the time in seconds since the epoch after which they're allowed, if it's been set by a
+            timeout, untimeout, or before account_created was stored, otherwise None
+        notified_ignored -- True if they've been told their messages are being ignored
+        account_created -- the time in seconds since the epoch their account was created, if it's known
+    """
+
+    __slots__ = ('id', 'allow', 'allow_after', 'notified_ignored', 'account_created', 'expires_at')
+
+    def __init__(
+            self, user_id: int, allow: typing.Optional[bool] = None, allow_after: float = None,
+            notified_ignored: bool = False, account_created: float = None
+    ):
+        """Initialise the class attributes."""
+        self.id = user_id
+        self.allow = allow
+        self.allow_after = allow_after
+        self.notified_ignored = notified_ignored
+        self.account_created = account_created
+        # Set by UserCache.put
+        self.expires_at = 0.0
+
+    @classmethod
+    def from_row(cls, row: tuple) -> 'UserRecord':
+        """Make a record from a (id, allow, allow_after, notified_ignored, account_created) row."""
+        user_id, allow, allow_after, notified_ignored, account_created = row
+        return cls(
+            user_id, None if allow is None else bool(allow), allow_after, bool(notified_ignored), account_created
+        )
+
+    def as_row(self) -> tuple:
+        """Return the record as a (id, allow, allow_after, notified_ignored, account_created) row."""
+        return self.id, self.allow, self.allow_after, self.notified_ignored, self.account_created
+
+    def allowed_after(self, required_age_seconds: float) -> float:
+        """Return the time in seconds since the epoch after which they're allowed.
+
+        That's allow_after if it's been set, otherwise when their account is old enough, so changing the required
+        age applies to every cached user straight away.
+        """
+        if self.allow_after is not None:
+            return self.allow_after
+        if self.account_created is None:
+            return 0.0
+        return self.account_created + required_age_seconds
+
+    def __repr__(self) -> str:
+        return f'UserRecord{self.as_row()!r}'
+
+
+class UserCache:
+    """Least recently used cache of user records, keyed by user id, which expire ttl seconds after they're put.
+
+    Once max_size records are cached, putting another evicts the least recently used one. Expired records count
+    as misses, so they're read again from the database, picking up anything another process wrote there.
+    Public methods:
+        get
+        put
+        discard
+        stats
+    Instance variables:
+        max_size -- the most records kept
+        ttl -- seconds a record is kept for after it's put
+    """
+
+    def __init__(self, max_size: int = None, ttl: float = None, clock: typing.Callable[[], float] = None):
+        """Initialise the class attributes."""
+        if max_size is None:
+            max_size = 10000
+        self.max_size = max_size
+        if ttl is None:
+            ttl = 3600.0
+        self.ttl = ttl
+        if clock is None:
+            clock = time.monotonic
+        self.clock = clock
+
+        self._records = collections.OrderedDict()
+        self._counts = collections.Counter()
+
+    def get(self, user_id: int) -> typing.Optional[UserRecord]:
+        """Return the cached record for a user, or None if there isn't one or it's expired."""
+        record = self._records.get(user_id)
+        if record is None:
+            self._counts['misses'] += 1
+            return None
+        if record.expires_at <= self.clock():
+            del self._records[user_id]
+            self._counts['expired'] += 1
+            self._counts['misses'] += 1
+            return None
+        self._records.move_to_end(user_id)
+        self._counts['hits'] += 1
+        return record
+
+    def put(self, record: UserRecord):
+        """Cache a record, replacing any for the same user, and evicting the least recently used if it's full."""
+        record.expires_at = self.clock() + self.ttl
+        self._records[record.id] = record
+        self._records.move_to_end(record.id)
+        while len(self._records) > self.max_size:
+            self._records.popitem(last=False)
+            self._counts['evictions'] += 1
+
+    def discard(self, user_id: int):
+        """Remove a user's record if it's cached."""
+        self._records.pop(user_id, None)
+
+    def stats(self) -> typing.Dict[str, int]:
+        """Return the number of cached records, and how many hits, misses, evictions and expiries there have been."""
+        stats = {key: self._counts[key] for key in ('hits', 'misses', 'evictions', 'expired')}
+        stats['size'] = len(self._records)
+        return stats
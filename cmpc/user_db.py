@@ -0,0 +1,218 @@
+"""Runs sqlite on its own thread, so the asyncio loop never waits on the disk.
+
+Classes:
+    UserDatabase -- single connection database thread, committing writes in batches
+"""
+
+import time
+import queue
+import sqlite3
+import asyncio
+import threading
+import collections
+import typing
+import logging as log
+from pathlib import Path
+
+
+class UserDatabase:
+    """Own an sqlite connection on a dedicated thread, and run statements on it in the order they're given.
+
+    The database is put in WAL mode, so a commit is one append to the write ahead log. Writes are run as they come
+    but only committed once batch_interval seconds have passed since the first write of the batch, so a burst of
+    inserts and updates costs one commit (and one fsync) instead of one each. Reads run straight away, and see
+    writes queued before them even if they haven't been committed yet. Statements are cached by the connection
+    after they're first prepared, so the same sql string is only parsed once.
+    Every method returns an asyncio future for the result, which is set on the loop it was called from once the
+    statement has run, for reads, or has been committed, for writes. Awaiting them is optional.
+    Public methods:
+        execute
+        executemany
+        fetchone
+        fetchall
+        migrate
+        close
+        stats
+    Instance variables:
+        path -- the database file
+        batch_interval -- the most seconds writes wait to be committed
+    """
+
+    _WRITE = 'write'
+    _WRITE_MANY = 'write_many'
+    _FETCH_ONE = 'fetch_one'
+    _FETCH_ALL = 'fetch_all'
+    _MIGRATE = 'migrate'
+    _STOP = 'stop'
+
+    def __init__(self, path: typing.Union[str, Path], batch_interval: float = None):
+        """Initialise the class attributes, and start the database thread."""
+        self.path = path
+        if batch_interval is None:
+            batch_interval = 0.05
+        self.batch_interval = batch_interval
+
+        self._requests = queue.Queue()
+        self._counts = collections.Counter()
+        self._thread = threading.Thread(target=self._run, name='UserDatabase', daemon=True)
+        self._thread.start()
+
+    def execute(self, sql: str, parameters: typing.Sequence = ()) -> asyncio.Future:
+        """Queue a write, the future is set to the number of rows changed once it's been committed."""
+        return self._submit(self._WRITE, sql, parameters)
+
+    def executemany(self, sql: str, rows: typing.Iterable[typing.Sequence]) -> asyncio.Future:
+        """Queue a write for each row, in one statement, the future is set to the number of rows changed."""
+        return self._submit(self._WRITE_MANY, sql, list(rows))
+
+    def fetchone(self, sql: str, parameters: typing.Sequence = ()) -> asyncio.Future:
+        """Queue a read, the future is set to the first row, or None."""
+        return self._submit(self._FETCH_ONE, sql, parameters)
+
+    def fetchall(self, sql: str, parameters: typing.Sequence = ()) -> asyncio.Future:
+        """Queue a read, the future is set to a list of every row."""
+        return self._submit(self._FETCH_ALL, sql, parameters)
+
+    def migrate(self, migrations: typing.Sequence[typing.Sequence[str]]) -> asyncio.Future:
+        """Bring the schema up to date, the future is set to (the version it was, the version it is now).
+
+        migrations[n] is the list of statements which take the schema from version n to n + 1. The version is kept
+        in the schema_version table, a database without one is version 0. Each migration is committed with the new
+        version in one transaction, so a failed migration is rolled back and tried again on the next start.
+        Statements queued after this run on the migrated schema.
+        """
+        return self._submit(self._MIGRATE, None, migrations)
+
+    def close(self, timeout: float = 5.0):
+        """Commit anything waiting to be committed, then close the connection and stop the thread."""
+        self._requests.put((self._STOP, None, None, None, None))
+        self._thread.join(timeout)
+
+    def stats(self) -> typing.Dict[str, int]:
+        """Return how many statements have been run and commits made, and how many are queued."""
+        stats = {key: self._counts[key] for key in ('reads', 'writes', 'commits', 'errors')}
+        stats['queue_depth'] = self._requests.qsize()
+        return stats
+
+    def _submit(self, kind: str, sql: str, parameters: typing.Sequence) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._requests.put((kind, sql, parameters, future, loop))
+        return future
+
+    @staticmethod
+    def _resolve(loop: asyncio.AbstractEventLoop, future: asyncio.Future, result=None, error: Exception = None):
+        def set_future():
+            if future.done():
+                return
+            if error is not None:
+                future.set_exception(error)
+            else:
+                future.set_result(result)
+
+        try:
+            loop.call_soon_threadsafe(set_future)
+        except RuntimeError:
+            # The loop has been closed, nobody is waiting any more
+            pass
+
+    def _run(self):
+        # isolation_level=None so transactions are only started and committed here
+        connection = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False, cached_statements=256)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        cursor = connection.cursor()
+        log.info(f'Connected to user info cache {self.path}')
+
+        # Futures of the writes in the open transaction, set once it's committed
+        uncommitted = []
+        commit_at = None
+        running = True
+        while running:
+            timeout = None if commit_at is None else max(0.0, commit_at - time.monotonic())
+            try:
+                kind, sql, parameters, future, loop = self._requests.get(timeout=timeout)
+            except queue.Empty:
+                kind = None
+
+            if kind == self._STOP:
+                running = False
+            elif kind is not None:
+                if kind in (self._WRITE, self._WRITE_MANY) and not connection.in_transaction:
+                    cursor.execute('BEGIN')
+                    commit_at = time.monotonic() + self.batch_interval
+                try:
+                    if kind == self._MIGRATE:
+                        if connection.in_transaction:
+                            self._commit(connection, uncommitted)
+                            uncommitted = []
+                            commit_at = None
+                        result = self._migrate(connection, parameters)
+                    elif kind == self._WRITE:
+                        cursor.execute(sql, parameters)
+                    elif kind == self._WRITE_MANY:
+                        cursor.executemany(sql, parameters)
+                    else:
+                        cursor.execute(sql, parameters)
+                        result = cursor.fetchone() if kind == self._FETCH_ONE else cursor.fetchall()
+                except sqlite3.Error as error:
+                    self._counts['errors'] += 1
+                    log.error(f'[DATABASE] {error} running: {sql or kind}')
+                    self._resolve(loop, future, error=error)
+                else:
+                    if kind in (self._WRITE, self._WRITE_MANY):
+                        self._counts['writes'] += 1
+                        uncommitted.append((loop, future, cursor.rowcount))
+                    else:
+                        self._counts['reads'] += 1
+                        self._resolve(loop, future, result)
+
+            if connection.in_transaction and (not running or time.monotonic() >= commit_at):
+                self._commit(connection, uncommitted)
+                uncommitted = []
+                commit_at = None
+            elif not connection.in_transaction:
+                commit_at = None
+
+        connection.close()
+
+    @staticmethod
+    def _migrate(connection: sqlite3.Connection, migrations: typing.Sequence[typing.Sequence[str]]
+                 ) -> typing.Tuple[int, int]:
+        connection.execute('CREATE TABLE IF NOT EXISTS schema_version (version INT)')
+        row = connection.execute('SELECT version FROM schema_version').fetchone()
+        if row is None:
+            connection.execute('INSERT INTO schema_version VALUES (0)')
+            old_version = 0
+        else:
+            old_version = row[0]
+
+        for version in range(old_version, len(migrations)):
+            connection.execute('BEGIN')
+            try:
+                for statement in migrations[version]:
+                    connection.execute(statement)
+                connection.execute('UPDATE schema_version SET version=?', (version + 1,))
+                connection.execute('COMMIT')
+            except sqlite3.Error:
+                connection.execute('ROLLBACK')
+                raise
+            log.info(f'[DATABASE] Migrated the database to version {version + 1}')
+        return old_version, max(old_version, len(migrations))
+
+    def _commit(self, connection: sqlite3.Connection, uncommitted: typing.List[tuple]):
+        try:
+            connection.execute('COMMIT')
+        except sqlite3.Error as error:
+            self._counts['errors'] += 1
+            log.error(f'[DATABASE] Could not commit {len(uncommitted)} writes: {error}')
+            try:
+                connection.execute('ROLLBACK')
+            except sqlite3.Error:
+                pass
+            for loop, future, row_count in uncommitted:
+                self._resolve(loop, future, error=error)
+            return
+        self._counts['commits'] += 1
+        for loop, future, row_count in uncommitted:
+            self._resolve(loop, future, row_count)
@@ -0,0 +1,110 @@
+"""Coalesces lookups of twitch users, so a burst of cache misses costs one api request.
+
+Classes:
+    UserLookup -- single-flight lookups by user id, batched into one fetch of up to max_batch_size ids
+"""
+
+import asyncio
+import collections
+import typing
+import logging as log
+
+
+class UserLookup:
+    """Look up users by id through a fetch function, which is called with a batch of ids at a time.
+
+    Lookups for an id that's already being looked up wait for that lookup instead of starting another
+    (single-flight). Other ids are collected for batch_window seconds, or until there are max_batch_size of them,
+    then fetched together. The fetch function returns a dict of id -> result for the ids it found, ids it didn't
+    find are looked up as None. If it raises, the exception is raised to every lookup in the batch.
+    Public methods:
+        get
+        get_many
+        stats
+    Instance variables:
+        fetch -- coroutine function taking a list of ids and returning a dict of id -> result
+        batch_window -- seconds ids are collected for before they're fetched
+        max_batch_size -- the most ids fetched at once, 100 for the twitch api
+    """
+
+    def __init__(
+            self, fetch: typing.Callable[[typing.List[int]], typing.Awaitable[typing.Dict[int, typing.Any]]],
+            batch_window: float = None, max_batch_size: int = None
+    ):
+        """Initialise the class attributes."""
+        self.fetch = fetch
+        if batch_window is None:
+            batch_window = 0.01
+        self.batch_window = batch_window
+        if max_batch_size is None:
+            max_batch_size = 100
+        self.max_batch_size = max_batch_size
+
+        # id -> future for every id that's queued or being fetched
+        self._in_flight = {}
+        self._queued = []
+        self._timer = None
+        self._counts = collections.Counter()
+
+    async def get(self, user_id: int) -> typing.Any:
+        """Look up a user, returning the fetch function's result for them, or None if they weren't found."""
+        future = self._in_flight.get(user_id)
+        if future is None:
+            future = self._queue(user_id)
+        else:
+            self._counts['coalesced'] += 1
+        # Shielded, so one lookup being cancelled doesn't cancel it for every other lookup of the id
+        return await asyncio.shield(future)
+
+    async def get_many(self, user_ids: typing.Iterable[int]) -> typing.Dict[int, typing.Any]:
+        """Look up several users at once, returning a dict of id -> result, or None for ids that weren't found."""
+        user_ids = list(dict.fromkeys(user_ids))
+        results = await asyncio.gather(*(self.get(user_id) for user_id in user_ids))
+        return dict(zip(user_ids, results))
+
+    def stats(self) -> typing.Dict[str, int]:
+        """Return how many lookups there have been, how many waited for another lookup, and how many fetches."""
+        stats = {key: self._counts[key] for key in ('lookups', 'coalesced', 'batches', 'errors')}
+        stats['in_flight'] = len(self._in_flight)
+        return stats
+
+    def _queue(self, user_id: int) -> asyncio.Future:
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self._in_flight[user_id] = future
+        self._queued.append(user_id)
+        self._counts['lookups'] += 1
+        if len(self._queued) >= self.max_batch_size:
+            self._start_batch()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.batch_window, self._start_batch)
+        return future
+
+    def _start_batch(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        user_ids = self._queued[:self.max_batch_size]
+        self._queued = self._queued[self.max_batch_size:]
+        if self._queued:
+            self._timer = asyncio.get_event_loop().call_later(self.batch_window, self._start_batch)
+        if user_ids:
+            asyncio.ensure_future(self._run_batch(user_ids))
+
+    async def _run_batch(self, user_ids: typing.List[int]):
+        self._counts['batches'] += 1
+        log.debug(f'Looking up {len(user_ids)} users')
+        try:
+            results = await self.fetch(user_ids)
+        except Exception as error:
+            self._counts['errors'] += 1
+            for user_id in user_ids:
+                future = self._in_flight.pop(user_id)
+                if not future.done():
+                    future.set_exception(error)
+            return
+
+        for user_id in user_ids:
+            future = self._in_flight.pop(user_id)
+            if not future.done():
+                future.set_result(results.get(user_id))
@@ -5,33 +5,35 @@ Functions:
     get_get_repo_info -- self explanatory
     removeprefix -- self explanatory, builtin as of 3.9 but here for compatibility with prior versions
     get_size -- for encoding large numbers into SI prefixes
+    parse_twitch_time -- converts a time from the twitch api to seconds since the epoch
     direct_or_auto -- returns 'auto' or 'direct' based on platform
     send_webhook -- simplifies sending of basic messages to discord webhooks
+    webhook_dispatcher -- returns the cmpc.WebhookDispatcher every discord webhook is sent through
+    webhook_outbox -- returns the cmpc.WebhookOutbox which send_webhook spools messages to
     send_error -- sends info on an unexpected exception to a discord webhook in embed form
     input_handler -- returns pyautogui or pydirectinput based on platform
-    move_mouse -- moves the mouse with either pyautogui or pydirectinput situtationally
-    hold_mouse -- holds the mouse with either pyautogui or pydirectinput situtationally
-    press_key -- presses a key with either pyautogui or pydirectinput situtationally
-    hold_mouse -- holds a key with either pyautogui or pydirectinput situtationally
+    move_mouse -- moves the mouse with the platform's default input backend
+    hold_mouse -- holds the mouse with the platform's default input backend
+    press_key -- presses a key with the platform's default input backend
+    hold_key -- holds a key with the platform's default input backend
     send_data -- gets info about the environment of the script and sends it to a discord webhook
     running_as_admin -- checks whether running as admin
 """
 
 # PSL Packages;
 import time
-import json
+import calendar
 import sys
 import typing
 import re
 from pathlib import Path
 
 # PIP Packages;
-import aiohttp
-import requests
-import pyautogui
 import psutil
 
 from cmpc.twitch_message import TwitchMessage
+from cmpc.webhook_dispatcher import WebhookDispatcher
+from cmpc.outbox import WebhookOutbox
 
 # Check if we are on windows
 if sys.platform == 'win32':
@@ -46,6 +48,8 @@ __all__ = (
     'get_size',
     'direct_or_auto',
     'send_webhook',
+    'webhook_dispatcher',
+    'webhook_outbox',
     'send_error',
     'input_handler',
     'move_mouse',
@@ -143,6 +147,16 @@ def get_size(value: float, suffix: str = 'B') -> str:
         value /= factor
 
 
+def parse_twitch_time(timestamp: str) -> float:
+    """Return the seconds since the epoch of a twitch api time, e.g. 2021-08-20T02:40:35Z, with or without fractions."""
+    try:
+        time_struct = time.strptime(timestamp, '%Y-%m-%dT%H:%M:%S.%fZ')
+    except ValueError:
+        time_struct = time.strptime(timestamp, '%Y-%m-%dT%H:%M:%SZ')
+    # It's UTC, which mktime would take as local time
+    return float(calendar.timegm(time_struct))
+
+
 def direct_or_auto() -> str:
     """Return if we should use pydirectinput or pyautogui."""
     if sys.platform == 'win32':
@@ -153,12 +167,34 @@ def direct_or_auto() -> str:
         return 'auto'
 
 
+_webhook_dispatcher = None
+
+
+def webhook_dispatcher() -> WebhookDispatcher:
+    """Return the cmpc.WebhookDispatcher shared by everything that sends discord webhooks."""
+    global _webhook_dispatcher
+    if _webhook_dispatcher is None:
+        _webhook_dispatcher = WebhookDispatcher()
+    return _webhook_dispatcher
+
+
+_webhook_outbox = None
+
+
+def webhook_outbox() -> WebhookOutbox:
+    """Return the cmpc.WebhookOutbox send_webhook queues messages in."""
+    global _webhook_outbox
+    if _webhook_outbox is None:
+        _webhook_outbox = WebhookOutbox(webhook_dispatcher())
+    return _webhook_outbox
+
+
 def send_webhook(url: str, content: str):
-    """Send a webhook to discord."""
-    data = {'content': content}
-    if url == "":
-        return
-    requests.post(url, data=data)
+    """Queue a message to be sent to a discord webhook, without waiting for it to be sent.
+
+    The message is spooled to disk first, so it's still sent after a restart if it couldn't be sent before.
+    """
+    webhook_outbox().send(url, {'content': content})
 
 
 async def send_error(
@@ -189,72 +225,68 @@ async def send_error(
             }
         ]
     }
-    async with aiohttp.ClientSession() as session:
-        await session.post(url, data=json.dumps(data), headers={'Content-Type': 'application/json'})
+    await webhook_dispatcher().send(url, data)
 
 
 def input_handler():
     """Return pyautogui or pydirectinput based on platform."""
     dor = direct_or_auto()
 
-    handler = pyautogui
-    if dor == 'auto':
-        handler = pyautogui
-    elif dor == 'direct':
-        handler = pydirectinput
+    if dor == 'direct':
+        return pydirectinput
+    import pyautogui
+    return pyautogui
+
 
-    return handler
+_input_backend = None
 
 
-def move_mouse(*args, **kwargs):
+def _default_input_backend():
+    """Return the default cmpc.InputBackend for the platform, resolved the first time it's needed."""
+    global _input_backend
+    if _input_backend is None:
+        from cmpc.input_backends import get_input_backend
+        _input_backend = get_input_backend()
+    return _input_backend
+
+
+def move_mouse(xval: int, yval: int):
     """Move the mouse, with cross-platform support."""
-    dor = direct_or_auto()
-    if dor == 'auto':
-        pyautogui.move(*args, **kwargs)
-    if dor == 'direct':
-        pydirectinput.move(*args, **kwargs)
+    _default_input_backend().move(xval, yval)
 
 
-def hold_mouse(time_value: float, *args, **kwargs):
+def hold_mouse(time_value: float, button: str = 'left'):
     """Hold a mouse button, with cross-platform support."""
-    dor = direct_or_auto()
-    handler = pyautogui
-    if dor == 'auto':
-        handler = pyautogui
-    elif dor == 'direct':
-        handler = pydirectinput
-    handler.mouseDown(*args, **kwargs)
-    time.sleep(time_value)
-    handler.mouseUp(*args, **kwargs)
-
-
-def press_key(*args, **kwargs):
-    """Press a key , with cross-platform support."""
-    dor = direct_or_auto()
-    if dor == 'auto':
-        pyautogui.press(*args, **kwargs)
-    if dor == 'direct':
-        pydirectinput.press(*args, **kwargs)
+    input_backend = _default_input_backend()
+    input_backend.mouse_down(button)
+    input_backend.sleep(time_value)
+    input_backend.mouse_up(button)
 
 
-def hold_key(time_value: float, *args, **kwargs):
+def press_key(key: str):
+    """Press a key, with cross-platform support."""
+    _default_input_backend().press(key)
+
+
+def hold_key(time_value: float, key: str):
     """Hold a key, with cross-platform support."""
-    dor = direct_or_auto()
-    handler = pyautogui
-    if dor == 'auto':
-        handler = pyautogui
-    elif dor == 'direct':
-        handler = pydirectinput
-    handler.keyDown(*args, **kwargs)
-    time.sleep(time_value)
-    handler.keyUp(*args, **kwargs)
-
-
-def parse_goto_args(message: TwitchMessage, prefix: str):
-    """Return the x and y coords. Used in go to and drag to commands."""
-    coord = removeprefix(message.content, prefix)
+    input_backend = _default_input_backend()
+    input_backend.key_down(key)
+    input_backend.sleep(time_value)
+    input_backend.key_up(key)
+
+
+def parse_goto_args(coord: str, screen_size: typing.Tuple[int, int] = None) -> typing.Tuple[int, int]:
+    """Return the x and y coords from the argument of the go to and drag to commands.
+
+    Accepts 'x y', or 'center'/'centre' for the middle of the screen.
+    screen_size defaults to the default input backend's screen size.
+    Raises ValueError if the coords are non-numeric or there aren't enough of them.
+    """
     if coord in ['center', 'centre']:
-        xval, yval = tuple(res / 2 for res in pyautogui.size())
+        if screen_size is None:
+            screen_size = _default_input_backend().size()
+        xval, yval = tuple(res / 2 for res in screen_size)
     else:
         xval, yval = coord.split(' ', 1)
     xval = int(xval)
@@ -302,5 +334,4 @@ async def send_data(url: str, context: dict):
             },
         ],
     }
-    async with aiohttp.ClientSession() as session:
-        await session.post(url, json=data)
+    await webhook_dispatcher().send(url, data)
@@ -0,0 +1,232 @@
+"""Sends discord webhooks from one shared session, batching embeds and keeping to discord's rate limits.
+
+Classes:
+    WebhookDispatcher -- queues payloads per webhook, and posts them from a worker task per webhook
+"""
+
+import time
+import asyncio
+import collections
+import typing
+import logging as log
+
+import aiohttp
+
+
+class WebhookDispatcher:
+    """Post discord webhook payloads in the background, with one pooled aiohttp session for every webhook.
+
+    Each webhook has its own queue and worker task, so a rate limited webhook doesn't hold up the others.
+    Payloads sent with batch=True are packed into one request with up to MAX_EMBEDS embeds, with each payload's
+    username and content moved into its embeds' author and footer. Only use it for payloads without pings.
+    Rate limits are tracked per bucket from discord's X-RateLimit headers, so a webhook waits for its bucket to
+    reset instead of being sent a 429. If one comes anyway, Retry-After is waited out and the request is retried.
+    send and send_nowait return a future for what happened to the payload: SENT, REJECTED by discord (a 4xx other
+    than 429, so sending it again won't help), or FAILED (a server or connection error, or dropped from the queue).
+    Public methods:
+        send
+        send_nowait
+        close
+        stats
+    Instance variables:
+        user_agent -- User-Agent header sent with every request
+        max_queue_size -- the most payloads queued per webhook, the oldest is dropped to make room
+        max_retries -- times a request is retried after a server or connection error
+    """
+
+    MAX_EMBEDS = 10
+
+    SENT = 'sent'
+    REJECTED = 'rejected'
+    FAILED = 'failed'
+
+    def __init__(self, user_agent: str = None, max_queue_size: int = None, max_retries: int = None):
+        """Initialise the class attributes. The session is created once there's something to send."""
+        if user_agent is None:
+            user_agent = 'CMPCscript (+https://cmpc.live/)'
+        self.user_agent = user_agent
+        if max_queue_size is None:
+            max_queue_size = 1000
+        self.max_queue_size = max_queue_size
+        if max_retries is None:
+            max_retries = 3
+        self.max_retries = max_retries
+
+        self._session = None
+        # url -> deque of (payload, batch, future)
+        self._queues = {}
+        self._wake_events = {}
+        self._workers = {}
+        # url -> rate limit bucket, bucket -> (remaining requests, monotonic time it resets)
+        self._url_buckets = {}
+        self._buckets = {}
+        self._global_reset_at = 0.0
+        self._counts = collections.Counter()
+
+    async def send(self, url: str, payload: dict, batch: bool = False) -> asyncio.Future:
+        """Queue a payload to be posted to a webhook. Returns once it's queued, not once it's sent."""
+        return self.send_nowait(url, payload, batch=batch)
+
+    def send_nowait(self, url: str, payload: dict, batch: bool = False) -> asyncio.Future:
+        """Queue a payload to be posted to a webhook. Must be called from the loop's thread.
+
+        Returns a future for SENT, REJECTED or FAILED, awaiting it is optional. An empty url is REJECTED.
+        """
+        future = asyncio.get_event_loop().create_future()
+        if not url:
+            future.set_result(self.REJECTED)
+            return future
+        queue = self._queues.get(url)
+        if queue is None:
+            queue = self._queues[url] = collections.deque()
+            self._wake_events[url] = asyncio.Event()
+            self._workers[url] = asyncio.ensure_future(self._run_worker(url))
+        if len(queue) >= self.max_queue_size:
+            queue.popleft()[2].set_result(self.FAILED)
+            self._counts['dropped'] += 1
+            log.warning('[DISCORD] Webhook queue is full, dropped the oldest message.')
+        queue.append((payload, batch, future))
+        self._counts['queued'] += 1
+        self._wake_events[url].set()
+        return future
+
+    async def close(self, timeout: float = 5.0):
+        """Give the queues up to timeout seconds to empty, then stop the workers and close the session."""
+        deadline = time.monotonic() + timeout
+        while any(self._queues.values()) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        for worker in self._workers.values():
+            worker.cancel()
+        self._workers.clear()
+        self._queues.clear()
+        if self._session is not None:
+            await self._session.close()
+            self._session = None
+
+    def stats(self) -> typing.Dict[str, int]:
+        """Return how many payloads have been queued, sent and dropped, requests made, and 429s received."""
+        stats = {key: self._counts[key] for key in ('queued', 'sent', 'requests', 'rate_limited', 'dropped')}
+        stats['queue_depth'] = sum(len(queue) for queue in self._queues.values())
+        return stats
+
+    async def _run_worker(self, url: str):
+        queue = self._queues[url]
+        wake_event = self._wake_events[url]
+        while True:
+            if not queue:
+                wake_event.clear()
+                await wake_event.wait()
+                continue
+
+            entries = [queue.popleft()] if not queue[0][1] else self._take_batch(queue)
+            payloads = [payload for payload, batch, future in entries]
+            try:
+                status = await self._post(url, self._merge_payloads(payloads), len(payloads))
+            except Exception:
+                # A bad payload mustn't stop everything after it being sent
+                log.exception('[DISCORD] Error sending webhook')
+                self._counts['dropped'] += len(payloads)
+                status = self.REJECTED
+            for payload, batch, future in entries:
+                if not future.done():
+                    future.set_result(status)
+
+    def _take_batch(self, queue: collections.deque) -> typing.List[tuple]:
+        """Take batchable entries off the front of the queue, up to MAX_EMBEDS embeds between them."""
+        entries = []
+        embed_count = 0
+        while queue and queue[0][1]:
+            payload_embed_count = len(queue[0][0].get('embeds', ())) or 1
+            if entries and embed_count + payload_embed_count > self.MAX_EMBEDS:
+                break
+            entries.append(queue.popleft())
+            embed_count += payload_embed_count
+        return entries
+
+    @staticmethod
+    def _merge_payloads(payloads: typing.List[dict]) -> dict:
+        if len(payloads) == 1:
+            return payloads[0]
+
+        embeds = []
+        for payload in payloads:
+            payload_embeds = payload.get('embeds') or [{'description': payload.get('content', '')}]
+            for embed in payload_embeds:
+                embed = dict(embed)
+                if payload.get('username'):
+                    embed.setdefault('author', {'name': payload['username']})
+                if payload.get('content') and payload.get('embeds'):
+                    embed.setdefault('footer', {'text': payload['content']})
+                embeds.append(embed)
+        return {'embeds': embeds}
+
+    async def _wait_for_rate_limit(self, url: str):
+        now = time.monotonic()
+        wait_until = self._global_reset_at
+        bucket = self._url_buckets.get(url)
+        if bucket is not None:
+            remaining, reset_at = self._buckets.get(bucket, (1, 0.0))
+            if remaining <= 0:
+                wait_until = max(wait_until, reset_at)
+        if wait_until > now:
+            await asyncio.sleep(wait_until - now)
+
+    def _update_rate_limit(self, url: str, headers: typing.Mapping[str, str]):
+        bucket = headers.get('X-RateLimit-Bucket')
+        if bucket is None:
+            return
+        self._url_buckets[url] = bucket
+        try:
+            remaining = int(headers.get('X-RateLimit-Remaining', 1))
+            reset_after = float(headers.get('X-RateLimit-Reset-After', 0))
+        except ValueError:
+            return
+        self._buckets[bucket] = (remaining, time.monotonic() + reset_after)
+
+    async def _post(self, url: str, payload: dict, payload_count: int) -> str:
+        if self._session is None:
+            self._session = aiohttp.ClientSession(headers={'User-Agent': self.user_agent})
+
+        failures = 0
+        while True:
+            await self._wait_for_rate_limit(url)
+            self._counts['requests'] += 1
+            try:
+                async with self._session.post(url, json=payload) as response:
+                    self._update_rate_limit(url, response.headers)
+                    if response.status == 429:
+                        self._counts['rate_limited'] += 1
+                        retry_after = await self._get_retry_after(response)
+                        if response.headers.get('X-RateLimit-Global'):
+                            self._global_reset_at = time.monotonic() + retry_after
+                        log.warning(f'[DISCORD] Rate limited, retrying in {retry_after:.2f}s')
+                        await asyncio.sleep(retry_after)
+                        continue
+                    if response.status < 400:
+                        self._counts['sent'] += payload_count
+                        return self.SENT
+                    if response.status < 500:
+                        log.error(f'[DISCORD] Webhook rejected with {response.status}: {await response.text()}')
+                        self._counts['dropped'] += payload_count
+                        return self.REJECTED
+                    error = f'status {response.status}'
+            except (aiohttp.ClientError, asyncio.TimeoutError) as client_error:
+                error = repr(client_error)
+
+            failures += 1
+            if failures > self.max_retries:
+                log.error(f'[DISCORD] Gave up sending webhook after {failures} tries: {error}')
+                self._counts['dropped'] += payload_count
+                return self.FAILED
+            await asyncio.sleep(2 ** failures)
+
+    @staticmethod
+    async def _get_retry_after(response: aiohttp.ClientResponse) -> float:
+        try:
+            return float(response.headers['Retry-After'])
+        except (KeyError, ValueError):
+            pass
+        try:
+            return float((await response.json(content_type=None))['retry_after'])
+        except (ValueError, KeyError, TypeError, aiohttp.ClientError):
+            return 1.0
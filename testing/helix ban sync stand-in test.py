@@ -0,0 +1,188 @@
+"""Runs cmpc.BanListSync against a local stand-in for the helix moderation/banned endpoint.
+
+Checks bans and timeouts are written to the users table, later syncs only read new bans, a sync that's stopped
+part way through carries on from its saved cursor, and a cursor twitch refuses with 400 starts the sync again from
+the newest ban. Doesn't need twitch:
+    python "testing/helix ban sync stand-in test.py"
+"""
+
+import time
+import tempfile
+from pathlib import Path
+
+from aiohttp import web
+
+from stand_in import check, serve, run
+from cmpc.ban_sync import BanListSync, BanSyncError
+from cmpc.user_db import UserDatabase
+from cmpc.mod_tools import USER_DB_MIGRATIONS
+
+BROADCASTER_ID = '77'
+TOKEN = 'stand-in-token'
+
+
+def twitch_time(timestamp: float) -> str:
+    return time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(timestamp))
+
+
+class HelixStandIn:
+    """Pages through bans newest first like helix does.
+
+    Cursors include a generation, so expire_cursors makes every cursor handed out so far get a 400, like an old
+    cursor does on twitch. fail_requests is a set of request numbers answered with a 503, and rate_limit_requests
+    a set answered with Ratelimit-Remaining 0, or a 429 if they're also in too_many_requests.
+    """
+
+    def __init__(self):
+        self.bans = []
+        self.requests = []
+        self.generation = 0
+        self.fail_requests = set()
+        self.rate_limit_requests = set()
+        self.too_many_requests = set()
+        self.base_time = int(time.time()) - 100000
+
+    def add_bans(self, user_ids: range, timeout_every: int = 0):
+        """Add bans newer than every ban so far. Every timeout_every'th one is a 10 minute timeout."""
+        newest = self.base_time + len(self.bans)
+        new_bans = []
+        for number, user_id in enumerate(user_ids, 1):
+            created_at = newest + number
+            timeout = timeout_every and number % timeout_every == 0
+            new_bans.append({
+                'user_id': str(user_id), 'user_login': f'user{user_id}', 'user_name': f'user{user_id}',
+                'created_at': twitch_time(created_at),
+                'expires_at': twitch_time(created_at + 600) if timeout else '',
+                'reason': '', 'moderator_id': '1', 'moderator_login': 'mod', 'moderator_name': 'mod',
+            })
+        self.bans[:0] = reversed(new_bans)
+
+    def expire_cursors(self):
+        self.generation += 1
+
+    async def handle(self, request: web.Request) -> web.Response:
+        self.requests.append(dict(request.query))
+        request_number = len(self.requests)
+        if request.headers.get('Authorization') != f'Bearer {TOKEN}' or request.query['broadcaster_id'] != '77':
+            return web.json_response({'status': 401, 'message': 'Invalid OAuth token'}, status=401)
+
+        headers = {'Ratelimit-Remaining': '799', 'Ratelimit-Reset': str(int(time.time()) + 1)}
+        if request_number in self.rate_limit_requests:
+            headers['Ratelimit-Remaining'] = '0'
+            if request_number in self.too_many_requests:
+                return web.json_response({'status': 429, 'message': 'Too Many Requests'}, status=429, headers=headers)
+        if request_number in self.fail_requests:
+            return web.json_response({'status': 503, 'message': 'Service Unavailable'}, status=503)
+
+        start = 0
+        if 'after' in request.query:
+            generation, _, offset = request.query['after'].partition(':')
+            if int(generation) != self.generation:
+                return web.json_response({'status': 400, 'message': 'invalid cursor'}, status=400)
+            start = int(offset)
+        first = int(request.query.get('first', 20))
+        page = self.bans[start:start + first]
+        pagination = {}
+        if start + first < len(self.bans):
+            pagination['cursor'] = f'{self.generation}:{start + first}'
+        return web.json_response({'data': page, 'pagination': pagination}, headers=headers)
+
+
+async def main():
+    stand_in = HelixStandIn()
+    app = web.Application()
+    app.router.add_get('/helix/moderation/banned', stand_in.handle)
+    runner, port = await serve(app)
+
+    database_folder = tempfile.TemporaryDirectory()
+    user_db = UserDatabase(Path(database_folder.name)/'user_cache.db', batch_interval=0.01)
+    await user_db.migrate(USER_DB_MIGRATIONS)
+    # Already told they're ignored, which a ban mustn't reset
+    await user_db.execute('INSERT INTO users VALUES (1005, NULL, NULL, 1, NULL)')
+
+    changed_user_ids = []
+    ban_sync = BanListSync(
+        user_db, 'stand-in-client-id', TOKEN, base_url=f'http://127.0.0.1:{port}/helix/',
+        on_users_changed=changed_user_ids.extend, max_retries=0
+    )
+
+    async def count_users() -> int:
+        return (await user_db.fetchone('SELECT count(*) FROM users'))[0]
+
+    async def sync_state() -> dict:
+        return dict(await user_db.fetchall('SELECT name, value FROM sync_state'))
+
+    # First sync, through a rate limit and a 429
+    stand_in.add_bans(range(1001, 1251), timeout_every=10)
+    stand_in.rate_limit_requests = {2, 3}
+    stand_in.too_many_requests = {2}
+    synced = await ban_sync.sync(BROADCASTER_ID)
+    check('first sync reads every ban', synced == 250, f'{synced} users, {len(stand_in.requests)} requests')
+    check('first sync pages 100 at a time', [request.get('first') for request in stand_in.requests] == ['100'] * 4)
+    check('429 is retried', stand_in.requests[1] == stand_in.requests[2])
+    check('every changed user is reported', sorted(changed_user_ids) == list(range(1001, 1251)))
+    banned = await user_db.fetchone('SELECT allow, allow_after, notified_ignored FROM users WHERE id=1005')
+    check('bans deny the user and keep notified_ignored', tuple(banned) == (0, None, 1), f'{tuple(banned)}')
+    timed_out = await user_db.fetchone('SELECT allow, allow_after FROM users WHERE id=1010')
+    check('timeouts set allow_after', timed_out[0] is None and timed_out[1] > 0, f'{tuple(timed_out)}')
+    state = await sync_state()
+    check('finished sync only keeps the newest ban', list(state) == [BanListSync.STATE_NEWEST], f'{state}')
+
+    # Incremental sync
+    stand_in.requests.clear()
+    stand_in.rate_limit_requests = set()
+    stand_in.too_many_requests = set()
+    stand_in.add_bans(range(2001, 2004))
+    synced = await ban_sync.sync(BROADCASTER_ID)
+    check('next sync only reads new bans', synced == 3 and len(stand_in.requests) == 1,
+          f'{synced} users, {len(stand_in.requests)} requests')
+
+    # Stopped part way through, then resumed from the saved cursor
+    stand_in.requests.clear()
+    stand_in.add_bans(range(3001, 3151))
+    stand_in.fail_requests = {2}
+    try:
+        await ban_sync.sync(BROADCASTER_ID)
+    except BanSyncError as error:
+        check('failed page stops the sync', True, str(error))
+    else:
+        check('failed page stops the sync', False)
+    state = await sync_state()
+    check('cursor is saved after every page', state.get(BanListSync.STATE_CURSOR) == '0:100', f'{state}')
+    check('pages before the failure are written', await count_users() == 253 + 100)
+
+    stand_in.requests.clear()
+    stand_in.fail_requests = set()
+    synced = await ban_sync.sync(BROADCASTER_ID)
+    check('resumed sync carries on from the cursor', stand_in.requests[0].get('after') == '0:100',
+          f'{stand_in.requests}')
+    check('resumed sync reads the rest', synced == 50, f'{synced} users')
+    check('resumed sync clears the cursor', list(await sync_state()) == [BanListSync.STATE_NEWEST])
+    check('every ban is written once', await count_users() == 253 + 150)
+
+    # Stopped part way through, then twitch refuses the saved cursor
+    stand_in.requests.clear()
+    stand_in.add_bans(range(4001, 4151))
+    stand_in.fail_requests = {2}
+    try:
+        await ban_sync.sync(BROADCASTER_ID)
+    except BanSyncError:
+        pass
+    stand_in.expire_cursors()
+    stand_in.requests.clear()
+    stand_in.fail_requests = set()
+    synced = await ban_sync.sync(BROADCASTER_ID)
+    afters = [request.get('after') for request in stand_in.requests]
+    check('refused cursor starts again from the newest ban', afters == ['0:100', None, '1:100'], f'{afters}')
+    check('restarted sync reads every new ban', synced == 150, f'{synced} users')
+    check('restarted sync clears the cursor', list(await sync_state()) == [BanListSync.STATE_NEWEST])
+    check('every ban is written once after a restart', await count_users() == 253 + 150 + 150)
+
+    check('only finished syncs are counted', ban_sync.stats()['syncs'] == 4, f'{ban_sync.stats()}')
+    user_db.close()
+    database_folder.cleanup()
+    await runner.cleanup()
+
+
+if __name__ == '__main__':
+    run(main)
@@ -0,0 +1,160 @@
+"""Runs cmpc.ObsWebsocketClient against a local stand-in for the obs websocket plugin (protocol 4.x).
+
+Checks it backs off while obs is down, authenticates, fails requests instead of hanging, and reconnects straight
+away when the connection drops. Doesn't need obs:
+    python "testing/obs websocket stand-in test.py"
+"""
+
+import time
+import base64
+import asyncio
+import hashlib
+
+from aiohttp import web
+
+from stand_in import check, serve, run
+from cmpc.obs_client import ObsWebsocketClient, ObsWebsocketError
+
+PASSWORD = 'hunter2'
+
+
+class ObsStandIn:
+    """Answers the requests the client sends like obs does. While up is False, websocket handshakes are refused."""
+
+    def __init__(self, password: str):
+        self.password = password
+        self.salt = 'c2FsdA=='
+        self.challenge = 'Y2hhbGxlbmdl'
+        self.up = True
+        self.attempts = []
+        self.text = ''
+        self.websockets = set()
+
+    def expected_auth(self) -> str:
+        secret = base64.b64encode(hashlib.sha256((self.password + self.salt).encode()).digest())
+        return base64.b64encode(hashlib.sha256(secret + self.challenge.encode()).digest()).decode()
+
+    async def handle(self, request: web.Request) -> web.StreamResponse:
+        self.attempts.append(time.monotonic())
+        if not self.up:
+            return web.Response(status=503)
+        websocket = web.WebSocketResponse()
+        await websocket.prepare(request)
+        self.websockets.add(websocket)
+        authenticated = False
+        async for message in websocket:
+            data = message.json()
+            request_type = data['request-type']
+            reply = {'message-id': data['message-id'], 'status': 'ok'}
+            if request_type == 'GetAuthRequired':
+                reply.update(authRequired=True, salt=self.salt, challenge=self.challenge)
+            elif request_type == 'Authenticate':
+                authenticated = data.get('auth') == self.expected_auth()
+                if not authenticated:
+                    reply.update(status='error', error='Authentication Failed.')
+            elif not authenticated:
+                reply.update(status='error', error='Not Authenticated')
+            elif request_type == 'GetTextGDIPlusProperties':
+                reply.update(source=data['source'], read_from_file=False, text=self.text)
+            elif request_type == 'SetTextGDIPlusProperties':
+                self.text = data['text']
+            elif request_type == 'Stall':
+                # Never answered, like obs hanging
+                continue
+            await websocket.send_json(reply)
+        self.websockets.discard(websocket)
+        return websocket
+
+    async def drop(self):
+        for websocket in list(self.websockets):
+            await websocket.close()
+
+
+async def wait_for(condition, timeout: float = 3.0) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        await asyncio.sleep(0.01)
+    return True
+
+
+async def main():
+    stand_in = ObsStandIn(PASSWORD)
+    app = web.Application()
+    app.router.add_get('/', stand_in.handle)
+    runner, port = await serve(app)
+
+    connects = []
+
+    async def on_connect():
+        connects.append(time.monotonic())
+
+    client = ObsWebsocketClient(
+        host='127.0.0.1', port=port, password=PASSWORD, on_connect=on_connect,
+        min_backoff=0.1, max_backoff=0.4, request_timeout=0.5
+    )
+
+    # Obs is down, the client should keep trying with a growing, capped backoff
+    stand_in.up = False
+    run_task = asyncio.ensure_future(client.run())
+    await asyncio.sleep(1.5)
+    gaps = [later - earlier for earlier, later in zip(stand_in.attempts, stand_in.attempts[1:])]
+    check('retries while obs is down', len(gaps) >= 3, f'{len(stand_in.attempts)} attempts')
+    check('first retry uses the minimum backoff', bool(gaps) and gaps[0] <= 0.15, f'{gaps[:1]}')
+    check('backoff grows', bool(gaps) and max(gaps) >= 0.19, f'{[round(gap, 2) for gap in gaps]}')
+    check('backoff is capped', bool(gaps) and max(gaps) <= 0.45)
+    try:
+        await client.call('GetVersion')
+    except ObsWebsocketError:
+        check('call fails straight away while disconnected', True)
+    else:
+        check('call fails straight away while disconnected', False)
+
+    # Obs comes up
+    stand_in.up = True
+    check('connects once obs is up', await wait_for(lambda: client.connected))
+    check('on_connect is awaited', len(connects) == 1)
+    await client.call('SetTextGDIPlusProperties', source='executing', text='w for 2')
+    check('requests reach obs', stand_in.text == 'w for 2')
+    start = time.monotonic()
+    try:
+        await client.call('Stall')
+    except ObsWebsocketError:
+        check('unanswered request times out', time.monotonic() - start < 1.0)
+    else:
+        check('unanswered request times out', False)
+
+    # The connection drops with a request in flight
+    stalled = asyncio.ensure_future(client.call('Stall'))
+    await asyncio.sleep(0.05)
+    dropped_at = time.monotonic()
+    await stand_in.drop()
+    try:
+        await stalled
+    except ObsWebsocketError as error:
+        check('in flight request fails when the connection drops', time.monotonic() - dropped_at < 0.4, str(error))
+    else:
+        check('in flight request fails when the connection drops', False)
+    check('reconnects after the connection drops', await wait_for(lambda: len(connects) == 2))
+    check('reconnect starts from the minimum backoff', connects[-1] - dropped_at < 0.3,
+          f'{connects[-1] - dropped_at:.2f}s')
+    check('reconnects are counted', client.stats()['reconnects'] == 1, f"{client.stats()}")
+    await client.call('SetTextGDIPlusProperties', source='executing', text='nothing')
+    check('requests work after reconnecting', stand_in.text == 'nothing')
+
+    # A wrong password never counts as connected
+    wrong_password = ObsWebsocketClient(host='127.0.0.1', port=port, password='wrong', min_backoff=0.1)
+    wrong_task = asyncio.ensure_future(wrong_password.run())
+    await asyncio.sleep(0.5)
+    check('wrong password is not connected', not wrong_password.connected)
+
+    wrong_password.stop()
+    client.stop()
+    await asyncio.wait_for(asyncio.gather(run_task, wrong_task), 3.0)
+    check('stops', run_task.done() and not client.connected)
+    await runner.cleanup()
+
+
+if __name__ == '__main__':
+    run(main)
@@ -0,0 +1,44 @@
+"""Shared by the stand-in test scripts in this folder, which run part of the script against a local stand-in service.
+
+Importing it puts the repo folder on sys.path, so cmpc can be imported when a script is run from the testing folder.
+Functions:
+    check -- print PASS or FAIL for one check, remembering the failures
+    serve -- serve an aiohttp app on a free local port
+    run -- run a test coroutine, then print the result and exit with 1 if any check failed
+"""
+
+import sys
+import asyncio
+import typing
+from pathlib import Path
+
+from aiohttp import web
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+failures = []
+
+
+def check(name: str, passed: bool, detail: str = ''):
+    """Print whether a check passed, with detail if given."""
+    print(f"{'PASS' if passed else 'FAIL'} {name}{f' ({detail})' if detail else ''}")
+    if not passed:
+        failures.append(name)
+
+
+async def serve(app: web.Application) -> typing.Tuple[web.AppRunner, int]:
+    """Serve app on 127.0.0.1 on a free port. Returns the runner, to clean up at the end, and the port."""
+    runner = web.AppRunner(app)
+    await runner.setup()
+    site = web.TCPSite(runner, '127.0.0.1', 0)
+    await site.start()
+    return runner, runner.addresses[0][1]
+
+
+def run(main: typing.Callable[[], typing.Awaitable]):
+    """Run main on a new event loop, then exit with 1 if any check failed."""
+    asyncio.run(main())
+    if failures:
+        print(f'{len(failures)} checks failed')
+        sys.exit(1)
+    print('All checks passed')